@@ -0,0 +1,291 @@
+import collections
+import itertools
+import json
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeHomeserver:
+    """Minimal in-process Matrix homeserver for benchmarking the bot
+
+    Runs in its own thread so that the blocking requests made by the bot
+    (account data, typing) don't deadlock the event loop. Supports just
+    enough of the client-server API for the bot to sync, send messages,
+    upload media, store account data, set typing and list members.
+
+    Messages are queued with inject() and delivered in the next /sync
+    response. A command is considered handled when the bot clears its
+    typing notification in the room the command was sent to.
+    """
+
+    def __init__(self, user_id, rooms=10, members=5, server_name='fake.example', host='127.0.0.1', port=0):
+        self.user_id = user_id
+        self.server_name = server_name
+        self.lock = threading.Condition()
+        self.counter = itertools.count(1)
+        self.rooms = dict()  # room_id -> [member mxid, ..]
+        self.new_rooms = []  # room_id's created since last sync
+        self.pending = collections.defaultdict(list)  # room_id -> [event, ..] to deliver
+        self.pending_commands = collections.defaultdict(collections.deque)  # room_id -> deque of (inject time, delivery time)
+        self.account_data = dict()
+        self.next_batch = 0
+        self.last_sync_sent = None
+        self.last_sync_had_events = False
+
+        # Metrics
+        self.injected = 0
+        self.completed = 0
+        self.latencies = []  # seconds from sync delivery to command handled
+        self.end_to_end = []  # seconds from inject to command handled
+        self.sync_processing = []  # seconds from sync response with events to next sync request
+        self.sends = 0
+        self.uploads = 0
+        self.uploaded_bytes = 0
+        self.requests = collections.Counter()
+
+        for i in range(rooms):
+            room_id = f'!room{i}:{server_name}'
+            self.rooms[room_id] = [user_id] + [self.member_id(i * members + j) for j in range(members)]
+
+        self.httpd = ThreadingHTTPServer((host, port), self.handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @staticmethod
+    def member_id(index):
+        # Spread users over a few homeservers to make stats interesting
+        return f'@user{index}:hs{index % 7}.example'
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='fakehomeserver', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.lock.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def inject(self, room_id, sender, body, command=False):
+        """Queue a text message to be delivered to the bot in the next sync"""
+        event = {
+            'type': 'm.room.message',
+            'event_id': f'$ev{next(self.counter)}',
+            'sender': sender,
+            'origin_server_ts': int(time.time() * 1000),
+            'content': {'msgtype': 'm.text', 'body': body},
+        }
+        with self.lock:
+            self.pending[room_id].append((event, time.monotonic() if command else None))
+            self.injected += 1 if command else 0
+            self.lock.notify_all()
+        return event['event_id']
+
+    def outstanding(self):
+        with self.lock:
+            return sum(len(events) for events in self.pending.values()) + \
+                sum(len(commands) for commands in self.pending_commands.values())
+
+    # Event builders
+
+    def state_event(self, event_type, state_key, content, sender=None):
+        return {
+            'type': event_type,
+            'state_key': state_key,
+            'event_id': f'$st{next(self.counter)}',
+            'sender': sender or self.user_id,
+            'origin_server_ts': int(time.time() * 1000),
+            'content': content,
+        }
+
+    def room_state(self, room_id):
+        members = self.rooms[room_id]
+        state = [
+            self.state_event('m.room.create', '', {'creator': members[0]}),
+            self.state_event('m.room.name', '', {'name': room_id[1:].split(':')[0]}),
+            self.state_event('m.room.power_levels', '', {'users': {self.user_id: 100}}),
+        ]
+        state.extend(self.state_event('m.room.member', mxid, {'membership': 'join'}, sender=mxid) for mxid in members)
+        return state
+
+    # Request handling
+
+    def sync(self, since, timeout):
+        with self.lock:
+            now = time.monotonic()
+            if self.last_sync_sent is not None and self.last_sync_had_events:
+                self.sync_processing.append(now - self.last_sync_sent)
+
+            rooms = dict()
+            if not since:
+                for room_id in self.rooms:
+                    rooms[room_id] = {'state': {'events': self.room_state(room_id)}, 'timeline': {'events': []}}
+                self.new_rooms = []
+            else:
+                deadline = now + timeout
+                while not any(self.pending.values()) and not self.new_rooms and time.monotonic() < deadline:
+                    self.lock.wait(deadline - time.monotonic())
+                for room_id in self.new_rooms:
+                    rooms[room_id] = {'state': {'events': self.room_state(room_id)}, 'timeline': {'events': []}}
+                self.new_rooms = []
+
+            delivered = time.monotonic()
+            for room_id, events in self.pending.items():
+                if not events:
+                    continue
+                room = rooms.setdefault(room_id, {'state': {'events': []}, 'timeline': {'events': []}})
+                for event, injected in events:
+                    room['timeline']['events'].append(event)
+                    if injected is not None:
+                        self.pending_commands[room_id].append((injected, delivered))
+                events.clear()
+
+            self.next_batch += 1
+            self.last_sync_had_events = any(room['timeline']['events'] for room in rooms.values())
+            self.last_sync_sent = time.monotonic()
+            return {
+                'next_batch': f's{self.next_batch}',
+                'rooms': {'join': {room_id: dict(room, ephemeral={'events': []}, account_data={'events': []}) for room_id, room in rooms.items()},
+                          'invite': {}, 'leave': {}},
+                'account_data': {'events': []},
+                'presence': {'events': []},
+                'to_device': {'events': []},
+            }
+
+    def typing(self, room_id, content):
+        if content.get('typing'):
+            return
+        with self.lock:
+            commands = self.pending_commands.get(room_id)
+            if not commands:
+                return
+            injected, delivered = commands.popleft()
+            now = time.monotonic()
+            self.completed += 1
+            self.latencies.append(now - delivered)
+            self.end_to_end.append(now - injected)
+
+    def create_room(self, content):
+        room_id = f'!created{next(self.counter)}:{self.server_name}'
+        with self.lock:
+            self.rooms[room_id] = [self.user_id] + list(content.get('invite', []))
+            self.new_rooms.append(room_id)
+            self.lock.notify_all()
+        return room_id
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            routes = [
+                ('GET', re.compile(r'/_matrix/client/[^/]+/sync$'), 'handle_sync'),
+                ('PUT', re.compile(r'/_matrix/client/[^/]+/rooms/([^/]+)/send/([^/]+)/([^/]+)$'), 'handle_send'),
+                ('POST', re.compile(r'/_matrix/media/[^/]+/upload$'), 'handle_upload'),
+                ('GET', re.compile(r'/_matrix/client/[^/]+/user/([^/]+)/account_data/([^/]+)$'), 'handle_get_account_data'),
+                ('PUT', re.compile(r'/_matrix/client/[^/]+/user/([^/]+)/account_data/([^/]+)$'), 'handle_put_account_data'),
+                ('PUT', re.compile(r'/_matrix/client/[^/]+/rooms/([^/]+)/typing/([^/]+)$'), 'handle_typing'),
+                ('GET', re.compile(r'/_matrix/client/[^/]+/rooms/([^/]+)/joined_members$'), 'handle_joined_members'),
+                ('GET', re.compile(r'/_matrix/client/[^/]+/rooms/([^/]+)/event/([^/]+)$'), 'handle_get_event'),
+                ('POST', re.compile(r'/_matrix/client/[^/]+/createRoom$'), 'handle_create_room'),
+            ]
+
+            def log_message(self, format, *args):
+                pass
+
+            def reply(self, code, data):
+                body = json.dumps(data).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def read_body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return self.rfile.read(length) if length else b''
+
+            def read_json(self):
+                body = self.read_body()
+                return json.loads(body) if body else {}
+
+            def dispatch(self, method):
+                parsed = urllib.parse.urlsplit(self.path)
+                self.query = urllib.parse.parse_qs(parsed.query)
+                for route_method, pattern, handler in self.routes:
+                    if route_method != method:
+                        continue
+                    match = pattern.match(parsed.path)
+                    if match:
+                        server.requests[handler] += 1
+                        args = [urllib.parse.unquote(arg) for arg in match.groups()]
+                        return getattr(self, handler)(*args)
+                self.read_body()
+                server.requests['unknown'] += 1
+                self.reply(404, {'errcode': 'M_UNRECOGNIZED', 'error': f'Unrecognized request {method} {parsed.path}'})
+
+            def do_GET(self):
+                self.dispatch('GET')
+
+            def do_PUT(self):
+                self.dispatch('PUT')
+
+            def do_POST(self):
+                self.dispatch('POST')
+
+            def handle_sync(self):
+                since = self.query.get('since', [None])[0]
+                # Don't keep the bot waiting for the full long poll, the benchmark ends quickly
+                timeout = min(int(self.query.get('timeout', ['0'])[0]), 1000) / 1000
+                self.reply(200, server.sync(since, timeout))
+
+            def handle_send(self, room_id, event_type, txn_id):
+                self.read_json()
+                with server.lock:
+                    server.sends += 1
+                self.reply(200, {'event_id': f'$sent{next(server.counter)}'})
+
+            def handle_upload(self):
+                body = self.read_body()
+                with server.lock:
+                    server.uploads += 1
+                    server.uploaded_bytes += len(body)
+                self.reply(200, {'content_uri': f'mxc://{server.server_name}/upload{next(server.counter)}'})
+
+            def handle_get_account_data(self, user_id, data_type):
+                data = server.account_data.get(data_type)
+                if data is None:
+                    self.reply(404, {'errcode': 'M_NOT_FOUND', 'error': 'Account data not found'})
+                else:
+                    self.reply(200, data)
+
+            def handle_put_account_data(self, user_id, data_type):
+                server.account_data[data_type] = self.read_json()
+                self.reply(200, {})
+
+            def handle_typing(self, room_id, user_id):
+                server.typing(room_id, self.read_json())
+                self.reply(200, {})
+
+            def handle_joined_members(self, room_id):
+                members = server.rooms.get(room_id, [])
+                self.reply(200, {'joined': {mxid: {'display_name': mxid[1:].split(':')[0], 'avatar_url': None} for mxid in members}})
+
+            def handle_get_event(self, room_id, event_id):
+                self.reply(200, {'event_id': event_id, 'room_id': room_id, 'type': 'm.room.message', 'sender': server.user_id,
+                                 'origin_server_ts': int(time.time() * 1000), 'content': {}})
+
+            def handle_create_room(self):
+                self.reply(200, {'room_id': server.create_room(self.read_json())})
+
+        return Handler
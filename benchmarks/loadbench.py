@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""End-to-end load benchmark for the bot
+
+Starts a fake homeserver in-process, runs the real Bot against it and feeds it
+messages at a configurable rate. Reports command throughput, command latency,
+sync processing time and peak RSS.
+
+Run from the repository root:
+
+    python3 -m benchmarks.loadbench --rooms 50 --members 20 --rate 20 --duration 30
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import time
+
+from benchmarks.fakehomeserver import FakeHomeserver
+
+BOT_USER = '@hemppa:fake.example'
+OWNER = '@owner:fake.example'
+DEFAULT_MIX = 'echo hello=5,bot version=1,bot status=1,bot stats=1,help=1'
+DEFAULT_MODULES = 'bot,echo,help,alias'
+
+
+def parse_mix(mix):
+    """Parse "command=weight,command=weight" into lists of commands and weights"""
+    commands, weights = [], []
+    for item in mix.split(','):
+        command, _, weight = item.partition('=')
+        commands.append('!' + command.strip())
+        weights.append(float(weight or 1))
+    return commands, weights
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+async def inject_messages(server, args):
+    rng = random.Random(args.seed)
+    commands, weights = parse_mix(args.mix)
+    room_ids = list(server.rooms)
+    interval = 1.0 / args.rate
+    end = time.monotonic() + args.duration
+    next_send = time.monotonic()
+    while time.monotonic() < end:
+        room_id = rng.choice(room_ids)
+        if rng.random() < args.chatter:
+            server.inject(room_id, rng.choice(server.rooms[room_id][1:]), 'just chatting, nothing to see here https://example.invalid/')
+        else:
+            server.inject(room_id, OWNER, rng.choices(commands, weights)[0], command=True)
+        next_send += interval
+        await asyncio.sleep(max(0, next_send - time.monotonic()))
+
+
+async def wait_for(predicate, timeout):
+    end = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > end:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+
+async def run_benchmark(args):
+    server = FakeHomeserver(BOT_USER, rooms=args.rooms, members=args.members)
+    for room_members in server.rooms.values():
+        room_members.append(OWNER)
+    server.start()
+
+    os.environ.update({
+        'MATRIX_USER': BOT_USER,
+        'MATRIX_SERVER': server.url,
+        'MATRIX_ACCESS_TOKEN': 'benchmark',
+        'BOT_OWNERS': OWNER,
+    })
+
+    from bot import Bot
+    bot = Bot()
+    if not args.verbose:
+        logging.root.setLevel(logging.CRITICAL)
+    bot.init()
+    wanted = args.modules.split(',')
+    bot.modules = {name: module for name, module in bot.modules.items() if name in wanted}
+    for module in bot.modules.values():
+        module.enable()
+    bot.save_settings()
+
+    bot_task = asyncio.create_task(bot.run())
+    if not await wait_for(lambda: bot.poll_task is not None and server.next_batch > 1, 30):
+        bot_task.cancel()
+        server.stop()
+        raise RuntimeError('Bot did not finish initial sync')
+
+    started = time.monotonic()
+    await inject_messages(server, args)
+    await wait_for(lambda: server.outstanding() == 0, args.drain)
+    elapsed = time.monotonic() - started
+
+    bot.handle_exit('benchmark', asyncio.get_running_loop())
+    try:
+        await bot_task
+    except asyncio.CancelledError:
+        pass
+    await bot.close()
+    server.stop()
+
+    return {
+        'rooms': args.rooms,
+        'members_per_room': args.members + 2,
+        'rate': args.rate,
+        'duration': round(elapsed, 2),
+        'commands_sent': server.injected,
+        'commands_completed': server.completed,
+        'commands_per_sec': round(server.completed / elapsed, 2),
+        'latency_p50_ms': round(percentile(server.latencies, 50) * 1000, 2),
+        'latency_p99_ms': round(percentile(server.latencies, 99) * 1000, 2),
+        'end_to_end_p99_ms': round(percentile(server.end_to_end, 99) * 1000, 2),
+        'sync_processing_p50_ms': round(percentile(server.sync_processing, 50) * 1000, 2),
+        'sync_processing_p99_ms': round(percentile(server.sync_processing, 99) * 1000, 2),
+        'sync_processing_max_ms': round(max(server.sync_processing or [0]) * 1000, 2),
+        'messages_sent_by_bot': server.sends,
+        'uploads': server.uploads,
+        'peak_rss_mib': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the bot against a fake in-process homeserver')
+    parser.add_argument('--rooms', type=int, default=20, help='number of rooms the bot is in')
+    parser.add_argument('--members', type=int, default=10, help='members per room, in addition to the bot and owner')
+    parser.add_argument('--rate', type=float, default=10, help='messages per second over all rooms')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to send messages for')
+    parser.add_argument('--drain', type=float, default=10, help='seconds to wait for outstanding commands after sending')
+    parser.add_argument('--chatter', type=float, default=0.5, help='fraction of messages that are not commands')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'command mix with weights (default "{DEFAULT_MIX}")')
+    parser.add_argument('--modules', default=DEFAULT_MODULES, help=f'comma separated modules to load and enable (default "{DEFAULT_MODULES}")')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    parser.add_argument('--verbose', action='store_true', help='keep bot logging enabled')
+    args = parser.parse_args()
+
+    results = asyncio.run(run_benchmark(args))
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for key, value in results.items():
+            print(f'{key:>24}: {value}')
+    return 0 if results['commands_completed'] == results['commands_sent'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
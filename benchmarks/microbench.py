@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks for CPU heavy module code paths
+
+Each benchmark runs a module code path against a recorded fixture from
+benchmarks/fixtures, so no network access is needed. Results can be saved
+and compared against a previous run to catch regressions:
+
+    python3 -m benchmarks.microbench --save baseline.json
+    # ... make changes ...
+    python3 -m benchmarks.microbench --compare baseline.json
+
+Use -k to run only benchmarks whose name contains the given string.
+"""
+
+import argparse
+import asyncio
+import gzip
+import importlib
+import itertools
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import timeit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from nio import MatrixRoom, RoomMemberEvent
+
+from modules.common.membership import MembershipIndex
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+BENCHMARKS = dict()  # name -> setup function returning the callable to time
+
+
+def benchmark(func):
+    """Register a benchmark. The function gets the context and returns a callable to time."""
+    BENCHMARKS[func.__name__[len('bench_'):]] = func
+    return func
+
+
+def load_fixture(name):
+    path = os.path.join(FIXTURES, name)
+    if name.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            return f.read()
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def load_module(name):
+    return importlib.import_module('modules.' + name).MatrixModule(name)
+
+
+def user_ids(count, offset=0):
+    return [f'@user{i}:hs{i % 50}.example' for i in range(offset, offset + count)]
+
+
+class FixtureServer:
+    """Serves fixture files over http on localhost, ignoring the query string"""
+
+    def __init__(self):
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                body = load_fixture(self.path[1:].split('?', 1)[0])
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def url(self, fixture):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/{fixture}'
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class BenchBot:
+    """Just enough of Bot for module commands: rooms and a send_text that sends nothing"""
+
+    def __init__(self, rooms):
+        self.client = SimpleNamespace(rooms=rooms, user='@hemppa:bench.example')
+        self.members = MembershipIndex()
+        self.members.rebuild(rooms)
+        self.owners = ['@owner:bench.example']
+        self.sent = []
+
+    async def send_text(self, room, body, event=None, msgtype="m.notice", bot_ignore=False):
+        self.sent.append(body)
+
+    def must_be_owner(self, event):
+        pass
+
+    def must_be_admin(self, room, event, power_level=50):
+        pass
+
+    def save_settings(self):
+        pass
+
+
+def make_rooms(room_count, users_per_room, user_count):
+    rooms = dict()
+    users = user_ids(user_count)
+    cycle = itertools.cycle(users)
+    for i in range(room_count):
+        room = MatrixRoom(f'!room{i}:bench.example', '@hemppa:bench.example')
+        for _ in range(users_per_room):
+            room.add_member(next(cycle), None, None)
+        rooms[room.room_id] = room
+    return rooms
+
+
+def text_event(body):
+    return SimpleNamespace(body=body, sender='@owner:bench.example', source={'content': {'body': body}})
+
+
+@benchmark
+def bench_url_get_content_from_url(ctx):
+    module = load_module('url')
+    # Don't let the per domain rate limit throttle the benchmark
+    module.policies.set('127.0.0.1', {'rate': 10 ** 9})
+    counter = itertools.count()
+
+    def run():
+        # Unique query string so that caching doesn't hide the fetch and parse
+        title, description = ctx.loop.run_until_complete(
+            module.get_content_from_url(ctx.server.url('article.html.gz') + f'?n={next(counter)}'))
+        assert title
+    return run
+
+
+@benchmark
+def bench_flog_html_flog(ctx):
+    module = load_module('flog')
+    data = json.loads(load_fixture('flightbook_logbook.json'))
+    return lambda: module.html_flog(data, False)
+
+
+@benchmark
+def bench_flog_text_flog(ctx):
+    module = load_module('flog')
+    data = json.loads(load_fixture('flightbook_logbook.json'))
+    return lambda: module.text_flog(data, False)
+
+
+@benchmark
+def bench_googletasks_task_tree(ctx):
+    googletasks = importlib.import_module('modules.googletasks')
+    module = googletasks.MatrixModule('googletasks')
+    fixture = json.loads(load_fixture('googletasks_tasks.json'))
+
+    # Mimics the google api client: service.tasks().list(...).execute()
+    request = SimpleNamespace(execute=lambda: {'items': [dict(item) for item in fixture['items']]})
+    module.service = SimpleNamespace(tasks=lambda: SimpleNamespace(list=lambda **kwargs: request))
+
+    def run():
+        tasklist = googletasks.GoogleTasksList('list1', 'Benchmark')
+        module._load_tasklist_tasks(tasklist)
+        for task in tasklist.google_tasks.values():
+            task.get_html_and_text_summary()
+    return run
+
+
+@benchmark
+def bench_welcome_room_member_events(ctx):
+    module = load_module('welcome_room')
+    module.enabled = True
+    room = make_rooms(1, 5000, 5000)['!room0:bench.example']
+    module.rooms[room.room_id] = {'welcome_message': 'Welcome!', 'notify_departure': True, 'last_event_ts': 0}
+    events = [RoomMemberEvent.from_dict({
+        'type': 'm.room.member', 'event_id': f'$member{i}', 'sender': user, 'state_key': user,
+        'origin_server_ts': 1000 + i, 'content': {'membership': 'join' if i % 2 else 'leave'},
+        'unsigned': {'prev_content': {'membership': 'leave' if i % 2 else 'join'}},
+    }) for i, user in enumerate(user_ids(5000))]
+
+    async def handle():
+        for event in events:
+            await module.member_cb(room, event)
+
+    def run():
+        module.rooms[room.room_id]['last_event_ts'] = 0
+        module.recently_welcomed.clear()
+        module.handled_events.clear()
+        module.welcome_queue.clear()
+        module.departures.clear()
+        ctx.loop.run_until_complete(handle())
+    return run
+
+
+def users_command(ctx, body, room_count=200, users_per_room=500, user_count=20000):
+    module = load_module('users')
+    rooms = make_rooms(room_count, users_per_room, user_count)
+    bot = BenchBot(rooms)
+    module.matrix_start(bot)
+    module.classes = {f'hs{i}': f'@*:hs{i}.example' for i in range(0, 50, 5)}
+    module.classes['bridged'] = '@user1*:*'
+    room = next(iter(rooms.values()))
+    event = text_event(body)
+    return lambda: ctx.loop.run_until_complete(module.matrix_message(bot, room, event))
+
+
+@benchmark
+def bench_users_stats(ctx):
+    return users_command(ctx, '!users stats')
+
+
+@benchmark
+def bench_users_roomstats(ctx):
+    return users_command(ctx, '!users roomstats')
+
+
+@benchmark
+def bench_users_listall(ctx):
+    return users_command(ctx, '!users listall @user12*:hs2.example')
+
+
+def measure(func, repeat):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {'min': min(times), 'median': statistics.median(times), 'number': number}
+
+
+def format_time(seconds):
+    for unit, scale in [('s', 1), ('ms', 1e-3), ('us', 1e-6)]:
+        if seconds >= scale:
+            return f'{seconds / scale:.2f} {unit}'
+    return f'{seconds / 1e-9:.0f} ns'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run micro-benchmarks for module hot paths')
+    parser.add_argument('-k', dest='select', help='only run benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=5, help='timing rounds per benchmark')
+    parser.add_argument('--save', help='save results as json to this file')
+    parser.add_argument('--compare', help='compare against results saved earlier with --save')
+    parser.add_argument('--threshold', type=float, default=1.25, help='fail if a benchmark is this many times slower than in --compare')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    ctx = SimpleNamespace(loop=asyncio.new_event_loop(), server=FixtureServer())
+    baseline = dict()
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = dict()
+    regressions = []
+    for name, setup in BENCHMARKS.items():
+        if args.select and args.select not in name:
+            continue
+        try:
+            func = setup(ctx)
+        except ImportError as e:
+            print(f'{name:40} skipped: {e}')
+            continue
+        func()  # Warm up
+        result = results[name] = measure(func, args.repeat)
+        line = f'{name:40} {format_time(result["min"]):>12} min {format_time(result["median"]):>12} median'
+        if name in baseline:
+            ratio = result['min'] / baseline[name]['min']
+            line += f'  {ratio:.2f}x baseline'
+            if ratio > args.threshold:
+                regressions.append(name)
+                line += ' REGRESSION'
+        print(line)
+
+    ctx.server.stop()
+    ctx.loop.close()
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
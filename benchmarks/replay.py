@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""Replay recorded sync traffic into the bot
+
+Record traffic from a running bot by setting SYNC_RECORD_FILE=/path/to/file.jsonl.gz,
+then replay it locally against a stub client that never touches the network:
+
+    python3 -m benchmarks.replay recording.jsonl.gz --speed 10
+    python3 -m benchmarks.replay recording.jsonl.gz --speed 0 --profile replay.prof
+
+Speed 1 replays with the original timing, 0 as fast as possible. Reports sync
+processing times and the requests the bot made compared to the recording.
+Requests made before the first sync and retries of rate limited or failed
+requests are reported separately, as replay doesn't repeat them. Recorded
+requests that weren't replayed and replayed ones that weren't recorded are
+listed.
+"""
+
+import argparse
+import asyncio
+import collections
+import cProfile
+import itertools
+import logging
+import re
+import sys
+import time
+import urllib.parse
+
+from nio import AsyncClient, SyncResponse, UnknownAccountDataEvent
+
+from benchmarks.loadbench import percentile
+from modules.common.syncrecorder import load_recording, strip_url
+
+TXN_ID_RE = re.compile(r'/(send/[^/]+|redact/[^/]+|sendToDevice/[^/]+)/[^/]+$')
+MAX_LISTED = 10
+
+
+def request_key(method, path):
+    """Method and path of a request, without the transaction and event ids that differ in replay"""
+    path = urllib.parse.unquote(path.split('?', 1)[0])
+    path = re.sub(r'/redact/[^/]+/[^/]+$', '/redact/*/*', path)
+    return f'{method} {TXN_ID_RE.sub(lambda m: f"/{m.group(1)}/*", path)}'
+
+
+def list_requests(counter):
+    """Most common requests of counter as text, or 'none'"""
+    if not counter:
+        return 'none'
+    items = [f'{key} x{count}' for key, count in counter.most_common(MAX_LISTED)]
+    if len(counter) > MAX_LISTED:
+        items.append(f'and {len(counter) - MAX_LISTED} more')
+    return ', '.join(items)
+
+
+class ReplayClient(AsyncClient):
+    """nio client that answers all requests locally with canned responses"""
+
+    canned = [
+        (re.compile(r'/rooms/([^/]+)/send/'), lambda match, n: {'event_id': f'$replay{n}'}),
+        (re.compile(r'/upload'), lambda match, n: {'content_uri': f'mxc://replay.invalid/{n}'}),
+        (re.compile(r'/createRoom'), lambda match, n: {'room_id': f'!replay{n}:replay.invalid'}),
+        (re.compile(r'/rooms/([^/]+)/join|/join/([^/?]+)'), lambda match, n: {'room_id': match.group(1) or match.group(2)}),
+        (re.compile(r'/rooms/([^/]+)/(leave|kick|state|redact)'), lambda match, n: {'event_id': f'$replay{n}'}),
+    ]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requests = []
+        self.counter = itertools.count(1)
+
+    async def _send(self, response_class, method, path, data=None, response_data=None, **kwargs):
+        self.requests.append((method, strip_url(path)))
+        body = {'errcode': 'M_UNRECOGNIZED', 'error': 'Not available in replay'}
+        for pattern, make_body in self.canned:
+            match = pattern.search(path)
+            if match:
+                body = make_body(match, next(self.counter))
+                break
+        try:
+            resp = response_class.from_dict(body, *(response_data or ()))
+        except Exception:
+            resp = response_class.from_dict({'errcode': 'M_UNKNOWN', 'error': 'Not available in replay'}, *(response_data or ()))
+        await self.receive_response(resp)
+        return resp
+
+
+def make_bot(records):
+    from bot import Bot
+
+    class ReplayBot(Bot):
+        """Bot whose own http requests (account data, typing) are answered from the recording"""
+
+        def __init__(self, account_data):
+            super().__init__()
+            self.account_data = account_data
+            self.requests = []
+
+        def set_account_data(self, data, data_type=None):
+            if not data_type:
+                self.account_data = data
+            userid = urllib.parse.quote(self.matrix_user)
+            self.requests.append(('PUT', f'/_matrix/client/r0/user/{userid}/account_data/{data_type or self.appid}'))
+
+        def get_account_data(self):
+            return self.account_data
+
+        def room_typing(self, room_id, typing=True):
+            userid = urllib.parse.quote(self.matrix_user)
+            self.requests.append(('PUT', f'/_matrix/client/v3/rooms/{room_id}/typing/{userid}'))
+
+    start = next((record for record in records if record['kind'] == 'start'), {})
+    account_data = next((record['body'] for record in records if record['kind'] == 'account_data'), None)
+
+    bot = ReplayBot(account_data)
+    bot.matrix_user = start.get('matrix_user', '@hemppa:replay.invalid')
+    bot.owners = start.get('owners', [])
+    bot.join_on_invite = start.get('join_on_invite', bot.join_on_invite)
+    bot.invite_whitelist = start.get('invite_whitelist', bot.invite_whitelist)
+    bot.leave_empty_rooms = start.get('leave_empty_rooms', bot.leave_empty_rooms)
+    bot.owners_only = False
+    bot.client = ReplayClient('http://replay.invalid', bot.matrix_user)
+    bot.client.access_token = 'replay'
+    bot.get_modules()
+    bot.client.add_global_account_data_callback(bot.account_data_cb, UnknownAccountDataEvent)
+    return bot
+
+
+async def replay(records, args):
+    bot = make_bot(records)
+    syncs = [record for record in records if record['kind'] == 'sync']
+    first_sync = next((i for i, record in enumerate(records) if record['kind'] == 'sync'), len(records))
+    requests = [record for record in records if record['kind'] == 'request']
+    # Settings saved while starting up etc. aren't responses to syncs
+    before_sync = [record for record in records[:first_sync] if record['kind'] == 'request']
+    after_sync = [record for record in records[first_sync:] if record['kind'] == 'request']
+    # nio sent these again, replay answers the first time
+    retried = [record for record in after_sync if record.get('status') == 429 or isinstance(record.get('status'), str)]
+    expected = collections.Counter(request_key(record['method'], record['path']) for record in after_sync
+                                   if record not in retried)
+
+    processing = []
+    events = 0
+    profiler = cProfile.Profile() if args.profile else None
+    started = time.monotonic()
+    previous = None
+    running = False
+    for record in syncs:
+        if args.speed and previous is not None:
+            await asyncio.sleep(max(0, record['t'] - previous) / args.speed)
+        previous = record['t']
+
+        response = SyncResponse.from_dict(record['body'])
+        if not isinstance(response, SyncResponse):
+            continue
+        events += sum(len(room.timeline.events) for room in response.rooms.join.values())
+
+        if profiler:
+            profiler.enable()
+        before = time.perf_counter()
+        await bot.client.receive_response(response)
+        await bot.client.run_response_callbacks([response])
+        processing.append(time.perf_counter() - before)
+        if profiler:
+            profiler.disable()
+
+        if not running:
+            # Like Bot.run(), start handling events only after the initial sync
+            await bot.initial_sync_done()
+            bot.start()
+            bot.add_callbacks()
+            if args.poll:
+                bot.poll_task = asyncio.create_task(bot.poll_timer())
+            running = True
+
+    # Wait for replies and other requests that modules make in background tasks
+    pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task() and task is not bot.poll_task]
+    if pending:
+        await asyncio.wait(pending, timeout=args.drain)
+    elapsed = time.monotonic() - started
+
+    if bot.poll_task:
+        bot.poll_task.cancel()
+    bot.stop()
+    if profiler:
+        profiler.dump_stats(args.profile)
+
+    replayed = bot.client.requests + bot.requests
+    replayed_keys = collections.Counter(request_key(method, path) for method, path in replayed)
+
+    return {
+        'syncs': len(processing),
+        'timeline_events': events,
+        'duration': round(elapsed, 2),
+        'sync_processing_total_ms': round(sum(processing) * 1000, 2),
+        'sync_processing_p50_ms': round(percentile(processing, 50) * 1000, 2),
+        'sync_processing_p99_ms': round(percentile(processing, 99) * 1000, 2),
+        'sync_processing_max_ms': round(max(processing or [0]) * 1000, 2),
+        'requests_recorded': len(requests),
+        'requests_before_first_sync': len(before_sync),
+        'requests_retried': len(retried),
+        'requests_replayed': len(replayed),
+        'requests_not_replayed': list_requests(expected - replayed_keys),
+        'requests_not_recorded': list_requests(replayed_keys - expected),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a sync recording into the bot')
+    parser.add_argument('recording', help='file recorded with SYNC_RECORD_FILE')
+    parser.add_argument('--speed', type=float, default=1, help='replay speed multiplier, 0 = as fast as possible')
+    parser.add_argument('--poll', action='store_true', help='also run module polling during replay (may access network)')
+    parser.add_argument('--profile', help='write cProfile stats of sync processing to this file')
+    parser.add_argument('--drain', type=float, default=5, help='seconds to wait for background tasks after the last sync')
+    parser.add_argument('--verbose', action='store_true', help='keep bot logging enabled')
+    args = parser.parse_args()
+
+    records = load_recording(args.recording)
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+    results = asyncio.run(replay(records, args))
+    for key, value in results.items():
+        print(f'{key:>26}: {value}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,10 +23,12 @@ from PIL import Image
 
 import requests
 from nio import AsyncClient, InviteEvent, JoinError, RoomMessageText, MatrixRoom, LoginError, RoomMemberEvent, \
-    RoomVisibility, RoomPreset, RoomCreateError, RoomResolveAliasResponse, UploadError, UploadResponse, SyncError, \
-    RoomPutStateError
+    RoomVisibility, RoomPreset, RoomCreateError, RoomCreateResponse, RoomResolveAliasResponse, UploadError, UploadResponse, \
+    SyncError, SyncResponse, RoomPutStateError, UnknownAccountDataEvent
 
 from modules.common.exceptions import CommandRequiresAdmin, CommandRequiresOwner, UploadFailed
+from modules.common.membership import MembershipIndex
+from modules.common.syncrecorder import SyncRecorder
 
 
 class Bot:
@@ -41,11 +43,17 @@ class Bot:
         self.module_aliases = dict()
         self.leave_empty_rooms = True
         self.uri_cache = dict()
+        self.dm_rooms = dict()  # mxid -> room id of direct message room with the user
+        self.direct_rooms = dict()  # Content of m.direct account data, mxid -> [room id, ..]
+        self.dm_created = set()  # Room id's of direct message rooms created, but not seen in sync yet
+        self.dm_creations = dict()  # mxid -> task creating a direct message room
+        self.members = MembershipIndex()  # Users, rooms and homeservers seen by the bot
         self.pollcount = 0
         self.poll_task = None
         self.owners = []
         self.debug = os.getenv("DEBUG", "false").lower() == "true"
         self.logger = None
+        self.recorder = None  # Records sync traffic if SYNC_RECORD_FILE is set
 
         self.jointime = None  # HACKHACKHACK to avoid running old commands after join
         self.join_hack_time = 5  # Seconds
@@ -317,24 +325,88 @@ class Bot:
 
     async def find_or_create_private_msg(self, mxid, roomname):
         # Find if we already have a common room with user:
-        msg_room = None
-        for croomid in self.client.rooms:
-            roomobj = self.client.rooms[croomid]
-            if len(roomobj.users) == 2:
-                for user in roomobj.users:
-                    if user == mxid:
-                        msg_room = roomobj
-
-        # Nope, let's create one
-        if not msg_room:
-            msg_room = await self.client.room_create(visibility=RoomVisibility.private,
-                                                     name=roomname,
-                                                     is_direct=True,
-                                                     preset=RoomPreset.private_chat,
-                                                     invite={mxid},
-                                                     )
+        msg_room = self.get_private_msg_room(mxid)
+        if msg_room:
+            return msg_room
+
+        # Nope, let's create one. Concurrent sends to same user wait for the same room to be created.
+        creation = self.dm_creations.get(mxid)
+        if not creation:
+            creation = asyncio.ensure_future(self.create_private_msg(mxid, roomname))
+            self.dm_creations[mxid] = creation
+            creation.add_done_callback(lambda _: self.dm_creations.pop(mxid, None))
+        return await asyncio.shield(creation)
+
+    def get_private_msg_room(self, mxid):
+        """Return direct message room with user from index, or None if there is none"""
+        room_id = self.dm_rooms.get(mxid)
+        if not room_id:
+            return None
+        roomobj = self.client.rooms.get(room_id)
+        if roomobj:
+            if len(roomobj.users) == 2 and mxid in roomobj.users:
+                return roomobj
+        elif room_id in self.dm_created:
+            # Created by us, but not synced yet
+            return MatrixRoom(room_id, self.matrix_user)
+        del self.dm_rooms[mxid]
+        return None
+
+    async def create_private_msg(self, mxid, roomname):
+        msg_room = await self.client.room_create(visibility=RoomVisibility.private,
+                                                 name=roomname,
+                                                 is_direct=True,
+                                                 preset=RoomPreset.private_chat,
+                                                 invite={mxid},
+                                                 )
+        if isinstance(msg_room, RoomCreateResponse):
+            self.dm_rooms[mxid] = msg_room.room_id
+            self.dm_created.add(msg_room.room_id)
+            self.direct_rooms.setdefault(mxid, []).append(msg_room.room_id)
+            self.set_account_data(self.direct_rooms, 'm.direct')
         return msg_room
 
+    def build_dm_index(self):
+        """Index direct message rooms from current room state and m.direct account data"""
+        self.dm_rooms = dict()
+        for roomobj in self.client.rooms.values():
+            self.update_dm_index(roomobj)
+        self.apply_direct_rooms()
+
+    def update_dm_index(self, roomobj):
+        self.dm_created.discard(roomobj.room_id)
+        if len(roomobj.users) == 2:
+            for user in roomobj.users:
+                if user != self.matrix_user and not self.get_private_msg_room(user):
+                    self.dm_rooms[user] = roomobj.room_id
+        elif len(roomobj.users) == 3:
+            # Someone joined, the room is no longer a direct message room. Entries
+            # pointing to bigger rooms are dropped when looked up.
+            for user in roomobj.users:
+                if self.dm_rooms.get(user) == roomobj.room_id:
+                    del self.dm_rooms[user]
+
+    def apply_direct_rooms(self):
+        for mxid, room_ids in self.direct_rooms.items():
+            for room_id in room_ids:
+                roomobj = self.client.rooms.get(room_id)
+                if roomobj and len(roomobj.users) == 2 and mxid in roomobj.users:
+                    self.dm_rooms[mxid] = room_id
+                    break
+
+    async def sync_cb(self, response):
+        # Membership in state blocks (newly joined rooms, gaps) doesn't trigger event callbacks
+        for room_id, info in response.rooms.join.items():
+            if room_id in self.client.rooms and any(isinstance(event, RoomMemberEvent) for event in info.state):
+                self.members.sync_room(room_id, self.client.rooms[room_id].users)
+        for room_id in response.rooms.leave:
+            self.members.remove_room(room_id)
+
+    async def account_data_cb(self, event):
+        if event.type == 'm.direct':
+            self.direct_rooms = event.content
+            self.apply_direct_rooms()
+
     def remove_callback(self, callback):
         for cb_object in self.client.event_callbacks:
             if cb_object.func == callback:
@@ -491,6 +563,12 @@ class Bot:
             self.logger.warning(f'Received invite event, but not joining as sender is not owner or bot not configured to join on invite. {event}')
 
     async def memberevent_cb(self, room, event):
+        if event.state_key == self.matrix_user and event.membership in ('leave', 'ban'):
+            self.members.remove_room(room.room_id)
+        else:
+            self.members.update(room.room_id, event.state_key, event.membership)
+        self.update_dm_index(room)
+
         # Automatically leaves rooms where bot is alone.
         if room.member_count == 1 and event.membership == 'leave' and event.sender != self.matrix_user:
             self.logger.info(f"Membership event in {room.display_name} ({room.room_id}) with {room.member_count} members by '{event.sender}' (I am {self.matrix_user})- leaving room as i don't want to be left alone!")
@@ -537,12 +615,16 @@ class Bot:
                         self.logger.exception(f'unhandled exception from {modulename}.matrix_poll')
             await asyncio.sleep(10)
 
-    def set_account_data(self, data):
+    def set_account_data(self, data, data_type=None):
         userid = urllib.parse.quote(self.matrix_user)
+        data_type = data_type or self.appid
 
-        ad_url = f"{self.client.homeserver}/_matrix/client/r0/user/{userid}/account_data/{self.appid}?access_token={self.client.access_token}"
+        ad_url = f"{self.client.homeserver}/_matrix/client/r0/user/{userid}/account_data/{data_type}?access_token={self.client.access_token}"
 
-        response = requests.put(ad_url, json.dumps(data))
+        body = json.dumps(data)
+        response = requests.put(ad_url, body)
+        if self.recorder:
+            self.recorder.record_request('PUT', ad_url, body, response.status_code)
         self.__handle_error_response(response)
 
         if response.status_code != 200:
@@ -557,6 +639,8 @@ class Bot:
         self.__handle_error_response(response)
 
         if response.status_code == 200:
+            if self.recorder:
+                self.recorder.record('account_data', body=response.json())
             return response.json()
         self.logger.error(f'Getting account data failed: {response} {response.json()} - this is normal if you have not saved any settings yet.')
         return None
@@ -567,6 +651,8 @@ class Bot:
         ad_url = f"{self.client.homeserver}/_matrix/client/v3/rooms/{room_id}/typing/{userid}?access_token={self.client.access_token}"
         body = f'{{"typing": {str(typing).lower()}, "timeout": 30000}}'
         response = requests.put(ad_url, data=body)
+        if self.recorder:
+            self.recorder.record_request('PUT', ad_url, body, response.status_code)
         self.__handle_error_response(response)
 
     def __handle_error_response(self, response):
@@ -584,6 +670,7 @@ class Bot:
         invite_whitelist = os.getenv('INVITE_WHITELIST')
         owners_only = os.getenv('OWNERS_ONLY') is not None
         leave_empty_rooms = os.getenv('LEAVE_EMPTY_ROOMS')
+        sync_record_file = os.getenv('SYNC_RECORD_FILE')
 
         if matrix_server and self.matrix_user and bot_owners and access_token:
             self.client = AsyncClient(matrix_server, self.matrix_user, ssl=matrix_server.startswith("https://"))
@@ -593,6 +680,12 @@ class Bot:
             self.leave_empty_rooms = (leave_empty_rooms or 'true').lower() == 'true'
             self.owners = bot_owners.split(',')
             self.owners_only = owners_only
+            if sync_record_file:
+                self.recorder = SyncRecorder(sync_record_file)
+                self.recorder.attach(self.client)
+                self.recorder.record('start', matrix_user=self.matrix_user, owners=self.owners,
+                                     join_on_invite=self.join_on_invite, invite_whitelist=self.invite_whitelist,
+                                     leave_empty_rooms=self.leave_empty_rooms)
             self.get_modules()
 
         else:
@@ -620,24 +713,35 @@ class Bot:
                 self.logger.exception(f'unhandled exception from {modulename}.matrix_stop')
         self.logger.info(f'All modules stopped.')
 
+    def add_callbacks(self):
+        self.client.add_event_callback(self.message_cb, RoomMessageText)
+        self.client.add_event_callback(self.invite_cb, (InviteEvent,))
+        self.client.add_event_callback(self.memberevent_cb, (RoomMemberEvent,))
+        self.client.add_response_callback(self.sync_cb, SyncResponse)
+
+    async def initial_sync_done(self):
+        """Leave empty rooms and index rooms and members of the initial sync"""
+        for roomid, room in self.client.rooms.items():
+            self.logger.info(f"Bot is on '{room.display_name}'({roomid}) with {len(room.users)} users")
+            if len(room.users) == 1 and self.leave_empty_rooms:
+                self.logger.info(f'Room {roomid} has no other users - leaving it.')
+                self.logger.info(await self.client.room_leave(roomid))
+        self.build_dm_index()
+        self.members.rebuild(self.client.rooms)
+
     async def run(self):
+        self.client.add_global_account_data_callback(self.account_data_cb, UnknownAccountDataEvent)
         sync_response = await self.client.sync()
         if type(sync_response) == SyncError:
             self.logger.error(f"Received Sync Error when trying to do initial sync! Error message is: %s", sync_response.message)
         else:
-            for roomid, room in self.client.rooms.items():
-                self.logger.info(f"Bot is on '{room.display_name}'({roomid}) with {len(room.users)} users")
-                if len(room.users) == 1 and self.leave_empty_rooms:
-                    self.logger.info(f'Room {roomid} has no other users - leaving it.')
-                    self.logger.info(await self.client.room_leave(roomid))
+            await self.initial_sync_done()
 
             if self.client.logged_in:
                 self.start()
                 self.poll_task = asyncio.get_event_loop().create_task(self.poll_timer())
                 self.load_settings(self.get_account_data())
-                self.client.add_event_callback(self.message_cb, RoomMessageText)
-                self.client.add_event_callback(self.invite_cb, (InviteEvent,))
-                self.client.add_event_callback(self.memberevent_cb, (RoomMemberEvent,))
+                self.add_callbacks()
 
                 if self.join_on_invite:
                     self.logger.info('Note: Bot will join rooms if invited')
@@ -658,6 +762,8 @@ class Bot:
             self.logger.info("Connection closed")
         except Exception as ex:
             self.logger.error("error while closing client: %s", ex)
+        if self.recorder:
+            self.recorder.close()
 
     def handle_exit(self, signame, loop):
         self.logger.info(f"Received signal {signame}")
@@ -682,7 +788,8 @@ async def main():
     await bot.shutdown()
 
 
-try:
-    asyncio.run(main())
-except Exception as e:
-    traceback.print_exc(file=sys.stderr)
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except Exception as e:
+        traceback.print_exc(file=sys.stderr)
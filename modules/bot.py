@@ -1,6 +1,9 @@
 import collections
 import logging
+import re
 import json
+import os
+import tracemalloc
 import requests
 from html import escape
 from datetime import timedelta
@@ -8,18 +11,120 @@ import time
 
 from nio import RoomCreateError
 from modules.common.module import BotModule, ModuleCannotBeDisabled
-
-class LogDequeHandler(logging.Handler):
-    def __init__(self, count):
-        super().__init__(level = logging.NOTSET)
-        self.logs = dict()
-        self.level = logging.INFO
+from modules.common.formatting import format_size
+from modules.common.memory import MemorySnapshot, tracemalloc_by_module
+
+class LogRingBuffer(logging.Handler):
+    """Keeps recent log messages in memory for !bot logs
+
+    Messages are stored as compact (created, levelno, name, message) tuples and
+    formatted only when asked for. Each module keeps its last per_module
+    entries, and all live entries together are bounded by a global entry count
+    and a byte budget, whichever is hit first.
+    """
+
+    entry_overhead = 120  # Approximate bytes used by an entry besides strings
+
+    def __init__(self, per_module=100, capacity=2000, max_bytes=1024 * 1024):
+        super().__init__(level=logging.INFO)
+        self.per_module = per_module
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.entries = collections.deque()  # (key, entry) of all modules in order
+        self.logs = dict()  # key -> deque of entries
+        self.live = 0  # entries in self.logs, self.entries also has entries dropped by the per module limit
+        self.bytes = 0
+
+    @staticmethod
+    def key_for(record):
+        # Bot modules log as "module <name>", everything else by source file
+        if record.name.startswith('module '):
+            return record.name[7:]
+        return str(record.module)
+
+    @classmethod
+    def entry_size(cls, entry):
+        return cls.entry_overhead + len(entry[2]) + len(entry[3])
 
     def emit(self, record):
         try:
-            self.logs[str(record.module)].append(record)
-        except:
-            self.logs[str(record.module)] = collections.deque([record], maxlen=15)
+            msg = record.getMessage()
+            if record.exc_info:
+                msg += '\n' + logging.Formatter().formatException(record.exc_info)
+        except Exception:
+            self.handleError(record)
+            return
+        key = self.key_for(record)
+        entry = (record.created, record.levelno, record.name, msg)
+
+        module_logs = self.logs.get(key)
+        if module_logs is None:
+            module_logs = self.logs[key] = collections.deque()
+        module_logs.append(entry)
+        self.entries.append((key, entry))
+        self.live += 1
+        self.bytes += self.entry_size(entry)
+
+        if len(module_logs) > self.per_module:
+            # The entry stays in self.entries until it reaches the head or is compacted, but no longer counts
+            self.live -= 1
+            self.bytes -= self.entry_size(module_logs.popleft())
+        while self.live > self.capacity or self.bytes > self.max_bytes:
+            old_key, old_entry = self.entries.popleft()
+            old_logs = self.logs.get(old_key)
+            # The oldest entry overall is the oldest of its module, unless already dropped there
+            if old_logs and old_logs[0] is old_entry:
+                old_logs.popleft()
+                self.live -= 1
+                self.bytes -= self.entry_size(old_entry)
+                if not old_logs:
+                    del self.logs[old_key]
+        if len(self.entries) > 2 * self.capacity:
+            self.entries = collections.deque(reversed(self.live_entries()))
+
+    def live_entries(self):
+        """(key, entry) of entries still in self.logs, newest first"""
+        # Only the newest len(self.logs[key]) entries of each module in self.entries are still alive
+        alive = {logs_key: len(logs) for logs_key, logs in self.logs.items()}
+        newest_first = []
+        for entry_key, entry in reversed(self.entries):
+            if alive.get(entry_key):
+                alive[entry_key] -= 1
+                newest_first.append((entry_key, entry))
+        return newest_first
+
+    def format_entry(self, entry):
+        created, levelno, name, msg = entry
+        record = logging.makeLogRecord({'created': created, 'msecs': (created % 1) * 1000, 'levelno': levelno,
+                                        'levelname': logging.getLevelName(levelno), 'name': name, 'msg': msg})
+        return self.format(record)
+
+    def query(self, key=None, count=15, level=logging.NOTSET, grep=None):
+        """Return the count most recent formatted messages of a module, or of all modules if key is None
+
+        :param level: only return messages of this level or higher
+        :param grep: compiled regex the message must match
+        :return: list of formatted messages, oldest first, or None if there are no logs for key
+        """
+        self.acquire()
+        try:
+            if key is None:
+                newest_first = [entry for entry_key, entry in self.live_entries()]
+            elif key in self.logs:
+                newest_first = list(reversed(self.logs[key]))
+            else:
+                return None
+        finally:
+            self.release()
+
+        matching = []
+        for entry in newest_first:
+            if entry[1] < level or (grep and not grep.search(entry[3])):
+                continue
+            matching.append(entry)
+            if len(matching) >= count:
+                break
+        return [self.format_entry(entry) for entry in reversed(matching)]
 
 class MatrixModule(BotModule):
 
@@ -27,14 +132,21 @@ class MatrixModule(BotModule):
         super().__init__(name)
         self.starttime = None
         self.can_be_disabled = False
+        self.mem_snapshot = None
+        self.loghandler = None
 
     def matrix_start(self, bot):
         super().matrix_start(bot)
         self.starttime = time.time()
-        self.loghandler = LogDequeHandler(10)
-        self.loghandler.setFormatter(logging.Formatter('%(levelname)s - %(name)s - %(message)s'))
+        self.loghandler = LogRingBuffer()
+        self.loghandler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s'))
         logging.root.addHandler(self.loghandler)
 
+    def matrix_stop(self, bot):
+        super().matrix_stop(bot)
+        if self.loghandler:
+            logging.root.removeHandler(self.loghandler)
+
     async def matrix_message(self, bot, room, event):
         args = event.body.split(None, 2)
 
@@ -59,6 +171,8 @@ class MatrixModule(BotModule):
                 await self.get_ping(bot, room, event)
             elif args[1] == 'rooms':
                 await self.rooms(bot, room, event)
+            elif args[1] == 'mem':
+                await self.memory(bot, room, event)
 
         elif len(args) == 3:
             if args[1] == 'enable':
@@ -73,6 +187,8 @@ class MatrixModule(BotModule):
                 await self.last_logs(bot, room, event, args[2])
             elif args[1] == 'uricache':
                 await self.manage_uri_cache(bot, room, event, args[2])
+            elif args[1] == 'mem':
+                await self.memory(bot, room, event, args[2])
         else:
             pass
 
@@ -121,25 +237,11 @@ class MatrixModule(BotModule):
 
     async def stats(self, bot, room):
         roomcount = len(bot.client.rooms)
-        homeservers = dict()
-        for croomid in bot.client.rooms:
-            try:
-                users = bot.client.rooms[croomid].users
-            except (KeyError, ValueError) as e:
-                self.logger.warning(f"Couldn't get user list in room with id {croomid}, skipping: {repr(e)}")
-                continue
-            for user in users:
-                user, hs = user.split(':', 1)
-                if homeservers.get(hs):
-                    homeservers[hs].add(user)
-                else:
-                    homeservers[hs] = {user}
-        homeservers = {k: len(v) for k, v in homeservers.items()}
-        usercount = sum(homeservers.values())
-        hscount = len(homeservers)
-        homeservers = sorted(homeservers.items(), key=lambda kv: (kv[1], kv[0]), reverse=True)
+        usercount = bot.members.user_count()
+        hscount = len(bot.members.homeserver_users)
+        homeservers = bot.members.homeserver_users.most_common(10)
         homeservers = ', '.join(['{} ({} users, {:.1f}%)'.format(hs[0], hs[1], 100.0 * hs[1] / usercount)
-            for hs in homeservers[:10]])
+            for hs in homeservers])
         await bot.send_text(room, f'I\'m seeing {usercount} users in {roomcount} rooms.'
                 f' Top ten homeservers (out of {hscount}): {homeservers}')
 
@@ -264,27 +366,29 @@ class MatrixModule(BotModule):
             # fallback to current room if we can't create one
             msg_room = room
 
-        try:
-            target, count = target.split()
-            count = -abs(int(count))
-        except ValueError:
-            count = 0
-
-        keys = list(self.loghandler.logs)
-        for key in [target, f'module {target}']:
+        args = target.split()
+        target = args.pop(0)
+        count = 15
+        level = logging.NOTSET
+        if args and args[0].isdigit():
+            count = int(args.pop(0))
+        if args and args[0].lower().startswith('level='):
+            level = logging.getLevelName(args.pop(0)[6:].upper())
+            if not isinstance(level, int):
+                return await bot.send_text(msg_room, 'Unknown log level, use level=debug, level=info, level=warning or level=error')
+        grep = None
+        if args:
             try:
-                logs = list(self.loghandler.logs[key])
-                break
-            except (KeyError, TypeError):
-                pass
-        else:
-            return await bot.send_text(msg_room, f'Unknown module {target}, or no logs yet')
+                grep = re.compile(' '.join(args), re.IGNORECASE)
+            except re.error as e:
+                return await bot.send_text(msg_room, f'Invalid regular expression: {e}')
 
-        if count:
-            logs = logs[count:]
-        logs = '\n'.join([self.loghandler.format(record) for record in logs])
+        logs = self.loghandler.query(None if target in ['all', '*'] else target, count, level, grep)
+        if logs is None:
+            return await bot.send_text(msg_room, f'Unknown module {target}, or no logs yet')
+        logs = '\n'.join(logs)
 
-        return await bot.send_html(msg_room, f'<strong>Logs for {key}:</strong>\n<pre><code class="language-txt">{escape(logs)}</code></pre>', f'Logs for {key}:\n' + logs)
+        return await bot.send_html(msg_room, f'<strong>Logs for {target}:</strong>\n<pre><code class="language-txt">{escape(logs)}</code></pre>', f'Logs for {target}:\n' + logs)
 
     async def manage_uri_cache(self, bot, room, event, action):
         bot.must_be_owner(event)
@@ -299,6 +403,42 @@ class MatrixModule(BotModule):
             bot.uri_cache = dict()
             bot.save_settings()
 
+    async def memory(self, bot, room, event, action=None):
+        bot.must_be_owner(event)
+        if action == 'trace':
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            return await bot.send_text(room, 'Tracing memory allocations. Note: this slows the bot down, use "!bot mem untrace" when done.')
+        if action == 'untrace':
+            tracemalloc.stop()
+            self.mem_snapshot = None
+            return await bot.send_text(room, 'Stopped tracing memory allocations.')
+
+        # The previous snapshot is kept by this module, but isn't state to measure
+        snapshot = MemorySnapshot(bot, exclude=[self.mem_snapshot] if self.mem_snapshot else ())
+        if action == 'snapshot':
+            self.mem_snapshot = snapshot
+            return await bot.send_text(room, 'Memory snapshot taken. Use "!bot mem diff" later to see what changed.')
+        if action == 'diff':
+            if not self.mem_snapshot:
+                return await bot.send_text(room, 'No snapshot yet, use "!bot mem snapshot" first.')
+            lines = snapshot.diff(self.mem_snapshot) or ['No changes']
+            return await bot.send_text(room, 'Memory changes since snapshot:\n' + '\n'.join(lines))
+
+        self.logger.info(f'{event.sender} asked for memory usage')
+        msg = ['Bot: ' + ', '.join([f'{name} {format_size(size)}' for name, size in snapshot.bot.items()])]
+        totals = sorted(snapshot.module_totals().items(), key=lambda kv: kv[1], reverse=True)
+        for modulename, total in totals[:15]:
+            attrs = sorted(snapshot.modules[modulename].items(), key=lambda kv: kv[1], reverse=True)[:3]
+            msg.append(f' - {modulename}: {format_size(total)} (' + ', '.join([f'{attr} {format_size(size)}' for attr, size in attrs]) + ')')
+        if snapshot.traced:
+            current, peak = tracemalloc.get_traced_memory()
+            msg.append(f'Traced: {format_size(current)}, peak {format_size(peak)}')
+            modules_dir = os.path.dirname(os.path.abspath(__file__))
+            for filename, size in sorted(tracemalloc_by_module(snapshot.traced, modules_dir).items(), key=lambda kv: kv[1], reverse=True)[:10]:
+                msg.append(f' - {filename}: {format_size(size)}')
+        await bot.send_text(room, '\n'.join(msg))
+
     async def rooms(self, bot, room, event):
         bot.must_be_owner(event)
         output = f'I\'m in following {len(bot.client.rooms)} rooms:\n'
@@ -311,7 +451,7 @@ class MatrixModule(BotModule):
         raise ModuleCannotBeDisabled
 
     def help(self):
-        return 'Bot management commands. (quit, version, reload, status, stats, leave, modules, enable, disable, import, export, ping)'
+        return 'Bot management commands. (quit, version, reload, status, stats, leave, modules, enable, disable, import, export, ping, mem)'
 
     def long_help(self, bot=None, event=None, **kwargs):
         text = self.help() + (
@@ -323,7 +463,8 @@ class MatrixModule(BotModule):
             text += ('\n- "!bot quit": kill the bot :('
                      '\n- "!bot reload": reload the bot modules'
                      '\n- "!bot uricache (view|clean)": view or clean the bot\'s URI cache'
-                     '\n- "!bot logs [module] ([count])": get [count] most recent logs from [module]'
+                     '\n- "!bot mem (trace|untrace|snapshot|diff)": show memory used by the bot and modules'
+                     '\n- "!bot logs [module|all] ([count]) (level=[level]) ([regex])": get [count] most recent logs from [module], optionally only of [level] or higher and matching [regex]'
                      '\n- "!bot enable [module]": enable a module'
                      '\n- "!bot disable [module]": disable a module'
                      '\n- "!bot import ([module]) [json]": import settings into the bot'
@@ -0,0 +1,172 @@
+import asyncio
+import collections
+import time
+from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
+
+from nio import ErrorResponse
+
+
+async def send_once(client, response_class, method, path, data=None):
+    """
+    Send a request made with nio.Api, like nio's AsyncClient methods do, but
+    return rate limit errors instead of retrying. nio retries them
+    internally however long the server asks to wait, so a BulkJob couldn't
+    pause all of its workers.
+    """
+    parts = urlsplit(path)
+    query = parse_qs(parts.query)
+    query.pop('access_token', None)
+    path = urlunsplit(parts._replace(query=urlencode(query, doseq=True)))
+    headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {client.access_token}'}
+    transport_response = await client.send(method, path, data, headers)
+    return await client.create_matrix_response(response_class, transport_response)
+
+
+class BulkJob:
+    """Runs an action against many targets, like kicking a spam wave of users
+
+    Actions run with bounded concurrency. When the server rate limits a
+    request, all workers pause for the retry-after time and the target is
+    retried. Progress is shown in a single message that is edited in place,
+    and the same message is finally edited to a summary.
+
+    action is a coroutine function taking a target and returning a nio
+    response. It should send with send_once(), so that rate limits reach
+    the job. In dry run mode nothing is done, the summary just lists the
+    targets.
+    """
+
+    concurrency = 5
+    max_retries = 5
+    progress_interval = 3  # seconds between progress edits
+    default_retry_after = 5  # seconds, when the server doesn't say
+    listed_failures = 10
+
+    def __init__(self, bot, room, verb, targets, action, logger, dry_run=False, cancel_command=None):
+        self.bot = bot
+        self.room = room
+        self.verb = verb  # e.g. 'Kicking'
+        self.targets = list(targets)
+        self.action = action
+        self.dry_run = dry_run
+        self.cancel_command = cancel_command  # shown in progress message
+        self.done = 0
+        self.failed = dict()  # target -> error message
+        self.rate_limited = 0
+        self.resume_at = 0  # monotonic time when rate limit pause ends
+        self.progress_event_id = None
+        self.last_progress = 0
+        self.cancelled = False
+        self.task = None
+        self.logger = logger  # of the module running the job
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    def cancel(self):
+        self.cancelled = True
+        if self.task:
+            self.task.cancel()
+
+    async def run(self):
+        started = time.monotonic()
+        if self.dry_run:
+            await self.send_progress(f'Dry run: would be {self.verb.lower()} {len(self.targets)} users: {" ".join(self.targets)}')
+            return
+
+        queue = collections.deque(self.targets)
+        workers = []
+        try:
+            await self.send_progress(self.progress_text())
+            workers = [asyncio.create_task(self.worker(queue)) for _ in range(min(self.concurrency, len(queue)))]
+            await asyncio.gather(*workers)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        finally:
+            summary = self.summary_text(time.monotonic() - started)
+            self.logger.info(f'{self.room.room_id}: {summary}')
+            # Shield so that the summary gets sent even when cancelled
+            await asyncio.shield(self.send_progress(summary))
+
+    async def worker(self, queue):
+        while queue:
+            target = queue.popleft()
+            for attempt in range(self.max_retries + 1):
+                await self.wait_rate_limit()
+                try:
+                    response = await self.action(target)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.failed[target] = repr(e)
+                    break
+                if isinstance(response, ErrorResponse):
+                    if response.status_code == 'M_LIMIT_EXCEEDED' and attempt < self.max_retries:
+                        self.rate_limited += 1
+                        retry_after = (response.retry_after_ms or self.default_retry_after * 1000) / 1000
+                        self.resume_at = max(self.resume_at, time.monotonic() + retry_after)
+                        continue
+                    self.failed[target] = response.message or str(response.status_code)
+                else:
+                    self.done += 1
+                break
+            await self.maybe_send_progress()
+
+    async def wait_rate_limit(self):
+        delay = self.resume_at - time.monotonic()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.resume_at - time.monotonic()
+
+    def progress_text(self):
+        text = f'{self.verb} {len(self.targets)} users: {self.done} done, {len(self.failed)} failed'
+        if self.resume_at > time.monotonic():
+            text += ' (rate limited, waiting)'
+        if self.cancel_command:
+            text += f'. Stop with {self.cancel_command}'
+        return text + '.'
+
+    def summary_text(self, elapsed):
+        remaining = len(self.targets) - self.done - len(self.failed)
+        text = f'{self.verb} {"cancelled" if self.cancelled else "finished"} in {elapsed:.1f}s: ' \
+            f'{self.done} done, {len(self.failed)} failed'
+        if remaining:
+            text += f', {remaining} not processed'
+        if self.rate_limited:
+            text += f', rate limited {self.rate_limited} times'
+        if self.failed:
+            failures = list(self.failed.items())[:self.listed_failures]
+            text += '. Failed: ' + ', '.join(f'{target} ({error})' for target, error in failures)
+            if len(self.failed) > self.listed_failures:
+                text += f' and {len(self.failed) - self.listed_failures} more'
+        return text + '.'
+
+    async def maybe_send_progress(self):
+        now = time.monotonic()
+        if now - self.last_progress >= self.progress_interval:
+            self.last_progress = now
+            await self.send_progress(self.progress_text())
+
+    async def send_progress(self, body):
+        if not self.progress_event_id:
+            response = await self.bot.send_text(self.room, body)
+            self.progress_event_id = getattr(response, 'event_id', None)
+            self.last_progress = time.monotonic()
+            return
+        content = {
+            'm.new_content': {
+                'msgtype': 'm.notice',
+                'body': body
+            },
+            'm.relates_to': {
+                'rel_type': 'm.replace',
+                'event_id': self.progress_event_id
+            },
+            'msgtype': 'm.notice',
+            'body': body
+        }
+        await self.bot.client.room_send(self.room.room_id, 'm.room.message', content)
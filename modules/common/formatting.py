@@ -0,0 +1,8 @@
+def format_size(size, sign=False):
+    """Human readable size, with an explicit + or - sign if sign is set (for differences)"""
+    sign = '+' if sign else ''
+    for unit in ['B', 'KiB', 'MiB']:
+        if abs(size) < 1024:
+            return f'{size:{sign}.0f} {unit}' if unit == 'B' else f'{size:{sign}.1f} {unit}'
+        size /= 1024
+    return f'{size:{sign}.1f} GiB'
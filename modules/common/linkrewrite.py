@@ -0,0 +1,71 @@
+import re
+
+from modules.common.urlpreview import domain_suffixes
+
+
+class RewriteRule:
+    """Rewrites links to source domains (and their subdomains) to an alternative frontend at target"""
+
+    def __init__(self, name, domains, target, keep_query=False):
+        self.name = name
+        self.domains = [domain.lower() for domain in domains]
+        self.target = target
+        self.keep_query = keep_query  # e.g. youtube needs ?v=
+
+    def rewrite(self, path, query):
+        return f'https://{self.target}{path}{query if self.keep_query else ""}'
+
+    def to_json(self):
+        return {'domains': self.domains, 'target': self.target, 'keep_query': self.keep_query}
+
+    @classmethod
+    def from_json(cls, name, data):
+        return cls(name, data['domains'], data['target'], data.get('keep_query', False))
+
+    def __str__(self):
+        return f'{self.name}: {", ".join(self.domains)} -> {self.target}' + (' (keeps query)' if self.keep_query else '')
+
+
+class LinkRewriter:
+    """Finds and rewrites links of all rules in one scan
+
+    The domains of all rules are compiled to one regex, so a message is
+    scanned once however many rules there are. The host of each match is
+    looked up by its domain suffixes to find the rule.
+    """
+
+    def __init__(self, rules):
+        self.rules = {rule.name: rule for rule in rules}
+        self.domain_rules = dict()  # domain -> rule
+        self.regex = None
+        self.compile()
+
+    def compile(self):
+        self.domain_rules = {domain: rule for rule in self.rules.values() for domain in rule.domains}
+        if not self.domain_rules:
+            self.regex = None
+            return
+        # Longest first, so that a domain doesn't shadow a longer one it is a prefix of
+        domains = '|'.join(map(re.escape, sorted(self.domain_rules, key=len, reverse=True)))
+        self.regex = re.compile(
+            r'https?://(?P<host>(?:[\w-]+\.)*(?:' + domains + r'))(?![\w.-])(?::\d+)?'
+            r'(?P<path>/[^\s?#]*)?(?P<query>\?[^\s#]*)?',
+            re.IGNORECASE)
+
+    def rule_for_host(self, host):
+        for suffix in domain_suffixes(host):
+            rule = self.domain_rules.get(suffix)
+            if rule:
+                return rule
+        return None
+
+    def rewrite(self, text, enabled):
+        """Return rewritten links found in text, for rules whose name is in enabled"""
+        if self.regex is None:
+            return []
+        links = []
+        for m in self.regex.finditer(text):
+            rule = self.rule_for_host(m.group('host'))
+            if rule and rule.name in enabled:
+                links.append(rule.rewrite(m.group('path') or '', m.group('query') or ''))
+        return list(dict.fromkeys(links))
@@ -0,0 +1,43 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger('hemppa')
+
+# Local files that are too big or change too often for account data live here.
+# It is a volume in docker-compose.yml, so the files survive container restarts.
+STORE_DIR = 'config'
+
+
+def store_path(name):
+    return os.path.join(STORE_DIR, name)
+
+
+def load_json(name, default=None):
+    """Load json data saved with save_json, or default if there is none"""
+    path = store_path(name)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as e:
+        logger.warning(f'Could not load {path}: {e}')
+        return default
+
+
+def save_json(name, data):
+    """Save json data atomically, so that a crash can't leave a half written file"""
+    path = store_path(name)
+    if not os.path.isdir(STORE_DIR):
+        logger.debug(f'Not saving {path}, {STORE_DIR} does not exist')
+        return False
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+    except (OSError, TypeError, ValueError) as e:
+        logger.warning(f'Could not save {path}: {e}')
+        return False
+    return True
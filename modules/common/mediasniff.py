@@ -0,0 +1,414 @@
+import html
+import re
+import struct
+import urllib.parse
+
+from modules.common.formatting import format_size
+
+SNIFF_BYTES = 64 * 1024  # read from the start of a file
+TAIL_BYTES = 16 * 1024  # read from the end of a pdf, where the trailer is
+SEEK_BYTES = 4096  # read at an offset for a single pdf object, mp4 box or jpeg segment
+MAX_SEEKS = 4
+
+TEXT_TYPE_RE = re.compile(r'html|xml|json|javascript')
+
+PDF_XMP_TITLE_RE = re.compile(rb'<dc:title>.*?<rdf:li[^>]*>(.*?)</rdf:li>', re.DOTALL)
+PDF_INFO_RE = re.compile(rb'/Info\s+(\d+)\s+(\d+)\s+R')
+PDF_TITLE_RE = re.compile(rb'/Title\s*([(<])')
+PDF_XREF_SECTION_RE = re.compile(rb'\s*(\d+)\s+(\d+)\s*?\r?\n')
+PDF_ESCAPES = {ord('n'): b'\n', ord('r'): b'\r', ord('t'): b'\t', ord('b'): b'\b', ord('f'): b'\f'}
+
+JPEG_SOF_MARKERS = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+
+MP3_BITRATES = {
+    3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],  # MPEG 1
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],  # MPEG 2
+    0: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],  # MPEG 2.5
+}
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+ID3_TEXT_ENCODINGS = ['latin-1', 'utf-16', 'utf-16-be', 'utf-8']
+ID3_FRAMES = {b'TIT2': 'title', b'TT2': 'title', b'TPE1': 'artist', b'TP1': 'artist'}  # v2.3 and v2.2 ids
+
+
+def is_file_type(content_type):
+    """Whether content is a file to describe, rather than a page to parse for a title"""
+    if content_type.startswith(('image/', 'audio/', 'video/', 'font/', 'application/')):
+        return not TEXT_TYPE_RE.search(content_type)
+    return False
+
+
+def total_size(headers):
+    """Size of the whole file from Content-Range or Content-Length, or None"""
+    content_range = headers.get('content-range', '')
+    if '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        return int(total) if total.isdigit() else None
+    length = headers.get('content-length', '')
+    if length.isdigit() and 'content-encoding' not in headers:
+        return int(length)
+    return None
+
+
+def file_name(url, headers):
+    """File name from Content-Disposition, or the last part of the url path"""
+    disposition = headers.get('content-disposition', '')
+    m = re.search(r'filename\s*=\s*"?([^";]+)', disposition)
+    if m:
+        return m.group(1).strip()
+    parts = urllib.parse.urlsplit(url)
+    return urllib.parse.unquote(parts.path.rstrip('/').rsplit('/', 1)[-1]) or parts.hostname
+
+
+async def read_prefix(response, max_bytes):
+    """Read up to max_bytes from the start of a streamed response"""
+    data = bytearray()
+    async for chunk in response.aiter_bytes():
+        data.extend(chunk)
+        if len(data) >= max_bytes:
+            break
+    return bytes(data[:max_bytes])
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f'{hours}:{minutes:02}:{seconds:02}' if hours else f'{minutes}:{seconds:02}'
+
+
+def image_size(data):
+    """(format, width, height) of a PNG, GIF, WebP or BMP image, or None"""
+    try:
+        if data.startswith(b'\x89PNG\r\n\x1a\n') and data[12:16] == b'IHDR':
+            return ('PNG',) + struct.unpack('>II', data[16:24])
+        if data[:6] in (b'GIF87a', b'GIF89a'):
+            return ('GIF',) + struct.unpack('<HH', data[6:10])
+        if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+            chunk = data[12:16]
+            if chunk == b'VP8 ' and data[23:26] == b'\x9d\x01\x2a':
+                width, height = struct.unpack('<HH', data[26:30])
+                return 'WebP', width & 0x3fff, height & 0x3fff
+            if chunk == b'VP8L' and data[20] == 0x2f:
+                bits = struct.unpack('<I', data[21:25])[0]
+                return 'WebP', (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+            if chunk == b'VP8X' and len(data) >= 30:
+                return 'WebP', int.from_bytes(data[24:27], 'little') + 1, int.from_bytes(data[27:30], 'little') + 1
+        if data[:2] == b'BM':
+            width, height = struct.unpack('<ii', data[18:26])
+            if width > 0 and height != 0:  # negative height means top-down rows
+                return 'BMP', width, abs(height)
+    except (struct.error, IndexError):
+        pass
+    return None
+
+
+def jpeg_scan(data, base):
+    """
+    Walk jpeg segments in data, read from file offset base, to the frame header.
+    Returns ((width, height), None), or (None, offset) of a segment that
+    isn't in data, or (None, None) if there are no dimensions to find.
+    """
+    pos = 2 if base == 0 else 0
+    while pos + 4 <= len(data):
+        if data[pos] != 0xff:
+            return None, None
+        marker = data[pos + 1]
+        if marker == 0xff:  # fill byte
+            pos += 1
+            continue
+        if marker == 0x01 or 0xd0 <= marker <= 0xd8:  # markers without a length
+            pos += 2
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            if pos + 9 > len(data):
+                break
+            height, width = struct.unpack('>HH', data[pos + 5:pos + 9])
+            return (width, height), None
+        if marker == 0xda:  # image data starts, there was no frame header
+            return None, None
+        pos += 2 + struct.unpack('>H', data[pos + 2:pos + 4])[0]
+    return None, base + pos
+
+
+def mp4_scan(data, base):
+    """
+    Walk mp4 boxes in data, read from file offset base, to the movie header.
+    Returns (duration in seconds, None), or (None, offset) of a top level box
+    that isn't in data, or (None, None) if there is no duration to find.
+    """
+    pos = 0
+    while pos + 8 <= len(data):
+        size, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        header = 8
+        if size == 1:
+            if pos + 16 > len(data):
+                break
+            size = struct.unpack('>Q', data[pos + 8:pos + 16])[0]
+            header = 16
+        if kind == b'moov':
+            return mvhd_duration(data, pos + header, pos + size if size else len(data)), None
+        if size < header:  # 0 means the box extends to the end of the file
+            return None, None
+        pos += size
+    return None, base + pos
+
+
+def mvhd_duration(data, pos, end):
+    end = min(end, len(data))
+    while pos + 8 <= end:
+        size, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        if kind == b'mvhd':
+            body = data[pos + 8:pos + size]
+            try:
+                if body[0] == 1:
+                    timescale, duration = struct.unpack('>IQ', body[20:32])
+                else:
+                    timescale, duration = struct.unpack('>II', body[12:20])
+            except (struct.error, IndexError):
+                return None
+            return duration / timescale if timescale else None
+        if size < 8:
+            return None
+        pos += size
+    return None
+
+
+async def seek_scan(scanner, data, size, read_range):
+    """Run a jpeg_scan or mp4_scan like scanner, reading parts of the file it asks for"""
+    base = 0
+    for _ in range(MAX_SEEKS + 1):
+        result, offset = scanner(data, base)
+        if result is not None or offset is None or offset <= base or (size is not None and offset >= size):
+            return result
+        data = await read_range(offset, SEEK_BYTES)
+        if not data:
+            return None
+        base = offset
+    return None
+
+
+def synchsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def id3_tag(data):
+    """
+    Read an ID3v2 tag at the start of data.
+    Returns (title, total size of the tag), title is "artist - title" if there is an artist.
+    """
+    if data[:3] != b'ID3' or len(data) < 10:
+        return None, 0
+    major, flags = data[3], data[5]
+    tag_size = synchsafe(data[6:10]) + 10 + (10 if flags & 0x10 else 0)
+    pos = 10
+    if flags & 0x40 and major >= 3:  # extended header
+        if len(data) < 14:
+            return None, tag_size
+        ext_size = synchsafe(data[10:14]) if major == 4 else struct.unpack('>I', data[10:14])[0] + 4
+        pos += ext_size
+    id_len, header_len = (3, 6) if major == 2 else (4, 10)
+    frames = dict()
+    end = min(tag_size, len(data))
+    while pos + header_len <= end:
+        frame_id = data[pos:pos + id_len]
+        if not frame_id.strip(b'\0'):
+            break  # padding
+        size_bytes = data[pos + id_len:pos + id_len + (3 if major == 2 else 4)]
+        if major == 2:
+            size = int.from_bytes(size_bytes, 'big')
+        elif major == 4:
+            size = synchsafe(size_bytes)
+        else:
+            size = struct.unpack('>I', size_bytes)[0]
+        if pos + header_len + size > len(data):
+            break  # rest of the tag wasn't read
+        body = data[pos + header_len:pos + header_len + size]
+        if frame_id in ID3_FRAMES and body and body[0] < len(ID3_TEXT_ENCODINGS):
+            text = body[1:].decode(ID3_TEXT_ENCODINGS[body[0]], errors='replace')
+            frames[ID3_FRAMES[frame_id]] = text.split('\0')[0].strip()
+        pos += header_len + size
+    title = frames.get('title')
+    if title and frames.get('artist'):
+        title = f'{frames["artist"]} - {title}'
+    return title or None, tag_size
+
+
+def mp3_duration(data, base, size):
+    """Duration of mp3 audio from the first frame at data, read from file offset base"""
+    if len(data) < 4:
+        return None
+    header = struct.unpack('>I', data[:4])[0]
+    if header >> 21 != 0x7ff or (header >> 17) & 3 != 1:  # frame sync and layer III
+        return None
+    version = (header >> 19) & 3
+    bitrate_index = (header >> 12) & 15
+    sample_rate_index = (header >> 10) & 3
+    if version not in MP3_BITRATES or sample_rate_index == 3 or bitrate_index in (0, 15):
+        return None
+    sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+    samples_per_frame = 1152 if version == 3 else 576
+    mono = (header >> 6) & 3 == 3
+    # Variable bitrate files have the frame count in a Xing or VBRI header in the first frame
+    xing = 4 + (32 if version == 3 and not mono else 17 if version == 3 or not mono else 9)
+    if data[xing:xing + 4] in (b'Xing', b'Info') and len(data) >= xing + 12:
+        if struct.unpack('>I', data[xing + 4:xing + 8])[0] & 1:
+            return struct.unpack('>I', data[xing + 8:xing + 12])[0] * samples_per_frame / sample_rate
+    if data[36:40] == b'VBRI' and len(data) >= 54:
+        return struct.unpack('>I', data[50:54])[0] * samples_per_frame / sample_rate
+    if size is None:
+        return None
+    return (size - base) * 8 / (MP3_BITRATES[version][bitrate_index] * 1000)
+
+
+def pdf_string(data, pos):
+    """Decode the pdf string object starting at data[pos], which is ( or <"""
+    if data[pos:pos + 1] == b'<':
+        end = data.find(b'>', pos)
+        if end < 0:
+            return None
+        raw = re.sub(rb'\s', b'', data[pos + 1:end])
+        try:
+            raw = bytes.fromhex((raw + b'0' * (len(raw) % 2)).decode('ascii'))
+        except ValueError:
+            return None
+    else:
+        raw = bytearray()
+        depth = 0
+        i = pos + 1
+        while i < len(data):
+            c = data[i]
+            if c == 0x5c:  # backslash
+                i += 1
+                if i >= len(data):
+                    break
+                c = data[i]
+                octal = re.match(rb'[0-7]{1,3}', data[i:i + 3])
+                if octal:
+                    raw.append(int(octal.group(0), 8) & 0xff)
+                    i += len(octal.group(0))
+                    continue
+                if c not in (0x0a, 0x0d):  # escaped newline continues the line
+                    raw += PDF_ESCAPES.get(c, bytes([c]))
+            elif c == 0x28:  # (
+                depth += 1
+                raw.append(c)
+            elif c == 0x29:  # )
+                if depth == 0:
+                    break
+                depth -= 1
+                raw.append(c)
+            else:
+                raw.append(c)
+            i += 1
+        raw = bytes(raw)
+    if raw.startswith(b'\xfe\xff'):
+        return raw[2:].decode('utf-16-be', errors='replace')
+    if raw.startswith(b'\xef\xbb\xbf'):
+        return raw[3:].decode('utf-8', errors='replace')
+    return raw.decode('latin-1')
+
+
+def pdf_object(data, num, gen):
+    """Body of the last definition of an indirect object in data, or None"""
+    body = None
+    for m in re.finditer(rb'(?<!\d)%d\s+%d\s+obj\b(.*?)endobj' % (num, gen), data, re.DOTALL):
+        body = m.group(1)
+    return body
+
+
+def pdf_xref_offset(data, num):
+    """File offset of object num from the classic xref tables in data, or None"""
+    for xref in reversed([m.end() for m in re.finditer(rb'(?<!start)xref', data)]):
+        pos = xref
+        while True:
+            m = PDF_XREF_SECTION_RE.match(data, pos)
+            if not m:
+                break
+            start, count = int(m.group(1)), int(m.group(2))
+            if start <= num < start + count:
+                entry = data[m.end() + 20 * (num - start):m.end() + 20 * (num - start) + 18].split()
+                if len(entry) == 3 and entry[2] == b'n':
+                    return int(entry[0])
+                break
+            pos = m.end() + 20 * count
+    return None
+
+
+def pdf_info_title(body):
+    m = PDF_TITLE_RE.search(body) if body else None
+    return pdf_string(body, m.start(1)) if m else None
+
+
+def pdf_xmp_title(data):
+    m = PDF_XMP_TITLE_RE.search(data)
+    if m:
+        return html.unescape(m.group(1).decode('utf-8', errors='replace'))
+    return None
+
+
+async def pdf_title(data, size, read_range):
+    """Title of a pdf from its XMP metadata, or from the Info dictionary the trailer points to"""
+    title = pdf_xmp_title(data)
+    if title:
+        return title
+    tail = data
+    if size is not None and size > len(data):
+        tail = await read_range(max(0, size - TAIL_BYTES), TAIL_BYTES) or b''
+    refs = PDF_INFO_RE.findall(tail) or PDF_INFO_RE.findall(data)
+    if not refs:
+        return None
+    num, gen = map(int, refs[-1])
+    body = pdf_object(tail, num, gen) or pdf_object(data, num, gen)
+    if body is None:
+        offset = pdf_xref_offset(tail, num)
+        if offset is not None:
+            body = pdf_object(await read_range(offset, SEEK_BYTES) or b'', num, gen)
+    return pdf_info_title(body)
+
+
+async def describe_file(name, content_type, data, size, read_range):
+    """
+    Describe a file from its first bytes, like "cat.png (PNG image, 800x600, 120.0 KiB)".
+
+    Formats that keep their metadata further in the file read the parts they
+    need with read_range(start, length), which returns the bytes or None.
+
+    :param name: file name, used if the file has no title of its own
+    :param content_type: media type from the Content-Type header
+    :param data: first bytes of the file
+    :param size: size of the file, or None if not known
+    """
+    title = None
+    details = []
+    image = image_size(data)
+    if image:
+        details += [f'{image[0]} image', f'{image[1]}x{image[2]}']
+    elif data[:2] == b'\xff\xd8':
+        details.append('JPEG image')
+        dimensions = await seek_scan(jpeg_scan, data, size, read_range)
+        if dimensions:
+            details.append(f'{dimensions[0]}x{dimensions[1]}')
+    elif data.startswith(b'%PDF-'):
+        details.append('PDF document')
+        title = await pdf_title(data, size, read_range)
+    elif data[4:8] == b'ftyp' or content_type in ('video/mp4', 'video/quicktime', 'audio/mp4', 'audio/x-m4a'):
+        details.append('MP4 audio' if content_type.startswith('audio/') else 'MP4 video')
+        duration = await seek_scan(mp4_scan, data, size, read_range)
+        if duration:
+            details.append(format_duration(duration))
+    elif content_type == 'audio/mpeg' or data[:3] == b'ID3':
+        details.append('MP3 audio')
+        title, tag_size = id3_tag(data)
+        frame = data[tag_size:tag_size + SEEK_BYTES]
+        if len(frame) < 4 and (size is None or tag_size < size):
+            # Large tags with cover art don't fit in data
+            frame = await read_range(tag_size, SEEK_BYTES) or b''
+        duration = mp3_duration(frame, tag_size, size)
+        if duration:
+            details.append(format_duration(duration))
+    else:
+        details.append(content_type or 'file')
+    if size is not None:
+        details.append(format_size(size))
+    return f'{title or name} ({", ".join(details)})'
@@ -0,0 +1,86 @@
+import collections
+
+
+class MembershipIndex:
+    """Index of room members seen by the bot
+
+    Kept up to date incrementally from membership events, so that user, room and
+    homeserver statistics don't need to walk every member of every room.
+
+    Members are users with join or invite membership, like MatrixRoom.users.
+    """
+
+    def __init__(self):
+        self.user_rooms = dict()  # mxid -> set of room id's
+        self.room_members = dict()  # room id -> set of mxid's
+        self.homeserver_users = collections.Counter()  # homeserver -> number of distinct users
+
+    @staticmethod
+    def homeserver(mxid):
+        return mxid.split(':', 1)[1] if ':' in mxid else ''
+
+    def add(self, room_id, mxid):
+        members = self.room_members.setdefault(room_id, set())
+        if mxid in members:
+            return
+        members.add(mxid)
+        rooms = self.user_rooms.get(mxid)
+        if rooms is None:
+            rooms = self.user_rooms[mxid] = set()
+            self.homeserver_users[self.homeserver(mxid)] += 1
+        rooms.add(room_id)
+
+    def remove(self, room_id, mxid):
+        members = self.room_members.get(room_id)
+        if not members or mxid not in members:
+            return
+        members.discard(mxid)
+        rooms = self.user_rooms[mxid]
+        rooms.discard(room_id)
+        if not rooms:
+            del self.user_rooms[mxid]
+            hs = self.homeserver(mxid)
+            self.homeserver_users[hs] -= 1
+            if not self.homeserver_users[hs]:
+                del self.homeserver_users[hs]
+
+    def update(self, room_id, mxid, membership):
+        """Apply a membership change (join, invite, leave, ban..)"""
+        if membership in ('join', 'invite'):
+            self.add(room_id, mxid)
+        else:
+            self.remove(room_id, mxid)
+
+    def sync_room(self, room_id, users):
+        """Make room members match users, a collection of mxid's"""
+        current = self.room_members.get(room_id, set())
+        users = set(users)
+        for mxid in current - users:
+            self.remove(room_id, mxid)
+        for mxid in users - current:
+            self.add(room_id, mxid)
+
+    def remove_room(self, room_id):
+        for mxid in list(self.room_members.get(room_id, ())):
+            self.remove(room_id, mxid)
+        self.room_members.pop(room_id, None)
+
+    def rebuild(self, rooms):
+        """Rebuild whole index from dict of room id -> MatrixRoom"""
+        self.user_rooms = dict()
+        self.room_members = dict()
+        self.homeserver_users = collections.Counter()
+        for room_id, room in rooms.items():
+            self.sync_room(room_id, room.users)
+
+    def users(self, room_id=None):
+        """Return mxid's of all users, or members of given room"""
+        if room_id:
+            return list(self.room_members.get(room_id, ()))
+        return list(self.user_rooms)
+
+    def user_count(self):
+        return len(self.user_rooms)
+
+    def member_count(self, room_id):
+        return len(self.room_members.get(room_id, ()))
@@ -0,0 +1,132 @@
+import logging
+from collections import deque
+import os
+import sys
+import tracemalloc
+from types import BuiltinFunctionType, FunctionType, MethodType, ModuleType
+
+from modules.common.formatting import format_size
+
+# Objects of these types are not followed when measuring deep sizes. They are
+# shared by everything (code, loggers) and would only add noise.
+OPAQUE_TYPES = (type, ModuleType, FunctionType, BuiltinFunctionType, MethodType, logging.Logger, tracemalloc.Snapshot)
+
+
+def deep_getsizeof(obj, exclude=None):
+    """Return approximate size of obj and everything reachable from it in bytes
+
+    :param obj: object to measure
+    :param exclude: set of object id's that must not be followed (bot, client, ..)
+    :return: size in bytes
+    """
+    seen = set(exclude or ())
+    size = 0
+    stack = [obj]
+    while stack:
+        current = stack.pop()
+        if id(current) in seen or isinstance(current, OPAQUE_TYPES):
+            continue
+        seen.add(id(current))
+        try:
+            size += sys.getsizeof(current)
+        except TypeError:
+            continue
+
+        if isinstance(current, (str, bytes, bytearray, int, float, bool)) or current is None:
+            continue
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+            continue
+        if isinstance(current, (list, tuple, set, frozenset, deque)):
+            stack.extend(current)
+            continue
+        if hasattr(current, '__dict__'):
+            stack.append(vars(current))
+        for slot in getattr(type(current), '__slots__', ()):
+            if hasattr(current, slot):
+                stack.append(getattr(current, slot))
+    return size
+
+
+def module_footprints(bot, exclude=()):
+    """Measure deep size of every attribute of every loaded module
+
+    References to the bot, its client and other modules are not followed, so
+    each attribute is only accounted for state it owns.
+
+    :param exclude: objects that must not be measured, like earlier snapshots
+    :return: dict modulename -> dict attribute -> bytes
+    """
+    exclude = {id(bot), id(bot.client), id(bot.modules)} | {id(obj) for obj in exclude}
+    exclude.update(id(module) for module in bot.modules.values())
+    footprints = dict()
+    for modulename, moduleobject in bot.modules.items():
+        if moduleobject is None:
+            continue
+        footprints[modulename] = {attr: deep_getsizeof(value, exclude) for attr, value in vars(moduleobject).items()
+                                  if id(value) not in exclude}
+    return footprints
+
+
+def bot_footprints(bot, exclude=()):
+    """Measure the state kept by the bot itself
+
+    :param exclude: objects that must not be measured, like earlier snapshots
+    :return: dict name -> bytes
+    """
+    exclude = {id(bot), id(bot.modules)} | {id(obj) for obj in exclude}
+    exclude.update(id(module) for module in bot.modules.values())
+    return {
+        'uri_cache': deep_getsizeof(bot.uri_cache, exclude),
+        'rooms': deep_getsizeof(bot.client.rooms, exclude),
+        'members': deep_getsizeof(bot.members, exclude),
+    }
+
+
+def tracemalloc_by_module(snapshot, modules_dir):
+    """Sum traced memory per file in the modules directory
+
+    :param snapshot: tracemalloc.Snapshot
+    :param modules_dir: absolute path of the modules directory
+    :return: dict filename (relative to modules_dir) -> bytes
+    """
+    sizes = dict()
+    prefix = os.path.join(modules_dir, '')
+    for stat in snapshot.statistics('filename'):
+        filename = stat.traceback[0].filename
+        if filename.startswith(prefix):
+            sizes[os.path.relpath(filename, modules_dir)] = stat.size
+    return sizes
+
+
+class MemorySnapshot:
+    """Deep sizes of bot and module state, plus tracemalloc snapshot if tracing"""
+
+    def __init__(self, bot, exclude=()):
+        self.modules = module_footprints(bot, exclude)
+        self.bot = bot_footprints(bot, exclude)
+        self.traced = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+
+    def module_totals(self):
+        return {name: sum(attrs.values()) for name, attrs in self.modules.items()}
+
+    def diff(self, older, limit=10):
+        """Return lines describing what grew or shrank since older snapshot"""
+        lines = []
+        for name, size in self.bot.items():
+            delta = size - older.bot.get(name, 0)
+            if delta:
+                lines.append((abs(delta), f'bot.{name}: {format_size(delta, sign=True)}'))
+        for modulename, attrs in self.modules.items():
+            for attr, size in attrs.items():
+                delta = size - older.modules.get(modulename, {}).get(attr, 0)
+                if delta:
+                    lines.append((abs(delta), f'{modulename}.{attr}: {format_size(delta, sign=True)}'))
+        lines = [line for _, line in sorted(lines, reverse=True)[:limit]]
+
+        if self.traced and older.traced:
+            lines.append('Traced allocations:')
+            for stat in self.traced.compare_to(older.traced, 'filename')[:limit]:
+                lines.append(f'{stat.traceback[0].filename}: {format_size(stat.size_diff, sign=True)} ({stat.count_diff:+d} blocks)')
+        return lines
@@ -1,60 +1,335 @@
-from datetime import datetime, timedelta
-from random import randrange
+import asyncio
+import collections
+import heapq
+import time
+from random import uniform
 
+import httpx
+
+from modules.common.localstore import load_json, save_json
 from modules.common.module import BotModule
+from modules.common.seenids import SeenIds
+
+
+class NotModified(Exception):
+    """Raised by fetch_conditional when the server says the data hasn't changed"""
 
 
 class PollingService(BotModule):
+    """
+    Base for modules that poll accounts (feeds, urls, ..) and post to rooms.
+
+    Subscriptions are grouped by account: an account added to many rooms is
+    fetched once per interval with fetch_account, and the data is passed to
+    poll_implementation for each of the rooms. Accounts that are due are
+    polled concurrently, max_concurrent_polls at a time, in a background
+    task so that slow accounts don't hold up other modules.
+
+    Subclasses implement fetch_account (if the fetched data is the same for
+    all rooms) and poll_implementation, or override process_account if the
+    data isn't handled per room.
+
+    fetch_conditional sends the ETag and Last-Modified validators of the
+    previous response, and raises NotModified on 304 (or an identical
+    response) so that nothing is processed for an unchanged account.
+
+    Each account has its own poll interval. It grows by backoff after every
+    poll where the account hasn't changed, up to interval_max, and drops back
+    to interval_min when it changes. After too many failures in a row the
+    account is polled only every circuit_break minutes until it works again.
+    Deadlines, with random jitter added, are kept in a heap so that finding
+    the due accounts doesn't depend on the number of accounts.
+
+    The defaults come from the attributes below. They can be changed for the
+    module with the "polling" setting and per account with "account_polling",
+    e.g. {"polling": {"interval_max": 720, "max_concurrent": 8}, "account_polling": {"account": {"interval_min": 5}}}
+    """
+
+    max_concurrent_polls = 4
+    http_timeout = 30  # seconds
+    seen_ids_save_interval = 300  # seconds
+    poll_interval_max = None  # minutes, None = 8 * poll_interval_min
+    poll_backoff = 2  # interval multiplier while an account doesn't change
+    poll_failure_limit = 5  # failures in a row before the circuit breaks
+    poll_circuit_break = 360  # minutes between polls of a broken account
+    # Setting name -> attribute with its default
+    POLL_SETTINGS = {
+        'interval_min': 'poll_interval_min',
+        'interval_random': 'poll_interval_random',
+        'interval_max': 'poll_interval_max',
+        'backoff': 'poll_backoff',
+        'failure_limit': 'poll_failure_limit',
+        'circuit_break': 'poll_circuit_break',
+        'max_concurrent': 'max_concurrent_polls',  # module wide only
+    }
+
     def __init__(self, name):
         super().__init__(name)
-        self.known_ids = set()
+        self.seen_ids = SeenIds()  # Item ids seen per account, see new_items
+        self.seen_ids_saved = time.monotonic()
         self.account_rooms = dict()  # Roomid -> [account, account..]
-        self.next_poll_time = dict()  # Roomid -> datetime, None = not polled yet
+        self.subscribers = dict()  # Account -> [roomid, roomid..]
+        self.poll_state = dict()  # Account -> {'deadline': monotonic time, 'interval': minutes, 'failures': n}
+        self.deadlines = []  # heap of (deadline, account), entries not matching poll_state are stale
+        self.synced = set()  # (account, roomid) pairs polled since start
+        self.fetched = set()  # (account, roomid) pairs that have been processed with full data
+        self.polling = dict()  # Setting name -> value, overriding the defaults
+        self.account_polling = dict()  # Account -> {setting name: value}
         self.service_name = "Service"
-        self.poll_interval_min = 30  # TODO: Configurable
-        self.poll_interval_random = 30
+        self.poll_interval_min = 30  # minutes
+        self.poll_interval_random = 30  # minutes of jitter at most
         self.owner_only = False # Set to true if service can be run only by bot owner
         self.send_all = False # Set to true to send all received items, even on first sync
+        self.poll_task = None
+        self.client = None  # httpx.AsyncClient for http_get
+        self.validators = dict()  # Account -> {header: value} to send in conditional requests
+        self.content_hashes = dict()  # Account -> hash of last response, for servers without validators
+        self.fetch_stats = collections.Counter()  # requests, conditional, not_modified, bytes
+
+    def matrix_start(self, bot):
+        super().matrix_start(bot)
+        self.seen_ids.load_json(load_json(self.seen_ids_file()))
+        for account in list(self.seen_ids.accounts):
+            if account not in self.subscribers:
+                self.seen_ids.remove_account(account)
 
     async def matrix_poll(self, bot, pollcount):
         if self.enabled and len(self.account_rooms):
-            await self.poll_all_accounts(bot)
-
-    async def poll_all_accounts(self, bot):
-        now = datetime.now()
-        delete_rooms = []
-        for roomid in self.account_rooms:
-            if roomid in bot.client.rooms:
-                send_messages = True
-                # First poll
-                if not self.next_poll_time.get(roomid, None):
-                    self.next_poll_time[roomid] = now + timedelta(hours=-1)
-                    if not self.send_all:
-                        send_messages = False
-                        self.logger.debug(f'Polling all accounts for room {roomid} - but this is first sync so I wont send messages')
-                if now >= self.next_poll_time.get(roomid):
-                    accounts = self.account_rooms[roomid]
-                    for account in accounts:
-                        await self.poll_account(bot, account, roomid, send_messages)
+            if self.poll_task is None or self.poll_task.done():
+                self.poll_task = asyncio.create_task(self.poll_all_accounts(bot))
+        if time.monotonic() - self.seen_ids_saved > self.seen_ids_save_interval:
+            self.save_seen_ids()
+
+    def matrix_stop(self, bot):
+        super().matrix_stop(bot)
+        if self.poll_task:
+            self.poll_task.cancel()
+            self.poll_task = None
+        self.save_seen_ids()
+        if self.client:
+            try:
+                asyncio.get_running_loop().create_task(self.client.aclose())
+            except RuntimeError:
+                pass  # No loop running, nothing to close
+            self.client = None
+
+    def seen_ids_file(self):
+        return f'{self.name}_seen_ids.json'
+
+    def save_seen_ids(self):
+        if self.seen_ids.dirty:
+            save_json(self.seen_ids_file(), self.seen_ids.to_json())
+            self.seen_ids.dirty = False
+        self.seen_ids_saved = time.monotonic()
+
+    def new_items(self, account, items, key=lambda item: item['id']):
+        """
+        Return the items of account that haven't been seen before, e.g. in
+        fetch_account. Seen ids are saved locally, so after a restart only
+        the items published meanwhile are new.
+        """
+        return self.seen_ids.new_items(account, items, key)
+
+    def update_subscriptions(self):
+        """Group rooms by account after account_rooms has changed, and schedule new accounts"""
+        self.subscribers = dict()
+        for roomid, accounts in self.account_rooms.items():
+            for account in accounts:
+                self.subscribers.setdefault(account, []).append(roomid)
+        subscribed = {(account, roomid) for account, roomids in self.subscribers.items() for roomid in roomids}
+        self.synced &= subscribed
+        self.fetched &= subscribed
+        for account in list(self.poll_state):
+            if account not in self.subscribers:
+                del self.poll_state[account]
+                self.forget_validators(account)
+                self.seen_ids.remove_account(account)
+        for account in self.subscribers:
+            if account not in self.poll_state:
+                self.poll_state[account] = {'interval': self.poll_setting(account, 'interval_min'), 'failures': 0}
+                self.schedule(account, time.monotonic())
+
+    def poll_setting(self, account, name):
+        value = self.account_polling.get(account, {}).get(name)
+        if value is None:
+            value = self.polling.get(name)
+        if value is None:
+            value = getattr(self, self.POLL_SETTINGS[name])
+        if value is None and name == 'interval_max':
+            value = 8 * self.poll_setting(account, 'interval_min')
+        return value
+
+    def schedule(self, account, deadline):
+        self.poll_state[account]['deadline'] = deadline
+        heapq.heappush(self.deadlines, (deadline, account))
+
+    def reschedule(self, account, changed, failed):
+        """Adapt the interval of account to the result of its poll and schedule the next one"""
+        state = self.poll_state.get(account)
+        if state is None:
+            return  # Removed while polling
+        interval_min = self.poll_setting(account, 'interval_min')
+        interval_max = max(interval_min, self.poll_setting(account, 'interval_max'))
+        if failed:
+            state['failures'] += 1
+        else:
+            state['failures'] = 0
+        if state['failures'] >= self.poll_setting(account, 'failure_limit'):
+            if state['failures'] == self.poll_setting(account, 'failure_limit'):
+                self.logger.warning(f'{self.service_name} account {account} failed {state["failures"]} times, '
+                                    f'polling it only every {self.poll_setting(account, "circuit_break")} minutes')
+            delay = self.poll_setting(account, 'circuit_break')
+        else:
+            if changed:
+                state['interval'] = interval_min
             else:
-                self.logger.warning(f'Bot is no longer in room {roomid} - deleting it from {self.service_name} room list')
-                delete_rooms.append(roomid)
+                state['interval'] = min(interval_max, max(interval_min, state['interval'] * self.poll_setting(account, 'backoff')))
+            delay = state['interval']
+        jitter = uniform(0, min(self.poll_setting(account, 'interval_random'), delay))
+        self.schedule(account, time.monotonic() + (delay + jitter) * 60)
+
+    def due_accounts(self):
+        now = time.monotonic()
+        due = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, account = heapq.heappop(self.deadlines)
+            state = self.poll_state.get(account)
+            if state and state['deadline'] == deadline:
+                state['deadline'] = None  # Being polled
+                due.append(account)
+        return due
 
+    async def poll_all_accounts(self, bot, force=False):
+        delete_rooms = [roomid for roomid in self.account_rooms if roomid not in bot.client.rooms]
         if len(delete_rooms):
             for roomid in delete_rooms:
+                self.logger.warning(f'Bot is no longer in room {roomid} - deleting it from {self.service_name} room list')
                 self.account_rooms.pop(roomid, None)
+            self.update_subscriptions()
             bot.save_settings()
 
-        self.first_run = False
+        if force:
+            due = [account for account, state in self.poll_state.items() if state['deadline'] is not None]
+            for account in due:
+                self.poll_state[account]['deadline'] = None
+        else:
+            due = self.due_accounts()
+        if not due:
+            return
+        semaphore = asyncio.Semaphore(max(1, int(self.poll_setting(None, 'max_concurrent'))))
+
+        async def poll(account):
+            async with semaphore:
+                await self.poll_account(bot, account, self.subscribers.get(account, []))
 
-    async def poll_implementation(self, bot, account, roomid, send_messages):
+        await asyncio.gather(*(poll(account) for account in due))
+
+    async def poll_account(self, bot, account, roomids):
+        if self.seen_ids.has_account(account):
+            # Seen ids tell exactly what is new, even on the first poll after a restart
+            self.synced.update((account, roomid) for roomid in roomids)
+        if any((account, roomid) not in self.fetched for roomid in roomids):
+            # A new room needs the full data, even if it hasn't changed
+            self.forget_validators(account)
+        changed, failed = True, False
+        try:
+            data = await self.fetch_account(bot, account)
+            await self.process_account(bot, account, roomids, data)
+            self.fetched.update((account, roomid) for roomid in roomids)
+        except NotModified:
+            self.logger.debug(f'{self.service_name} account {account} not modified')
+            changed = False
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.logger.exception(f'Polling {self.service_name} account {account} failed')
+            changed, failed = False, True
+        self.reschedule(account, changed, failed)
+
+    async def fetch_account(self, bot, account):
+        """Fetch data of account once for all rooms, passed to poll_implementation"""
+        return None
+
+    async def process_account(self, bot, account, roomids, data):
+        for roomid in roomids:
+            send_messages = self.send_all or (account, roomid) in self.synced
+            if not send_messages:
+                self.logger.debug(f'Polling {account} for room {roomid} - but this is first sync so I wont send messages')
+            self.synced.add((account, roomid))
+            await self.poll_implementation(bot, account, roomid, send_messages, data)
+
+    async def poll_implementation(self, bot, account, roomid, send_messages, data):
         pass
 
-    async def poll_account(self, bot, account, roomid, send_messages):
-        polldelay = timedelta(minutes=self.poll_interval_min + randrange(self.poll_interval_random))
-        self.next_poll_time[roomid] = datetime.now() + polldelay
+    async def http_get(self, url, **kwargs):
+        """GET url with a client shared by all polls, raising on error status"""
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=self.http_timeout, follow_redirects=True)
+        response = await self.client.get(url, **kwargs)
+        if response.is_error:  # 304 is fine for fetch_conditional
+            response.raise_for_status()
+        return response
+
+    def forget_validators(self, account):
+        self.validators.pop(account, None)
+        self.content_hashes.pop(account, None)
+
+    async def fetch_conditional(self, account, url, **kwargs):
+        """
+        GET url with the validators of the previous response of account.
+        Raises NotModified if the server responds 304 or the response is
+        the same as the previous one.
+        """
+        validators = self.validators.get(account)
+        self.fetch_stats['requests'] += 1
+        if validators:
+            self.fetch_stats['conditional'] += 1
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, **validators)
+        response = await self.http_get(url, **kwargs)
+        if response.status_code == 304:
+            self.fetch_stats['not_modified'] += 1
+            raise NotModified()
+        self.fetch_stats['bytes'] += len(response.content)
+        content_hash = hash(response.content)
+        if self.content_hashes.get(account) == content_hash:
+            self.fetch_stats['unchanged'] += 1
+            raise NotModified()
+        self.content_hashes[account] = content_hash
+        validators = dict()
+        if response.headers.get('etag'):
+            validators['If-None-Match'] = response.headers['etag']
+        if response.headers.get('last-modified'):
+            validators['If-Modified-Since'] = response.headers['last-modified']
+        if validators:
+            self.validators[account] = validators
+        else:
+            self.validators.pop(account, None)
+        return response
+
+    def poll_state_text(self, account):
+        state = self.poll_state.get(account)
+        if not state:
+            return f'{account} not scheduled'
+        if state['deadline'] is None:
+            text = f'{account} being polled now'
+        else:
+            text = f'{account} next poll in {max(0, state["deadline"] - time.monotonic()) / 60:.1f} minutes'
+        text += f', interval {state["interval"]:g} minutes'
+        if state['failures']:
+            text += f', failed {state["failures"]} times in a row'
+            if state['failures'] >= self.poll_setting(account, 'failure_limit'):
+                text += ' (circuit broken)'
+        return text
 
-        await self.poll_implementation(bot, account, roomid, send_messages)
+    def fetch_stats_text(self):
+        stats = self.fetch_stats
+        if not stats['requests']:
+            return 'No http requests yet'
+        conditional = stats['conditional'] / stats['requests'] * 100
+        not_modified = stats['not_modified'] / stats['conditional'] * 100 if stats['conditional'] else 0
+        return f"{stats['requests']} requests, {conditional:.0f}% conditional, " \
+               f"{not_modified:.0f}% of those not modified (304), {stats['unchanged']} full responses unchanged, " \
+               f"{stats['bytes']} bytes of full responses"
 
     async def matrix_message(self, bot, room, event):
         if self.owner_only:
@@ -67,19 +342,19 @@ class PollingService(BotModule):
                 await bot.send_text(room,
                                     f'{self.service_name} accounts in this room: {self.account_rooms.get(room.room_id) or []}')
             elif args[1] == 'debug':
+                polls = [self.poll_state_text(account) for account in self.account_rooms.get(room.room_id) or []]
                 await bot.send_text(room,
-                                    f"{self.service_name} accounts: {self.account_rooms.get(room.room_id) or []} - known ids: {self.known_ids}\n" \
-                                    f"Next poll in this room at {self.next_poll_time.get(room.room_id)} - in {self.next_poll_time.get(room.room_id) - datetime.now()}")
+                                    f"{self.service_name} accounts: {self.account_rooms.get(room.room_id) or []} - known ids: " +
+                                    f"{sum(self.seen_ids.count(account) for account in self.account_rooms.get(room.room_id) or [])}\n" +
+                                    '\n'.join(polls + [self.fetch_stats_text()]))
             elif args[1] == 'poll':
                 bot.must_be_owner(event)
                 self.logger.info(f'{self.service_name} force polling requested by {event.sender}')
-                # Faking next poll times to force poll
-                for roomid in self.account_rooms:
-                    self.next_poll_time[roomid] = datetime.now() - timedelta(hours=1)
-                await self.poll_all_accounts(bot)
+                await self.poll_all_accounts(bot, force=True)
             elif args[1] == 'clear':
                 bot.must_be_admin(room, event)
                 self.account_rooms[room.room_id] = []
+                self.update_subscriptions()
                 bot.save_settings()
                 await bot.send_text(room, f'Cleared all {self.service_name} accounts from this room')
         if len(args) == 3:
@@ -97,6 +372,7 @@ class PollingService(BotModule):
                         return
                 else:
                     self.account_rooms[room.room_id] = [account]
+                self.update_subscriptions()
                 bot.save_settings()
                 await bot.send_text(room, f'Added {self.service_name} account {account} to this room.')
 
@@ -108,6 +384,8 @@ class PollingService(BotModule):
 
                 if self.account_rooms.get(room.room_id):
                     self.account_rooms[room.room_id].remove(account)
+                self.synced.discard((account, room.room_id))
+                self.update_subscriptions()
 
                 self.logger.info(f'{self.service_name} accounts now for this room {self.account_rooms.get(room.room_id)}')
 
@@ -117,12 +395,19 @@ class PollingService(BotModule):
     def get_settings(self):
         data = super().get_settings()
         data['account_rooms'] = self.account_rooms
+        data['polling'] = self.polling
+        data['account_polling'] = self.account_polling
         return data
 
     def set_settings(self, data):
         super().set_settings(data)
         if data.get('account_rooms'):
             self.account_rooms = data['account_rooms']
+        if data.get('polling'):
+            self.polling = data['polling']
+        if data.get('account_polling'):
+            self.account_polling = data['account_polling']
+        self.update_subscriptions()
 
     def help(self):
         return f'{self.service_name} polling'
@@ -0,0 +1,73 @@
+import hashlib
+import time
+
+
+def id_hash(item_id):
+    """64 bit hash of an item id, much smaller to keep than the id itself"""
+    return int.from_bytes(hashlib.blake2b(str(item_id).encode(), digest_size=8).digest(), 'big')
+
+
+class SeenIds:
+    """Ids of items seen per account, bounded in size and age
+
+    Ids are kept as 64 bit hashes in dicts ordered by when they were last
+    seen. An id still present in a fetch is moved to the end, so only ids
+    that have dropped out of the account's data get evicted, either when the
+    account has more than max_ids or when it hasn't been seen for max_age.
+    """
+
+    def __init__(self, max_ids=1000, max_age=90 * 24 * 3600):
+        self.max_ids = max_ids
+        self.max_age = max_age
+        self.accounts = dict()  # account -> {id hash: time last seen}
+        self.dirty = False
+
+    def has_account(self, account):
+        return account in self.accounts
+
+    def new_items(self, account, items, key):
+        """
+        Return items whose id (key(item)) hasn't been seen for account, and
+        remember all of them.
+        """
+        ids = self.accounts.setdefault(account, dict())
+        now = int(time.time())
+        new = []
+        items = list(items)
+        for item in items:
+            h = id_hash(key(item))
+            if ids.pop(h, None) is None:
+                new.append(item)
+            ids[h] = now
+        # Never evict ids of this fetch, they would be new again on the next one
+        self.prune(ids, now, max(self.max_ids, len(items)))
+        self.dirty = True
+        return new
+
+    def prune(self, ids, now, max_ids=None):
+        max_ids = max_ids or self.max_ids
+        while len(ids) > max_ids:
+            del ids[next(iter(ids))]
+        while ids:
+            oldest = next(iter(ids))
+            if now - ids[oldest] <= self.max_age:
+                break
+            del ids[oldest]
+
+    def remove_account(self, account):
+        if self.accounts.pop(account, None) is not None:
+            self.dirty = True
+
+    def count(self, account):
+        return len(self.accounts.get(account, ()))
+
+    def to_json(self):
+        return {account: [[h, seen] for h, seen in ids.items()] for account, ids in self.accounts.items()}
+
+    def load_json(self, data):
+        now = int(time.time())
+        for account, ids in (data or {}).items():
+            ids = {h: seen for h, seen in ids}
+            # Only by age, a saved account can be over max_ids when its last fetch was
+            self.prune(ids, now, max(self.max_ids, len(ids)))
+            self.accounts[account] = ids
@@ -0,0 +1,113 @@
+import gzip
+import json
+import logging
+import time
+import urllib.parse
+
+
+def strip_url(url):
+    """Return path and query of url without the access token"""
+    parts = urllib.parse.urlsplit(url)
+    query = [(key, value) for key, value in urllib.parse.parse_qsl(parts.query) if key != 'access_token']
+    path = parts.path
+    if query:
+        path += '?' + urllib.parse.urlencode(query)
+    return path
+
+
+def load_recording(path):
+    """Read all records from a recording file
+
+    :param path: file written by SyncRecorder
+    :return: list of dicts with at least keys 't' (unix time) and 'kind'
+    """
+    records = []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+
+class SyncRecorder:
+    """Records raw sync responses and outgoing requests of the bot
+
+    Records are written as gzip compressed json lines. Each record has the
+    time it was recorded ('t'), its kind and kind specific data:
+
+    - start: matrix_user, owners and room joining/leaving settings of the bot
+    - account_data: the bot's settings as loaded from the server
+    - sync: raw sync response body
+    - request: method, path (without access token), body and response status
+      of an outgoing request. Status is the exception name if it failed, nio
+      retries timeouts and 429 responses as new requests.
+
+    The recording can be fed back to the bot with benchmarks/replay.py. Note
+    that the recording contains message contents and bot settings, so keep it safe.
+    """
+
+    flush_interval = 5  # seconds
+
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, 'at', encoding='utf-8')
+        self.last_flush = time.time()
+        self.count = 0
+        self.logger = logging.getLogger('hemppa')
+        self.logger.info(f'Recording sync traffic to {path}')
+
+    def record(self, kind, **data):
+        data['t'] = time.time()
+        data['kind'] = kind
+        try:
+            self.file.write(json.dumps(data) + '\n')
+        except (TypeError, ValueError) as e:
+            self.logger.warning(f'Could not record {kind}: {e}')
+            return
+        self.count += 1
+        if data['t'] - self.last_flush > self.flush_interval:
+            self.file.flush()
+            self.last_flush = data['t']
+
+    def record_request(self, method, url, body=None, status=None):
+        if isinstance(body, (bytes, bytearray)):
+            body = {'bytes': len(body)}
+        elif isinstance(body, str):
+            try:
+                body = json.loads(body)
+            except ValueError:
+                body = {'bytes': len(body)}
+        elif body is not None and not isinstance(body, dict):
+            # Streamed uploads etc.
+            body = {'stream': type(body).__name__}
+        self.record('request', method=method, path=strip_url(url), body=body, status=status)
+
+    def attach(self, client):
+        """Wrap the nio client so that sync responses and requests get recorded"""
+        parse_body = client.parse_body
+        send = client.send
+
+        async def recording_parse_body(transport_response):
+            data = await parse_body(transport_response)
+            if transport_response.url.path.endswith('/sync'):
+                self.record('sync', body=data)
+            return data
+
+        async def recording_send(method, path, data=None, headers=None, trace_context=None, timeout=None):
+            if path.split('?', 1)[0].endswith('/sync'):
+                return await send(method, path, data, headers, trace_context, timeout)
+            try:
+                response = await send(method, path, data, headers, trace_context, timeout)
+            except Exception as e:
+                self.record_request(method, path, data, type(e).__name__)
+                raise
+            self.record_request(method, path, data, response.status)
+            return response
+
+        client.parse_body = recording_parse_body
+        client.send = recording_send
+
+    def close(self):
+        self.file.close()
+        self.logger.info(f'Recorded {self.count} records to {self.path}')
@@ -0,0 +1,27 @@
+import time
+
+
+class TokenBucket:
+    """Token bucket refilled at rate_per_minute
+
+    Allows short bursts up to rate_per_minute, and on average
+    rate_per_minute after that.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, max_wait):
+        """Take a token, returning how many seconds to wait before using it.
+        Returns None without taking a token if that would be longer than max_wait."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate if self.rate else None
+        if wait is None or wait > max_wait:
+            return None
+        self.tokens -= 1
+        return wait
@@ -0,0 +1,590 @@
+import asyncio
+import codecs
+import collections
+import re
+import time
+import urllib.parse
+from html.parser import HTMLParser
+
+from modules.common.tokenbucket import TokenBucket
+
+# Where to look for <meta charset> if the Content-Type header doesn't tell
+CHARSET_SNIFF_BYTES = 1024
+
+FEED_SLICE = 4096  # characters
+
+META_CHARSET_RE = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([a-zA-Z0-9_.:-]+)', re.IGNORECASE)
+
+
+def charset_from_content_type(content_type):
+    """Return charset parameter of a Content-Type header value, or None"""
+    for param in (content_type or '').split(';')[1:]:
+        key, _, value = param.partition('=')
+        if key.strip().lower() == 'charset' and value.strip():
+            return value.strip().strip('"\'')
+    return None
+
+
+def sniff_charset(data):
+    """Return charset from BOM or <meta charset> / http-equiv in the start of a document, or None"""
+    for bom, charset in ((codecs.BOM_UTF8, 'utf-8'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16')):
+        if data.startswith(bom):
+            return charset
+    match = META_CHARSET_RE.search(data[:CHARSET_SNIFF_BYTES])
+    return match.group(1).decode('ascii') if match else None
+
+
+def incremental_decoder(charset):
+    try:
+        return codecs.getincrementaldecoder(charset or 'utf-8')(errors='replace')
+    except LookupError:
+        return codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+
+class HeadMetadataParser(HTMLParser):
+    """Collects title and description from the <head> of a html document
+
+    Feed it the document in pieces; done becomes true at </head> (or <body>)
+    or as soon as both a <title> and a description have been seen, after
+    which the rest of the document is not needed.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title_tag = None
+        self.meta_title = None
+        self.og_title = None
+        self.description = None
+        self.in_title = False
+        self.title_parts = []
+        self.done = False
+
+    @property
+    def title(self):
+        """Title like the old BeautifulSoup based parsing: <title>, then meta title, then og:title"""
+        if self.title_tag:
+            return self.title_tag
+        return self.meta_title or self.og_title
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'title' and self.title_tag is None:
+            self.in_title = True
+        elif tag == 'meta':
+            attrs = dict(attrs)
+            name = (attrs.get('name') or '').lower()
+            prop = (attrs.get('property') or '').lower()
+            content = attrs.get('content')
+            if content is None:
+                return
+            if name == 'title' and self.meta_title is None:
+                self.meta_title = content
+            elif prop == 'og:title' and self.og_title is None:
+                self.og_title = content
+            elif name == 'description' and self.description is None:
+                self.description = content
+                self.check_done()
+        elif tag == 'body':
+            self.done = True
+
+    def handle_startendtag(self, tag, attrs):
+        if tag != 'title':
+            self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self.in_title:
+            self.in_title = False
+            self.title_tag = ''.join(self.title_parts)
+            self.check_done()
+        elif tag == 'head':
+            self.done = True
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title_parts.append(data)
+
+    def check_done(self):
+        if self.title_tag and self.description is not None:
+            self.done = True
+
+
+async def read_head_metadata(response, max_bytes):
+    """Stream a html response until its head has been parsed
+
+    :param response: streamed httpx response
+    :param max_bytes: stop after reading this many bytes in any case
+    :return: (title, description, bytes read)
+    """
+    parser = HeadMetadataParser()
+    charset = charset_from_content_type(response.headers.get('content-type'))
+    decoder = incremental_decoder(charset) if charset else None
+    pending = b''  # bytes waiting for charset sniffing
+    read = 0
+    async for chunk in response.aiter_bytes():
+        read += len(chunk)
+        if decoder is None:
+            pending += chunk
+            if len(pending) < CHARSET_SNIFF_BYTES and read < max_bytes:
+                continue
+            decoder = incremental_decoder(sniff_charset(pending))
+            chunk, pending = pending, b''
+        text = decoder.decode(chunk)
+        # Feed in slices, chunks can be large and the head may end early in them
+        for start in range(0, len(text), FEED_SLICE):
+            parser.feed(text[start:start + FEED_SLICE])
+            if parser.done:
+                break
+        if parser.done or read >= max_bytes:
+            break
+    else:
+        if decoder is None:
+            decoder = incremental_decoder(sniff_charset(pending))
+            parser.feed(decoder.decode(pending))
+        parser.feed(decoder.decode(b'', final=True))
+    return parser.title, parser.description, read
+
+
+def domain_suffixes(host):
+    """www.example.com -> www.example.com, example.com, com"""
+    labels = host.lower().split('.')
+    return ['.'.join(labels[i:]) for i in range(len(labels))]
+
+
+class PreviewCache:
+    """Size bounded cache of url previews with per domain time to live
+
+    Successful previews live for the ttl of the most specific matching
+    domain in ttls (or default_ttl), failures only for error_ttl, so
+    transient errors are retried soon. Entries are dropped in least
+    recently used order when the cache is full. Concurrent lookups of the
+    same url share one fetch.
+    """
+
+    def __init__(self, max_entries=2000, default_ttl=6 * 3600, error_ttl=60):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.error_ttl = error_ttl
+        self.ttls = dict()  # domain -> seconds
+        self.entries = collections.OrderedDict()  # url -> (expires, title, description, ok)
+        self.inflight = dict()  # url -> task fetching it
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0  # lookups that joined an in-flight fetch
+        self.dirty = False
+
+    def ttl_for(self, url):
+        host = urllib.parse.urlsplit(url).hostname or ''
+        for suffix in domain_suffixes(host):
+            if suffix in self.ttls:
+                return self.ttls[suffix]
+        return self.default_ttl
+
+    def get(self, url):
+        """Return cached (title, description, ok), or None"""
+        entry = self.entries.get(url)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            del self.entries[url]
+            return None
+        self.entries.move_to_end(url)
+        return entry[1:]
+
+    def put(self, url, title, description, ok=True):
+        ttl = self.ttl_for(url) if ok else self.error_ttl
+        if ttl <= 0:
+            return
+        self.entries[url] = (time.time() + ttl, title, description, ok)
+        self.entries.move_to_end(url)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        if ok:
+            self.dirty = True
+
+    async def lookup(self, url, fetch):
+        """Return (title, description) for url, calling coroutine function fetch(url) on a miss
+
+        fetch should raise on failure. The exception is passed on to the
+        callers waiting for that fetch, and cached as a negative entry so
+        that lookups return (None, None) until it expires.
+        """
+        cached = self.get(url)
+        if cached is not None:
+            self.hits += 1
+            return cached[:2]
+        task = self.inflight.get(url)
+        if task:
+            self.shared += 1
+            return await asyncio.shield(task)
+        self.misses += 1
+        task = self.inflight[url] = asyncio.ensure_future(self.fetch_and_put(url, fetch))
+        return await asyncio.shield(task)
+
+    async def fetch_and_put(self, url, fetch):
+        try:
+            title, description = await fetch(url)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.put(url, None, None, ok=False)
+            raise
+        finally:
+            self.inflight.pop(url, None)
+        self.put(url, title, description)
+        return title, description
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses + self.shared
+        return (self.hits + self.shared) / lookups if lookups else 0
+
+    def stats(self):
+        return f'{len(self.entries)} cached previews, hit rate {self.hit_rate() * 100:.1f}% ' \
+               f'({self.hits} hits, {self.shared} shared fetches, {self.misses} misses)'
+
+    def to_json(self):
+        now = time.time()
+        return [[url, *entry] for url, entry in self.entries.items() if entry[3] and entry[0] > now]
+
+    def load_json(self, data):
+        now = time.time()
+        for url, expires, title, description, ok in data or []:
+            if expires > now:
+                self.entries[url] = (expires, title, description, ok)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.dirty = True
+
+
+TRACKING_PARAM_RE = re.compile(r'^(utm_\w+|fbclid|gclid|mc_eid|igshid|si)$')
+
+
+def normalize_url(url):
+    """
+    Normalize url for comparing, so that trivially different ways of writing
+    the same link are equal: lower case scheme and host, no default port,
+    fragment, tracking parameters or trailing punctuation.
+    """
+    url = url.rstrip('.,;:!?)\'">')
+    try:
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+    host = (parts.hostname or '').lower()
+    if ':' in host:
+        host = f'[{host}]'
+    if port and (parts.scheme, port) not in (('http', 80), ('https', 443)):
+        host += f':{port}'
+    query = '&'.join(param for param in parts.query.split('&')
+                     if param and not TRACKING_PARAM_RE.match(param.split('=', 1)[0]))
+    return urllib.parse.urlunsplit((parts.scheme.lower(), host, parts.path or '/', query, ''))
+
+
+class RecentUrls:
+    """Urls previewed recently in each room, to skip repeated pastes
+
+    A url previewed in a room is remembered for the room's window. One least
+    recently used ordered dict holds the urls of all rooms, so memory is
+    bounded by max_entries however many rooms there are. Urls are only
+    remembered once their preview is sent, while being fetched they are
+    pending, so a url pasted again meanwhile isn't fetched twice.
+    """
+
+    def __init__(self, max_entries=5000):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()  # (room id, normalized url) -> monotonic time previewed
+        self.pending = set()  # (room id, normalized url) being fetched
+        self.suppressed = 0
+
+    def check(self, room_id, url, window):
+        """
+        Return True if url was previewed in room within window seconds or is
+        being fetched, otherwise mark it pending until done() is called
+        """
+        if window <= 0:
+            return False
+        key = (room_id, normalize_url(url))
+        previewed = self.entries.get(key)
+        if key in self.pending or (previewed is not None and time.monotonic() - previewed < window):
+            self.suppressed += 1
+            return True
+        self.pending.add(key)
+        return False
+
+    def done(self, room_id, url, previewed):
+        """Fetching url for room is done, remember it if its preview was sent"""
+        key = (room_id, normalize_url(url))
+        self.pending.discard(key)
+        if not previewed:
+            return
+        self.entries[key] = time.monotonic()
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear_room(self, room_id):
+        for key in [key for key in self.entries if key[0] == room_id]:
+            del self.entries[key]
+
+
+class DomainTrie:
+    """Maps domains to values, looked up by host with the domain suffixes matching
+
+    Labels are stored right to left, so looking up a host walks at most as
+    many nodes as it has labels, however many domains are stored.
+    """
+
+    VALUE = object()  # key of a node's value, can't be a label like '' of a.b..c
+
+    def __init__(self):
+        self.root = dict()
+
+    def insert(self, domain, value):
+        node = self.root
+        for label in reversed(domain.lower().strip('.').split('.')):
+            node = node.setdefault(label, dict())
+        node[self.VALUE] = value
+
+    def matches(self, host):
+        """Return (domain, value) of all domains matching host, least specific first"""
+        found = []
+        node = self.root
+        labels = host.lower().strip('.').split('.')
+        for i in range(len(labels) - 1, -1, -1):
+            node = node.get(labels[i])
+            if node is None:
+                break
+            if self.VALUE in node:
+                found.append(('.'.join(labels[i:]), node[self.VALUE]))
+        return found
+
+
+class RateLimiter(TokenBucket):
+    """Concurrency and request rate limits for one domain
+
+    Rate is enforced with a token bucket refilled at rate_per_minute, which
+    allows short bursts up to the same number of requests.
+    """
+
+    def __init__(self, max_concurrent, rate_per_minute):
+        super().__init__(rate_per_minute)
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+
+
+class FetchPolicies:
+    """Per domain fetch policies for url previews
+
+    A policy is a dict of some of the keys in DEFAULT_POLICY. The policy for
+    a host is the defaults updated with every matching domain's policy,
+    least specific first, so example.com settings apply to
+    www.example.com unless it has its own. Resolved policies are cached
+    per host until the policies change.
+    """
+
+    DEFAULT_POLICY = {
+        'allow': True,
+        'user_agent': None,  # None = the module's default user agent
+        'cookies': {},
+        'max_bytes': 800000,
+        'timeout': 10.0,  # seconds
+        'max_concurrent': 2,  # fetches at a time
+        'rate': 30,  # fetches per minute
+    }
+
+    max_hosts = 1000  # resolved policies and limiters kept
+
+    def __init__(self, builtin=None):
+        self.builtin = builtin or dict()  # domain -> policy, always applied before custom ones
+        self.custom = dict()  # domain -> policy, from settings
+        self.trie = None
+        self.resolved = collections.OrderedDict()  # host -> (policy, limiter key)
+        self.limiters = collections.OrderedDict()  # domain or host -> RateLimiter
+        self.compile()
+
+    @classmethod
+    def parse(cls, args):
+        """Parse ['key=value', ..] into a policy dict. Raises ValueError for bad keys or values."""
+        policy = dict()
+        for arg in args:
+            key, sep, value = arg.partition('=')
+            if not sep or key not in cls.DEFAULT_POLICY:
+                raise ValueError(f'Unknown policy setting {arg}, use one of {", ".join(cls.DEFAULT_POLICY)}')
+            default = cls.DEFAULT_POLICY[key]
+            if key == 'allow':
+                policy[key] = value.lower() in ('true', 'yes', '1')
+            elif key == 'cookies':
+                policy[key] = dict(cookie.split(':', 1) for cookie in value.split(',') if ':' in cookie)
+            elif key == 'user_agent':
+                policy[key] = value or None
+            else:
+                try:
+                    number = type(default)(value)
+                except ValueError:
+                    number = None
+                if number is None or not 0 < number < float('inf'):
+                    raise ValueError(f'Policy setting {key} must be a positive {type(default).__name__}, not {value}')
+                policy[key] = number
+        return policy
+
+    def compile(self):
+        self.trie = DomainTrie()
+        for domain in set(self.builtin) | set(self.custom):
+            policy = dict(self.builtin.get(domain, {}))
+            policy.update(self.custom.get(domain, {}))
+            self.trie.insert(domain, policy)
+        self.resolved.clear()
+        self.limiters.clear()
+
+    def set(self, domain, policy):
+        self.custom[domain.lower()] = policy
+        self.compile()
+
+    def delete(self, domain):
+        if self.custom.pop(domain.lower(), None) is None:
+            return False
+        self.compile()
+        return True
+
+    def resolve(self, host):
+        """Return (policy, limiter key) for host"""
+        host = (host or '').lower()
+        entry = self.resolved.get(host)
+        if entry is None:
+            policy = dict(self.DEFAULT_POLICY)
+            key = host
+            for domain, domain_policy in self.trie.matches(host):
+                policy.update(domain_policy)
+                key = domain
+            entry = self.resolved[host] = (policy, key)
+            if len(self.resolved) > self.max_hosts:
+                self.resolved.popitem(last=False)
+        else:
+            self.resolved.move_to_end(host)
+        return entry
+
+    def policy_for(self, url):
+        return self.resolve(urllib.parse.urlsplit(url).hostname)[0]
+
+    def limiter_for(self, url):
+        """Return (policy, RateLimiter) for url. Hosts under one policy domain share a limiter."""
+        policy, key = self.resolve(urllib.parse.urlsplit(url).hostname)
+        limiter = self.limiters.get(key)
+        if limiter is None:
+            limiter = self.limiters[key] = RateLimiter(policy['max_concurrent'], policy['rate'])
+            if len(self.limiters) > self.max_hosts:
+                self.limiters.popitem(last=False)
+        else:
+            self.limiters.move_to_end(key)
+        return policy, limiter
+
+
+class TextExtractor(HTMLParser):
+    """Collects the text of the first <p> in a html snippet"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.depth = 0
+        self.parts = []
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'p' and not self.done:
+            self.depth += 1
+        elif tag == 'br' and self.depth:
+            self.parts.append(' ')
+
+    def handle_endtag(self, tag):
+        if tag == 'p' and self.depth:
+            self.depth -= 1
+            self.done = not self.depth
+
+    def handle_data(self, data):
+        if self.depth:
+            self.parts.append(data)
+
+    @classmethod
+    def first_paragraph(cls, html):
+        parser = cls()
+        parser.feed(html or '')
+        return ' '.join(''.join(parser.parts).split()) or None
+
+
+class OEmbedProvider:
+    """A site whose previews come from its oEmbed endpoint instead of its html
+
+    :param name: provider name for logging
+    :param domains: domains (and their subdomains) of the provider
+    :param pattern: regex the url must match, so only content pages use oEmbed
+    :param endpoint: oEmbed endpoint url, the page url is passed as url parameter
+    :param rewrite: optional function to rewrite the page url before querying
+    """
+
+    def __init__(self, name, domains, pattern, endpoint, rewrite=None):
+        self.name = name
+        self.domains = domains
+        self.pattern = re.compile(pattern)
+        self.endpoint = endpoint
+        self.rewrite = rewrite
+
+    def params(self, url):
+        return {'url': self.rewrite(url) if self.rewrite else url, 'format': 'json'}
+
+    def extract(self, data):
+        """Return (title, description) from oEmbed response data"""
+        title = data.get('title')
+        author = data.get('author_name')
+        description = data.get('description') or (f'By {author}' if author else None)
+        if not title and data.get('html'):
+            # Rich embeds like tweets have no title, the content is in the html
+            text = TextExtractor.first_paragraph(data['html'])
+            if text:
+                title = f'{author}: {text}' if author else text
+                description = None
+        return title, description
+
+
+class ProviderRegistry:
+    """Finds the oEmbed provider for an url by its domain"""
+
+    def __init__(self, providers):
+        self.trie = DomainTrie()
+        for provider in providers:
+            for domain in provider.domains:
+                self.trie.insert(domain, provider)
+
+    def match(self, url):
+        """Return provider for url, or None"""
+        parts = urllib.parse.urlsplit(url)
+        for domain, provider in reversed(self.trie.matches(parts.hostname or '')):
+            if provider.pattern.search(url):
+                return provider
+        return None
+
+
+def twitter_url(url):
+    """publish.twitter.com wants twitter.com urls"""
+    return re.sub(r'^https?://(www\.|mobile\.)?x\.com/', 'https://twitter.com/', url)
+
+
+OEMBED_PROVIDERS = [
+    OEmbedProvider('YouTube', ['youtube.com', 'youtu.be'],
+                   r'youtu\.be/[\w-]+|youtube\.com/(watch\?|shorts/|live/|playlist\?)',
+                   'https://www.youtube.com/oembed'),
+    OEmbedProvider('Twitter', ['twitter.com', 'x.com'],
+                   r'/\w+/status(es)?/\d+',
+                   'https://publish.twitter.com/oembed', rewrite=twitter_url),
+    OEmbedProvider('Reddit', ['reddit.com', 'redd.it'],
+                   r'/r/\w+/comments/|redd\.it/\w+',
+                   'https://www.reddit.com/oembed'),
+    OEmbedProvider('Vimeo', ['vimeo.com'],
+                   r'vimeo\.com/(\d+|channels/|groups/)',
+                   'https://vimeo.com/api/oembed.json'),
+    OEmbedProvider('SoundCloud', ['soundcloud.com'],
+                   r'soundcloud\.com/[\w-]+/[\w-]+',
+                   'https://soundcloud.com/oembed'),
+    OEmbedProvider('Spotify', ['open.spotify.com'],
+                   r'/(track|album|playlist|episode|show|artist)/\w+',
+                   'https://open.spotify.com/oembed'),
+]
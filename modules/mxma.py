@@ -1,7 +1,3 @@
-from modules.common.module import BotModule
-import requests, json
-import traceback
-
 from modules.common.pollingservice import PollingService
 
 class MatrixModule(PollingService):
@@ -10,21 +6,22 @@ class MatrixModule(PollingService):
         self.service_name = 'MXMA'
         self.poll_interval_min = 5
         self.poll_interval_random = 2
+        self.poll_interval_max = self.poll_interval_min  # Messages should not wait for a backed off poll
+        self.poll_circuit_break = 30  # minutes, a failing endpoint is retried soon
         self.owner_only = True
         self.send_all = True
         self.enabled = False
 
-    async def poll_implementation(self, bot, account, roomid, send_messages):
-        try:
-            response = requests.get(url=account, timeout=5)
-            if response.status_code == 200:
-                if 'messages' in response.json():
-                    messages = response.json()['messages']
-                    for message in messages:
-                        success = await bot.send_msg(message['to'], message['title'], message['message'])
-        except Exception:
-            self.logger.error('Polling MXMA failed:')
-            traceback.print_exc(file=sys.stderr)
+    async def fetch_account(self, bot, account):
+        # The endpoint is a message queue, the same messages can legitimately
+        # come again, so no conditional requests or identical response checks
+        response = await self.http_get(account)
+        return response.json().get('messages', [])
+
+    async def process_account(self, bot, account, roomids, data):
+        # Messages are sent to users, not to the rooms the endpoint was added in
+        for message in data:
+            await bot.send_msg(message['to'], message['title'], message['message'])
 
     def help(self):
         return 'Matrix messaging API'
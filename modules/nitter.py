@@ -1,18 +1,31 @@
-import re
-
+from modules.common.linkrewrite import LinkRewriter, RewriteRule
 from modules.common.module import BotModule
+from modules.common.tokenbucket import TokenBucket
 from nio import RoomMessageText
 
+# Rules that exist unless overridden with !nitter add
+BUILTIN_RULES = [
+    RewriteRule('twitter', ['twitter.com', 'x.com'], 'nitter.net'),
+    RewriteRule('youtube', ['youtube.com', 'youtu.be'], 'yewtu.be', keep_query=True),
+    RewriteRule('reddit', ['reddit.com'], 'safereddit.com'),
+    RewriteRule('medium', ['medium.com'], 'scribe.rip'),
+]
+
 
-# This module reads matrix messages and converts twitter.com links to nitter.nl
-# Module will only target messages that contain only the twitter link
-# Additionally module will target only profile links or post links, query parameters are removed
+# This module reads matrix messages and converts links to alternative frontends,
+# like twitter.com links to nitter.net. Rules are enabled per room.
+# Additionally module will target only the link path, query parameters are removed
+# unless the rule keeps them.
 class MatrixModule(BotModule):
+    rewrites_per_minute = 10  # per room, links over this are not rewritten
+
     def __init__(self, name):
         super().__init__(name)
-        self.regex = re.compile(r'https://twitter.com/([^?]*)')
+        self.rewriter = LinkRewriter(BUILTIN_RULES)
+        self.custom_rules = dict()  # name -> RewriteRule added with !nitter add
+        self.room_rules = dict()  # room id -> set of enabled rule names
+        self.limiters = dict()  # room id -> TokenBucket
         self.bot = None
-        self.enabled_rooms = []
         self.enabled = False
 
     def matrix_start(self, bot):
@@ -27,11 +40,15 @@ class MatrixModule(BotModule):
         super().matrix_stop(bot)
         bot.remove_callback(self.text_cb)
 
+    def compile_rules(self):
+        self.rewriter = LinkRewriter(BUILTIN_RULES + list(self.custom_rules.values()))
+
     async def text_cb(self, room, event):
         """
         Handle client callbacks for all room text events
         """
-        if room.room_id not in self.enabled_rooms:
+        enabled = self.room_rules.get(room.room_id)
+        if not enabled:
             return
 
         if self.bot.should_ignore_event(event):
@@ -44,11 +61,18 @@ class MatrixModule(BotModule):
         if event.body.startswith('!'):
             return
 
-        if len(event.body.split()) <= 1:
-            if event.body.startswith('https://twitter.com/'):
-                for link in self.regex.findall(event.body):
-                    await self.bot.send_text(room, f'https://nitter.net/{link}')
-                return
+        links = self.rewriter.rewrite(event.body, enabled)
+        if not links:
+            return
+
+        limiter = self.limiters.get(room.room_id)
+        if limiter is None:
+            limiter = self.limiters[room.room_id] = TokenBucket(self.rewrites_per_minute)
+        if limiter.reserve(0) is None:
+            self.logger.debug(f'Not rewriting links in {room.room_id}, rate limited')
+            return
+
+        await self.bot.send_text(room, '\n'.join(links))
 
     async def matrix_message(self, bot, room, event):
         """
@@ -57,32 +81,78 @@ class MatrixModule(BotModule):
         args = event.body.split()
         args.pop(0)
         if len(args) == 0:
-            await bot.send_text(room, 'Usage: !nitter <enable|disable>')
+            await bot.send_text(room, 'Usage: !nitter <enable|disable> [rule ...], !nitter rules, '
+                                      '!nitter add <rule> <domain,domain> <target> [keepquery], !nitter del <rule>')
             return
-        if len(args) == 1:
-            if args[0] == 'enable':
-                bot.must_be_admin(room, event)
-                self.enabled_rooms.append(room.room_id)
-                self.enabled_rooms = list(dict.fromkeys(self.enabled_rooms))  # Deduplicate
-                await bot.send_text(room, "Ok, enabling conversion of twitter links to nitter links here")
-                bot.save_settings()
+        if args[0] == 'rules':
+            enabled = self.room_rules.get(room.room_id, set())
+            await bot.send_text(room, 'Link rewrite rules:\n' + '\n'.join(
+                f' - {rule}' + (' (enabled here)' if name in enabled else '')
+                for name, rule in sorted(self.rewriter.rules.items())))
+            return
+        if args[0] in ('enable', 'disable'):
+            bot.must_be_admin(room, event)
+            if args[1:]:
+                names = args[1:]
+            elif args[0] == 'enable':
+                names = ['twitter']  # What earlier versions did, other rules must be asked for
+            else:
+                names = sorted(self.room_rules.get(room.room_id, ()))
+                if not names:
+                    await bot.send_text(room, 'No link rewriting enabled here')
+                    return
+            # Rules deleted after enabling them here can still be disabled
+            unknown = [name for name in names if name not in self.rewriter.rules
+                       and (args[0] == 'enable' or name not in self.room_rules.get(room.room_id, ()))]
+            if unknown:
+                await bot.send_text(room, f'Unknown rules: {", ".join(unknown)}. See !nitter rules')
                 return
-            if args[0] == 'disable':
-                bot.must_be_admin(room, event)
-                self.enabled_rooms.remove(room.room_id)
-                await bot.send_text(room, "Ok, disabling conversion of twitter links to nitter links here")
-                bot.save_settings()
+            enabled = self.room_rules.setdefault(room.room_id, set())
+            if args[0] == 'enable':
+                enabled.update(names)
+            else:
+                enabled.difference_update(names)
+            if not enabled:
+                del self.room_rules[room.room_id]
+                self.limiters.pop(room.room_id, None)
+            await bot.send_text(room, f"Ok, {args[0]}d rewriting {', '.join(sorted(names))} links here")
+            bot.save_settings()
+            return
+        if args[0] == 'add' and len(args) in (4, 5):
+            bot.must_be_owner(event)
+            rule = RewriteRule(args[1], args[2].split(','), args[3], keep_query=args[4:] == ['keepquery'])
+            self.custom_rules[rule.name] = rule
+            self.compile_rules()
+            await bot.send_text(room, f'Ok, rule {rule}')
+            bot.save_settings()
+            return
+        if args[0] == 'del' and len(args) == 2:
+            bot.must_be_owner(event)
+            if self.custom_rules.pop(args[1], None) is None:
+                await bot.send_text(room, f'No added rule {args[1]}')
                 return
+            self.compile_rules()
+            await bot.send_text(room, f'Ok, deleted rule {args[1]}')
+            bot.save_settings()
+            return
+        await bot.send_text(room, 'Sorry, I did not understand. See !nitter for usage.')
 
     def help(self):
-        return 'Converts Twitter links to nitter links.'
+        return 'Converts Twitter, YouTube, Reddit etc. links to alternative frontend links.'
 
     def get_settings(self):
         data = super().get_settings()
-        data["enabled_rooms"] = self.enabled_rooms
+        data["room_rules"] = {room_id: sorted(names) for room_id, names in self.room_rules.items()}
+        data["custom_rules"] = {name: rule.to_json() for name, rule in self.custom_rules.items()}
         return data
 
     def set_settings(self, data):
         super().set_settings(data)
-        if data.get("enabled_rooms"):
-            self.enabled_rooms = data["enabled_rooms"]
+        if data.get("custom_rules"):
+            self.custom_rules = {name: RewriteRule.from_json(name, rule) for name, rule in data["custom_rules"].items()}
+            self.compile_rules()
+        if data.get("room_rules"):
+            self.room_rules = {room_id: set(names) for room_id, names in data["room_rules"].items()}
+        elif data.get("enabled_rooms"):
+            # Earlier versions only converted twitter links
+            self.room_rules = {room_id: {'twitter'} for room_id in data["enabled_rooms"]}
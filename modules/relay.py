@@ -1,13 +1,95 @@
+import asyncio
+import collections
+import ipaddress
+import re
+import tempfile
+import time
+import urllib.parse
+
+import httpx
+
 from modules.common.module import BotModule
-from nio import RoomMessageText
+from nio import RoomMessageMedia, RoomMessageText, UploadResponse
+
+# Server name (host, ipv4, [ipv6], optional port) and media id of an mxc uri
+MXC_RE = re.compile(r'mxc://([A-Za-z0-9.-]+|\[[0-9A-Fa-f:.]+\])(:\d{1,5})?/([A-Za-z0-9_-]+)')
+
+
+async def check_public_url(url):
+    """
+    Raise ValueError unless url is https and its host resolves only to
+    public addresses, so that remote servers can't make the bot fetch
+    internal or loopback urls
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme != 'https' or not parts.hostname:
+        raise ValueError(f'Not fetching non-https url {url}')
+    try:
+        addresses = [ipaddress.ip_address(parts.hostname)]
+    except ValueError:
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(parts.hostname, parts.port or 443)
+        except OSError as e:
+            raise ValueError(f'Could not resolve {parts.hostname}: {e}')
+        addresses = [ipaddress.ip_address(info[4][0].split('%')[0]) for info in infos]
+    if not addresses or not all(address.is_global for address in addresses):
+        raise ValueError(f'Not fetching {url}, {parts.hostname} is not a public address')
+
 
 class MatrixModule(BotModule):
+    """
+    Relays messages between bridged rooms.
+
+    A bridge is a group of two or more rooms, every message in one of them
+    is relayed to all the others. Rooms are indexed to their group, so
+    finding the targets doesn't depend on the number of bridges.
+
+    Messages are queued per target room. When messages arrive faster than
+    they can be sent, the queued ones are combined into one event.
+
+    Media is relayed by reusing the original mxc:// uri and info, so no
+    bytes are transferred. Only when the bot's homeserver can't serve media
+    from the origin server is the file downloaded from the origin and
+    uploaded again.
+    """
+
+    max_batch_lines = 20
+    max_copy_bytes = 50 * 1024 * 1024
+    media_check_interval = 3600  # seconds to remember whether an origin server's media is served
+    max_copied = 100
+    download_paths = ['/_matrix/client/v1/media/download/', '/_matrix/media/v3/download/']
+    max_redirects = 5
+
     def __init__(self, name):
         super().__init__(name)
-        self.bridges = dict()
+        self.groups = []  # [[room id, room id, ..], ..]
+        self.room_groups = dict()  # room id -> group containing it
+        self.queues = collections.defaultdict(collections.deque)  # target room id -> lines to send
+        self.senders = dict()  # target room id -> task sending its queue
+        self.media_served = dict()  # origin server -> (media can be served, monotonic time checked)
+        self.copied = collections.OrderedDict()  # original mxc uri -> mxc uri of copy, so copies are shared by targets
+        self.copying = dict()  # original mxc uri -> task copying it, shared by targets relayed to meanwhile
         self.bot = None
         self.enabled = False
 
+    def index_groups(self):
+        self.room_groups = {room_id: group for group in self.groups for room_id in group}
+
+    def add_bridge(self, room_id, other_id):
+        """Bridge two rooms, merging their existing groups"""
+        group = self.room_groups.get(room_id)
+        other_group = self.room_groups.get(other_id)
+        if group is None and other_group is None:
+            self.groups.append([room_id, other_id])
+        elif group is None:
+            other_group.append(room_id)
+        elif other_group is None:
+            group.append(other_id)
+        elif group is not other_group:
+            group.extend(other_group)
+            self.groups.remove(other_group)
+        self.index_groups()
+
     async def message_cb(self, room, event):
         if self.bot.should_ignore_event(event):
             return
@@ -15,95 +97,273 @@ class MatrixModule(BotModule):
         if event.body.startswith('!'):
             return
 
-        source_id = None
-        target_id = None
+        group = self.room_groups.get(room.room_id)
+        if not group:
+            return
 
-        for src_id, tgt_id in self.bridges.items():
-            if room.room_id == src_id:
-                source_id = src_id
-                target_id = tgt_id
-            elif room.room_id == tgt_id:
-                source_id = tgt_id
-                target_id = src_id
+        sendernick = room.user_name(event.sender) or event.sender
+        self.enqueue(group, room.room_id, f'<{sendernick}> {event.body}')
 
-        if not source_id or not target_id:
+    async def media_cb(self, room, event):
+        if self.bot.should_ignore_event(event):
             return
 
-        target_room = self.bot.get_room_by_id(target_id)
-        if(target_room):
-            sendernick = target_room.user_name(event.sender)
-            if not sendernick:
-                sendernick = event.sender
-            await self.bot.send_text(target_room, f'<{sendernick}> {event.body}', msgtype="m.text", bot_ignore=True)
-        else:
-            self.logger.warning(f"Bot doesn't seem to be in bridged room {target_id}")
+        group = self.room_groups.get(room.room_id)
+        if not group:
+            return
+
+        content = event.source['content']
+        sendernick = room.user_name(event.sender) or event.sender
+        relayed = {
+            'msgtype': content.get('msgtype', 'm.file'),
+            'url': event.url,
+            # Body works as a caption when filename is set
+            'body': f'<{sendernick}> {event.body}',
+            'filename': content.get('filename', event.body),
+            'org.vranki.hemppa.ignore': 'true',
+        }
+        if 'info' in content:
+            relayed['info'] = content['info']
+        self.enqueue(group, room.room_id, relayed)
+
+    def enqueue(self, group, source_id, item):
+        """Queue a text line or media content to all other rooms in group"""
+        for target_id in group:
+            if target_id != source_id:
+                self.queues[target_id].append(item)
+                if target_id not in self.senders:
+                    self.senders[target_id] = asyncio.create_task(self.send_queue(target_id))
+
+    async def send_queue(self, target_id):
+        queue = self.queues[target_id]
+        try:
+            while queue:
+                target_room = self.bot.get_room_by_id(target_id)
+                if not target_room:
+                    self.logger.warning(f"Bot doesn't seem to be in bridged room {target_id}")
+                    queue.clear()
+                    break
+                if isinstance(queue[0], dict):
+                    await self.send_media(target_room, queue.popleft())
+                    continue
+                lines = []
+                while queue and isinstance(queue[0], str) and len(lines) < self.max_batch_lines:
+                    lines.append(queue.popleft())
+                await self.bot.send_text(target_room, '\n'.join(lines), msgtype="m.text", bot_ignore=True)
+        except Exception:
+            self.logger.exception(f'Relaying to {target_id} failed')
+            queue.clear()
+        finally:
+            self.senders.pop(target_id, None)
+
+    async def send_media(self, target_room, content):
+        if not MXC_RE.fullmatch(content['url'] or ''):
+            self.logger.warning(f"Not relaying media with invalid uri {content['url']}")
+            return
+        origin = urllib.parse.urlsplit(content['url']).netloc
+        served, checked = self.media_served.get(origin, (None, 0))
+        if served is None or time.monotonic() - checked > self.media_check_interval:
+            served, definitive = await self.check_media(content['url'])
+            if definitive:
+                self.media_served[origin] = (served, time.monotonic())
+        if not served:
+            content = await self.copy_media(content)
+            if not content:
+                return
+        await self.bot.client.room_send(target_room.room_id, 'm.room.message', content)
+
+    def download_urls(self, mxc):
+        server_and_id = mxc[len('mxc://'):]
+        return [self.bot.client.homeserver + path + server_and_id for path in self.download_paths]
+
+    async def check_media(self, mxc):
+        """
+        Check whether the bot's homeserver can serve the media, fetching just
+        the first byte. Returns (served, definitive), where definitive tells
+        whether the result holds for other media of the origin server too.
+        """
+        headers = {'Authorization': f'Bearer {self.bot.client.access_token}', 'Range': 'bytes=0-0'}
+        async with httpx.AsyncClient(timeout=30) as client:
+            for url in self.download_urls(mxc):
+                try:
+                    response = await client.get(url, headers=headers)
+                except httpx.HTTPError as e:
+                    self.logger.warning(f'Checking media {mxc} failed: {repr(e)}')
+                    return True, False  # Don't copy just because the check failed
+                if response.status_code in (200, 206):
+                    return True, True
+                if response.status_code == 429 or response.status_code >= 500:
+                    self.logger.warning(f'Checking media {mxc} failed ({response.status_code})')
+                    return True, False
+                if response.status_code not in (404, 405) or 'M_UNRECOGNIZED' not in response.text:
+                    # Only this file, e.g. it's missing or too large for the homeserver to fetch
+                    self.logger.info(f'Media {mxc} is not served by homeserver ({response.status_code}), copying media')
+                    return False, False
+        # Homeserver doesn't support any of the download endpoints
+        self.logger.info('Homeserver does not serve media, copying media')
+        return False, True
+
+    async def public_get(self, client, url):
+        """
+        Start a streamed GET of url, following redirects only to public https
+        urls. Returns the response, which must be closed. Raises ValueError
+        for urls that must not be fetched.
+        """
+        for _ in range(self.max_redirects + 1):
+            await check_public_url(url)
+            response = await client.send(client.build_request('GET', url), stream=True)
+            if not response.is_redirect:
+                return response
+            await response.aclose()
+            url = urllib.parse.urljoin(url, response.headers['location'])
+        raise ValueError(f'Too many redirects fetching {url}')
+
+    async def origin_base_url(self, client, origin):
+        """Client API base url of a homeserver, from .well-known if it has one"""
+        try:
+            response = await self.public_get(client, f'https://{origin}/.well-known/matrix/client')
+            try:
+                if response.status_code == 200:
+                    await response.aread()
+                    return response.json()['m.homeserver']['base_url'].rstrip('/')
+            finally:
+                await response.aclose()
+        except (httpx.HTTPError, ValueError, KeyError, TypeError, AttributeError):
+            pass
+        return f'https://{origin}'
+
+    async def copy_media(self, content):
+        """
+        Copy media to the bot's homeserver, once however many targets it is
+        relayed to. Returns content with the new url, or None if that fails.
+        """
+        mxc = content['url']
+        if mxc in self.copied:
+            self.copied.move_to_end(mxc)
+            return dict(content, url=self.copied[mxc])
+
+        task = self.copying.get(mxc)
+        if task is None:
+            task = self.copying[mxc] = asyncio.create_task(self.copy_file(mxc, content))
+            task.add_done_callback(lambda _: self.copying.pop(mxc, None))
+        # Shielded, so that a target's sender being cancelled doesn't cancel the copy for the others
+        content_uri = await asyncio.shield(task)
+        return dict(content, url=content_uri) if content_uri else None
+
+    async def copy_file(self, mxc, content):
+        """
+        Download media directly from its origin server, up to max_copy_bytes,
+        to a temporary file and upload it from there to the bot's homeserver.
+        Only public https urls are fetched, also when redirected. Returns the
+        mxc uri of the copy, or None if that fails.
+        """
+        match = MXC_RE.fullmatch(mxc)
+        if not match:
+            self.logger.warning(f'Not copying media with invalid uri {mxc}')
+            return None
+        origin = match.group(1) + (match.group(2) or '')
+        with tempfile.TemporaryFile() as file:
+            async with httpx.AsyncClient(timeout=60) as client:
+                try:
+                    url = await self.origin_base_url(client, origin) + '/_matrix/media/v3/download/' + mxc[len('mxc://'):]
+                    response = await self.public_get(client, url)
+                    try:
+                        if response.status_code != 200:
+                            self.logger.warning(f'Could not download {mxc} for relaying ({response.status_code})')
+                            return None
+                        content_type = response.headers.get('content-type', 'application/octet-stream')
+                        size = 0
+                        async for chunk in response.aiter_bytes():
+                            size += len(chunk)
+                            if size > self.max_copy_bytes:
+                                self.logger.warning(f'Not relaying {mxc}, larger than {self.max_copy_bytes} bytes')
+                                return None
+                            file.write(chunk)
+                    finally:
+                        await response.aclose()
+                except (httpx.HTTPError, ValueError) as e:
+                    self.logger.warning(f'Copying media {mxc} failed: {repr(e)}')
+                    return None
+
+            file.seek(0)
+            response, _ = await self.bot.client.upload(file, content_type, content.get('filename'), filesize=size)
+        if not isinstance(response, UploadResponse):
+            self.logger.warning(f'Uploading copy of {mxc} failed: {response}')
+            return None
+        self.copied[mxc] = response.content_uri
+        if len(self.copied) > self.max_copied:
+            self.copied.popitem(last=False)
+        return response.content_uri
 
     def matrix_start(self, bot):
         super().matrix_start(bot)
         bot.client.add_event_callback(self.message_cb, RoomMessageText)
+        bot.client.add_event_callback(self.media_cb, RoomMessageMedia)
         self.bot = bot
 
     def matrix_stop(self, bot):
         super().matrix_stop(bot)
         bot.remove_callback(self.message_cb)
+        bot.remove_callback(self.media_cb)
+        for task in self.senders.values():
+            task.cancel()
+        self.senders.clear()
+        for task in list(self.copying.values()):
+            task.cancel()
+        self.queues.clear()
         self.bot = None
 
+    def room_name(self, room_id):
+        room = self.bot.get_room_by_id(room_id)
+        return room.display_name if room else f'??? {room_id}'
+
     async def matrix_message(self, bot, room, event):
         bot.must_be_admin(room, event)
         args = event.body.split()
         args.pop(0)
         if len(args) == 1:
             if args[0] == 'list':
-                i = 1
-                msg = f"Active relay bridges ({len(self.bridges)}):\n"
-                for src_id, tgt_id in self.bridges.items():
-                    srcroom = self.bot.get_room_by_id(src_id)
-                    tgtroom = self.bot.get_room_by_id(tgt_id)
-
-                    if srcroom:
-                        srcroom = srcroom.display_name
-                    else:
-                        srcroom = f'??? {src_id}'
-
-                    if tgtroom:
-                        tgtroom = tgtroom.display_name
-                    else:
-                        tgtroom = f'??? {tgt_id}'
-
-                    msg += f'{i}: {srcroom} <-> {tgtroom}'
-                    i = i + 1
+                msg = f"Active relay bridges ({len(self.groups)}):\n"
+                for i, group in enumerate(self.groups, 1):
+                    msg += f'{i}: ' + ' <-> '.join(self.room_name(room_id) for room_id in group) + '\n'
                 await bot.send_text(room, msg)
 
         if len(args) == 2:
             if args[0] == 'bridge':
                 roomid = args[1]
                 room_to_bridge = bot.get_room_by_id(roomid)
-                if room_to_bridge:
+                if roomid == room.room_id:
+                    await bot.send_text(room, f'Can\'t bridge a room with itself!')
+                elif room_to_bridge:
                     await bot.send_text(room, f'Bridging {room_to_bridge.display_name} here.')
-                    self.bridges[room.room_id] = roomid
+                    self.add_bridge(room.room_id, roomid)
                     bot.save_settings()
                 else:
                     await bot.send_text(room, f'I am not on room with id {roomid} (note: use id, not alias)!')
             elif args[0] == 'unbridge':
                 idx = int(args[1]) - 1
-                i = 0
-                for src_id, tgt_id in self.bridges.items():
-                    if i == idx:
-                        del self.bridges[src_id]
-                        await bot.send_text(room, f'Unbridged {src_id} and {tgt_id}.')
-                        bot.save_settings()
-                        return
-                    i = i + 1
+                if 0 <= idx < len(self.groups):
+                    group = self.groups.pop(idx)
+                    self.index_groups()
+                    await bot.send_text(room, f'Unbridged {" and ".join(group)}.')
+                    bot.save_settings()
 
     def help(self):
-        return 'Simple relaybot between two Matrix rooms'
+        return 'Simple relaybot between Matrix rooms'
 
     def get_settings(self):
         data = super().get_settings()
-        data["bridges"] = self.bridges
+        data["groups"] = self.groups
         return data
 
     def set_settings(self, data):
         super().set_settings(data)
-        if data.get("bridges"):
-            self.bridges = data["bridges"]
+        if data.get("groups"):
+            self.groups = data["groups"]
+            self.index_groups()
+        elif data.get("bridges"):
+            # Earlier versions stored one to one bridges as source -> target
+            self.groups = []
+            self.index_groups()
+            for src_id, tgt_id in data["bridges"].items():
+                self.add_bridge(src_id, tgt_id)
@@ -1,36 +1,38 @@
 from modules.common.pollingservice import PollingService
-from urllib.request import urlopen
-import json
-import time
 
 
 class MatrixModule(PollingService):
     def __init__(self, name):
         super().__init__(name)
         self.accountroomid_laststatus = {}
+        self.poll_interval_max = 45  # minutes, open/closed changes should not be announced hours late
         self.template = '{spacename} is now {open_closed}'
         self.i18n = {'open': 'open 🔓', 'closed': 'closed 🔒'}
         self.enabled = False
 
-    async def poll_implementation(self, bot, account, roomid, send_messages):
+    async def fetch_account(self, bot, account):
         self.logger.debug(f'polling space api {account}.')
-        spacename, is_open = MatrixModule.open_status(account)
+        response = await self.fetch_conditional(account, account)
+        return MatrixModule.open_status(response.json())
+
+    async def poll_implementation(self, bot, account, roomid, send_messages, data):
+        spacename, is_open = data
 
         open_str = self.i18n['open'] if is_open else self.i18n['closed']
         text = self.template.format(spacename=spacename, open_closed=open_str)
         self.logger.debug(text)
 
         last_status = self.accountroomid_laststatus.get(account+roomid, False)
+        if account+roomid in self.accountroomid_laststatus and last_status == is_open:
+            return
+        # Stored also on the first poll, later polls of unchanged data are skipped as not modified
+        self.accountroomid_laststatus[account+roomid] = is_open
         if send_messages and last_status != is_open:
             await bot.send_text(bot.get_room_by_id(roomid), text)
-            self.accountroomid_laststatus[account+roomid] = is_open
-            bot.save_settings()
+        bot.save_settings()
 
     @staticmethod
-    def open_status(spaceurl):
-        with urlopen(spaceurl, timeout=5) as response:
-            js = json.load(response)
-
+    def open_status(js):
         return js['space'], js['state']['open']
 
     def get_settings(self):
@@ -58,8 +60,8 @@ class MatrixModule(PollingService):
             'commands: list, debug, poll, clear, add URL, del URL\n' + \
             '!spaceapi add URL: to add a space-api endpoint\n' + \
             '!spaceapi list: to list the endpoint configured for this room.\n' + \
-            f'I will look for changes roughly every {self.poll_interval_min} ' + \
-            'minutes. Find out more about Space-API at https://spaceapi.io/.'
+            f'I will look for changes every {self.poll_interval_min} to {self.poll_interval_max} ' + \
+            'minutes, less often while nothing changes. Find out more about Space-API at https://spaceapi.io/.'
         if bot.is_owner(event):
             text += '\nA template and I18N can be configured via settings of ' + \
                 'the module. Use "!bot export spacepi", then change the ' + \
@@ -1,14 +1,28 @@
+import asyncio
 import re
 import shlex
-from functools import lru_cache
+import time
 
 import httpx
 import sys
 import traceback
-from bs4 import BeautifulSoup
 from nio import RoomMessageText
 
+from modules.common.localstore import load_json, save_json
+from modules.common.mediasniff import SNIFF_BYTES, describe_file, file_name, is_file_type, read_prefix, total_size
 from modules.common.module import BotModule
+from modules.common.urlpreview import (OEMBED_PROVIDERS, FetchPolicies, PreviewCache, ProviderRegistry, RecentUrls,
+                                      read_head_metadata)
+
+# Policies that apply unless overridden with !url policy
+BUILTIN_POLICIES = {
+    # fix for #98: matrix.to urls are 99.99% pills and should not
+    # spam the channel with matrix.to titles
+    'matrix.to': {'allow': False},
+    'youtube.com': {'user_agent': 'curl/7.64.0'},
+    'youtu.be': {'user_agent': 'curl/7.64.0'},
+    'google.com': {'user_agent': 'curl/7.64.0'},
+}
 
 
 class MatrixModule(BotModule):
@@ -16,8 +30,20 @@ class MatrixModule(BotModule):
     Simple url fetch and spit out title module.
 
     Everytime a url is seen in a message we do http request to it and try to get a title tag contents to spit out to the room.
+
+    Urls are fetched in a background task with a pooled async http client,
+    so slow sites don't block the bot. Urls in one message are fetched
+    concurrently and their previews are sent in the original order.
+
+    Links to images, pdfs and media files get a description of the file,
+    read from its first bytes and a few ranges where the format needs it.
     """
 
+    max_concurrent_fetches = 4  # per message
+    cache_file = 'url_preview_cache.json'
+    cache_save_interval = 300  # seconds
+    default_window = 300  # seconds to not preview the same url again in a room
+
     def __init__(self, name):
         super().__init__(name)
 
@@ -34,6 +60,15 @@ class MatrixModule(BotModule):
             "BOTH": "Spamming this channel with both title and description",
         }
         self.blacklist = [ ]
+        self.blacklist_re = None  # blacklist compiled to one regex
+        self.policies = FetchPolicies(BUILTIN_POLICIES)
+        self.providers = ProviderRegistry(OEMBED_PROVIDERS)
+        self.client = None  # httpx.AsyncClient, shared by all fetches
+        self.tasks = set()  # running preview tasks
+        self.cache = PreviewCache()
+        self.cache_saved = time.monotonic()
+        self.recent = RecentUrls()
+        self.windows = dict()  # room_id -> seconds, if not default_window
         self.enabled = False
 
     def matrix_start(self, bot):
@@ -43,6 +78,7 @@ class MatrixModule(BotModule):
         super().matrix_start(bot)
         self.bot = bot
         bot.client.add_event_callback(self.text_cb, RoomMessageText)
+        self.cache.load_json(load_json(self.cache_file))
         # extend the useragent string to contain version and bot name
         self.useragent = f"Mozilla/5.0 (compatible; Hemppa/{self.bot.version}; {self.bot.client.user}; +https://github.com/vranki/hemppa/)"
         self.logger.debug(f"useragent: {self.useragent}")
@@ -51,21 +87,48 @@ class MatrixModule(BotModule):
     def matrix_stop(self, bot):
         super().matrix_stop(bot)
         bot.remove_callback(self.text_cb)
+        for task in self.tasks:
+            task.cancel()
+        self.recent.pending.clear()
+        self.save_cache()
+        if self.client:
+            try:
+                asyncio.get_running_loop().create_task(self.client.aclose())
+            except RuntimeError:
+                pass  # No loop running, nothing to close
+            self.client = None
+
+    def save_cache(self):
+        if self.cache.dirty:
+            save_json(self.cache_file, self.cache.to_json())
+            self.cache.dirty = False
+        self.cache_saved = time.monotonic()
+
+    async def matrix_poll(self, bot, pollcount):
+        if time.monotonic() - self.cache_saved > self.cache_save_interval:
+            self.save_cache()
+
+    def http_client(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(10.0),
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            )
+        return self.client
+
+    def set_blacklist(self, blacklist):
+        self.blacklist = blacklist
+        self.blacklist_re = re.compile('|'.join(map(re.escape, blacklist))) if blacklist else None
 
-    def user_agent_for_url(self, url):
-        if ('youtube.com' in url) or ('youtu.be' in url) or ('google.com' in url):
-            return 'curl/7.64.0'
-        return self.useragent
-
-    # Currently not used, but for future needs:
-    def cookies_for_url(self, url):
-        if ('youtube.com' in url) or ('youtu.be' in url) or ('google.com' in url):
-            cookies = httpx.Cookies()
-            cookies.set('CONSENT', 'YES', domain='.youtube.com')
-            return cookies
-#            return {'CONSENT': 'YES', 'Domain': '.youtube.com', 
-#                'Path': '/', 'SameSite' : 'None', 'Expires': 'Sun, 10 Jan 2038 07:59:59 GMT', 'Max-Age': '946080000'}
-        return {}
+    def url_allowed(self, url):
+        if not self.policies.policy_for(url)['allow']:
+            self.logger.debug(f"Skipping url denied by policy: {url}")
+            return False
+        if self.blacklist_re and self.blacklist_re.search(url):
+            self.logger.debug(f"Skipping blacklisted url {url}")
+            return False
+        return True
 
     async def text_cb(self, room, event):
         """
@@ -95,39 +158,44 @@ class MatrixModule(BotModule):
         if status == "OFF":
             return
 
-        try:
-            # extract possible urls from message
-            urls = re.findall(r"(https?://\S+)", event.body)
+        # extract possible urls from message
+        urls = re.findall(r"(https?://\S+)", event.body)
 
-            # no urls, nothing to do
-            if len(urls) == 0:
-                return
+        # no urls, nothing to do
+        if len(urls) == 0:
+            return
 
-            # fetch the urls and if we can see a title spit it out
-            for url in urls:
-                # fix for #98 a bit ugly, but skip all matrix.to urls
-                # those are 99.99% pills and should not
-                # spam the channel with matrix.to titles
-                if url.startswith("https://matrix.to/#/"):
-                    self.logger.debug(f"Skipping matrix.to url (#98): {url}")
-                    continue
-
-                url_blacklisted = False
-                for blacklisted in self.blacklist:
-                    if blacklisted in url:
-                        url_blacklisted = True
-                if url_blacklisted:
-                    self.logger.debug(f"Skipping blacklisted url {url}")
-                    continue
+        # skip urls that were just previewed here, without fetching or sending anything
+        window = self.windows.get(room.room_id, self.default_window)
+        fetch_urls = [url for url in dict.fromkeys(urls)
+                      if self.url_allowed(url) and not self.recent.check(room.room_id, url, window)]
+
+        if fetch_urls:
+            # Don't keep the sync loop waiting for slow sites
+            task = asyncio.create_task(self.send_previews(room, fetch_urls, status))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def send_previews(self, room, urls, status):
+        """
+        Fetch the urls concurrently and spit out their titles in the original order
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrent_fetches)
 
+        async def fetch(url):
+            async with semaphore:
                 try:
-                    title, description = self.get_content_from_url(url)
+                    return await self.get_content_from_url(url)
                 except Exception as e:
                     self.logger.warning(f"could not fetch url: {e}")
                     traceback.print_exc(file=sys.stderr)
                     # failed fetching, give up
-                    continue
+                    return (None, None)
 
+        previewed = set()
+        try:
+            results = await asyncio.gather(*(fetch(url) for url in urls))
+            for url, (title, description) in zip(urls, results):
                 msg = ""
 
                 if status == "TITLE" and title is not None:
@@ -145,87 +213,114 @@ class MatrixModule(BotModule):
 
                 if msg.strip(): # Evaluates to true on non-empty strings
                     await self.bot.send_text(room, msg, msgtype=self.type, bot_ignore=True)
+                    previewed.add(url)
         except Exception as e:
-            self.logger.warning(f"Unexpected error in url module text_cb: {e}")
+            self.logger.warning(f"Unexpected error in url module send_previews: {e}")
             traceback.print_exc(file=sys.stderr)
+        finally:
+            # Only urls whose preview was sent are skipped when pasted again
+            for url in urls:
+                self.recent.done(room.room_id, url, url in previewed)
 
-    @lru_cache(maxsize=128)
-    def get_content_from_url(self, url):
+    async def get_content_from_url(self, url):
         """
-        Fetch url and try to get the title and description from the response
+        Get the title and description of url, from cache if possible
         """
-        title = None
-        description = None
-        # timeout will still handle network timeouts
-        timeout = httpx.Timeout(10.0)
-        responsetext = ""  # read our response here
         try:
-            self.logger.debug(f"start streaming {url}")
-            # stream the response so that we can set a upper limit on how much we want to fetch.
-            # as we are using stream the r.text wont be available, save our read data ourself
-
-            # maximum size to read of the response in characters (this prevents us from reading stream forever)
-            maxsize = 800000
-            headers = {
-                'user-agent': self.user_agent_for_url(url)
-            }
-            # Google may break things anytime so here are some things to try:
-            # If needed some day..  'Set-Cookie': "CONSENT=YES; Domain=.youtube.com; Path=/; SameSite=None; Secure; Expires=Sun, 10 Jan 2038 07:59:59 GMT; Max-Age=946080000"
-            # cookies = self.cookies_for_url(url)
-            # print('cookies', url, cookies)
-            # print('headers', headers)
-            with httpx.stream("GET", url, timeout=timeout, headers=headers) as r:
-                for part in r.iter_text():
-                    # self.logger.debug(
-                    #     f"reading response stream, limiting in {maxsize} bytes"
-                    # )
-
-                    responsetext += part
-                    maxsize -= len(part)
-
-                    if maxsize < 0:
-                        break
-
-            self.logger.debug(f"end streaming {url}")
+            return await self.cache.lookup(url, self.fetch_content)
         except Exception as e:
             self.logger.warning(f"Failed fetching url {url}. Error: {e}")
-            return (title, description)
-
-        if r.status_code != 200:
-            self.logger.warning(
-                f"Failed fetching url {url}. Status code: {r.status_code}"
-            )
-            return (title, description)
+            return (None, None)
 
-        # try parse and get the title
-        try:
-            soup = BeautifulSoup(responsetext, "html.parser")
-
-            if soup.title and len(soup.title.string) > 0:
-                title = soup.title.string
-            else:
-                title_tag = soup.find("meta", attrs={"name": "title"})
-                ogtitle = soup.find("meta", property="og:title")
-                if title_tag:
-                    title = title_tag.get("content", None)
-                elif ogtitle:
-                    title = ogtitle["content"]
-                elif soup.head and soup.head.title:
-                    title = soup.head.title.string.strip()
-            descr_tag = soup.find("meta", attrs={"name": "description"})
-            if descr_tag:
-                description = descr_tag.get("content", None)
-        except Exception as e:
-            self.logger.warning(f"Failed parsing response from url {url}. Error: {e}")
-            return (title, description)
+    async def fetch_content(self, url):
+        """
+        Fetch url and try to get the title and description from the response.
+        Raises an exception if fetching fails.
+        """
+        policy, limiter = self.policies.limiter_for(url)
+        wait = limiter.reserve(policy['timeout'])
+        if wait is None:
+            raise ValueError("Too many requests to this domain")
+        if wait:
+            await asyncio.sleep(wait)
+
+        async with limiter.semaphore:
+            title, description = None, None
+            # Sites with an oEmbed endpoint give the title in a few KB of json
+            provider = self.providers.match(url)
+            if provider:
+                try:
+                    title, description = await self.fetch_oembed(provider, url, policy)
+                except (httpx.HTTPError, ValueError) as e:
+                    self.logger.debug(f"{provider.name} oEmbed failed for {url}, falling back to html: {e}")
+            if not title:
+                title, description = await self.fetch_html(url, policy)
 
         # Title should not contain newlines or tabs
         if title is not None:
             assert isinstance(title, str)
+            title = title.strip()
             title = title.replace("\n", "")
             title = title.replace("\t", "")
         return (title, description)
 
+    async def fetch_oembed(self, provider, url, policy):
+        r = await self.http_client().get(provider.endpoint, params=provider.params(url),
+                                         headers={'user-agent': self.useragent}, timeout=policy['timeout'])
+        r.raise_for_status()
+        data = r.json()
+        if not isinstance(data, dict):
+            raise ValueError("Unexpected oEmbed response")
+        self.logger.debug(f"got {provider.name} oEmbed for {url}, {len(r.content)} bytes")
+        return provider.extract(data)
+
+    def request_headers(self, policy):
+        headers = {
+            'user-agent': policy['user_agent'] or self.useragent
+        }
+        if policy['cookies']:
+            headers['cookie'] = '; '.join(f'{name}={value}' for name, value in policy['cookies'].items())
+        return headers
+
+    async def fetch_html(self, url, policy):
+        self.logger.debug(f"start streaming {url}")
+        headers = self.request_headers(policy)
+        # stream the response and parse it as it comes, so that we can
+        # stop as soon as the head has been read
+        async with self.http_client().stream("GET", url, headers=headers, timeout=policy['timeout']) as r:
+            if r.status_code not in (200, 206):
+                raise ValueError(f"Status code: {r.status_code}")
+            content_type = r.headers.get('content-type', '').split(';')[0].strip().lower()
+            if is_file_type(content_type):
+                # Images, pdfs etc. are described from their first bytes
+                data = await read_prefix(r, min(SNIFF_BYTES, policy['max_bytes']))
+                response_headers = r.headers
+            else:
+                # max_bytes limits how much we read in any case (this prevents us from reading stream forever)
+                title, description, read = await read_head_metadata(r, policy['max_bytes'])
+                self.logger.debug(f"end streaming {url}, read {read} bytes")
+                return title, description
+
+        async def read_range(start, length):
+            return await self.fetch_range(url, headers, policy, start, length)
+
+        title = await describe_file(file_name(url, response_headers), content_type, data,
+                                    total_size(response_headers), read_range)
+        self.logger.debug(f"end streaming {url}, described {content_type} from {len(data)} bytes")
+        return title, None
+
+    async def fetch_range(self, url, headers, policy, start, length):
+        """
+        Fetch length bytes of url from offset start with a Range request.
+        Returns None if the server doesn't support ranges.
+        """
+        headers = dict(headers, range=f'bytes={start}-{start + length - 1}')
+        async with self.http_client().stream("GET", url, headers=headers, timeout=policy['timeout']) as r:
+            if r.status_code != 206:
+                # Whole file would be sent, don't read it
+                return None
+            return await read_prefix(r, length)
+
     async def matrix_message(self, bot, room, event):
         """
         commands for setting what to do in this channel
@@ -246,7 +341,10 @@ class MatrixModule(BotModule):
 
         # show status
         elif len(args) == 1 and args[0] == "status":
-            status = self.STATUSES.get(self.status.get(room.room_id, "OFF")) + f', URL blacklist: {self.blacklist}'
+            status = self.STATUSES.get(self.status.get(room.room_id, "OFF")) + f', URL blacklist: {self.blacklist}' \
+                + f', repeat window: {self.windows.get(room.room_id, self.default_window)}s' \
+                + f' ({self.recent.suppressed} repeated urls skipped)' \
+                + f', preview cache: {self.cache.stats()}'
             await bot.send_text(
                 room, status
             )
@@ -272,13 +370,76 @@ class MatrixModule(BotModule):
         elif len(args) == 2 and args[0] == "blacklist":
             bot.must_be_owner(event)
             if args[1] == 'clear':
-                self.blacklist = []
+                self.set_blacklist([])
             else:
-                self.blacklist = args[1].split(',')
+                self.set_blacklist(args[1].split(','))
             bot.save_settings()
             await bot.send_text(room, f"Blacklisted URLs set to {self.blacklist}")
             return
 
+        # list fetch policies
+        elif len(args) == 2 and args[0] == "policy" and args[1] == "list":
+            policies = [f" - {domain}: {policy}" for domain, policy in sorted(self.policies.custom.items())]
+            builtin = [f" - {domain}: {policy}" for domain, policy in sorted(self.policies.builtin.items())]
+            await bot.send_text(room, "Fetch policies:\n" + "\n".join(policies or [" (none)"])
+                                + "\nBuilt in:\n" + "\n".join(builtin)
+                                + f"\nDefaults: {self.policies.DEFAULT_POLICY}")
+            return
+
+        # delete fetch policy
+        elif len(args) == 3 and args[0] == "policy" and args[1] == "del":
+            bot.must_be_owner(event)
+            if self.policies.delete(args[2]):
+                bot.save_settings()
+                await bot.send_text(room, f"Deleted fetch policy for {args[2]}")
+            else:
+                await bot.send_text(room, f"No fetch policy for {args[2]}")
+            return
+
+        # set fetch policy
+        elif len(args) >= 3 and args[0] == "policy":
+            bot.must_be_owner(event)
+            try:
+                policy = FetchPolicies.parse(args[2:])
+            except ValueError as e:
+                await bot.send_text(room, str(e))
+                return
+            self.policies.set(args[1], policy)
+            bot.save_settings()
+            await bot.send_text(room, f"Fetch policy for {args[1].lower()} set to {policy}")
+            return
+
+        # set how long the same url is not previewed again in this room
+        elif len(args) == 2 and args[0] == "window":
+            if not args[1].isdigit():
+                await bot.send_text(room, "Usage: !url window [seconds], 0 to always preview")
+                return
+            self.windows[room.room_id] = int(args[1])
+            self.recent.clear_room(room.room_id)
+            bot.save_settings()
+            await bot.send_text(room, f"Not previewing the same url again in this room for {int(args[1])} seconds")
+            return
+
+        # clear preview cache
+        elif len(args) == 2 and args[0] == "cache" and args[1] == "clear":
+            bot.must_be_owner(event)
+            self.cache.clear()
+            self.save_cache()
+            await bot.send_text(room, "Preview cache cleared")
+            return
+
+        # set how long previews of a domain are cached
+        elif len(args) == 4 and args[0] == "cache" and args[1] == "ttl":
+            bot.must_be_owner(event)
+            if not args[3].isdigit():
+                await bot.send_text(room, "Usage: !url cache ttl [domain] [seconds], 0 to not cache")
+                return
+            domain = args[2].lower()
+            self.cache.ttls[domain] = int(args[3])
+            bot.save_settings()
+            await bot.send_text(room, f"Caching previews from {domain} for {int(args[3])} seconds")
+            return
+
         # invalid command
         await bot.send_text(
             room,
@@ -292,6 +453,9 @@ class MatrixModule(BotModule):
         data["status"] = self.status
         data["type"] = self.type
         data["blacklist"] = self.blacklist
+        data["cache_ttls"] = self.cache.ttls
+        data["policies"] = self.policies.custom
+        data["windows"] = self.windows
         return data
 
     def set_settings(self, data):
@@ -301,7 +465,14 @@ class MatrixModule(BotModule):
         if data.get("type"):
             self.type = data["type"]
         if data.get("blacklist"):
-            self.blacklist = data["blacklist"]
+            self.set_blacklist(data["blacklist"])
+        if data.get("policies"):
+            self.policies.custom = data["policies"]
+            self.policies.compile()
+        if data.get("windows"):
+            self.windows = data["windows"]
+        if data.get("cache_ttls"):
+            self.cache.ttls = data["cache_ttls"]
 
     def help(self):
         return "If I see a url in a message I will try to get the title from the page and spit it out"
@@ -1,10 +1,94 @@
+from modules.common.bulkjob import BulkJob, send_once
 from modules.common.module import BotModule
+from nio import Api, RoomKickResponse
+import collections
 import fnmatch
+import re
+
+
+def homeserver_pattern(pattern):
+    """Return homeserver if wildcard pattern matches exactly the users of one homeserver (@*:hs), else None"""
+    for prefix in ('@*:', '*:'):
+        if pattern.startswith(prefix):
+            hs = pattern[len(prefix):]
+            # All digit suffix would be a port, matching users of many homeservers
+            if hs and not hs.isdigit() and not any(c in hs for c in '*?[:'):
+                return hs
+    return None
+
+
+def filter_users(users, pattern):
+    """fnmatch.filter, but checks the homeserver suffix directly for @*:hs patterns"""
+    hs = homeserver_pattern(pattern)
+    if hs is not None:
+        suffix = ':' + hs
+        return [user for user in users if user.endswith(suffix)]
+    return fnmatch.filter(users, pattern)
+
+
+def translate_pattern(pattern, prefix):
+    """
+    fnmatch.translate, with the names of groups it uses internally prefixed,
+    so that several translated patterns can be joined into one regex
+    """
+    return re.sub(r'\(\?P([<=])', r'(?P\1' + prefix, fnmatch.translate(pattern))
+
+
+class UserClassifier:
+    """Classifies mxid's by the user classes
+
+    Patterns of the form @*:hs are looked up by homeserver, the rest are
+    compiled into a single regex. A user belongs to the first class (in
+    insertion order) whose pattern matches. Results are cached per user
+    until the classes change.
+    """
+
+    max_cache = 500000
+
+    def __init__(self, classes):
+        self.order = list(classes)
+        self.homeservers = dict()  # homeserver -> class index
+        regexes = []
+        for index, (name, pattern) in enumerate(classes.items()):
+            hs = homeserver_pattern(pattern)
+            if hs is not None:
+                self.homeservers.setdefault(hs, index)
+            else:
+                regexes.append(f'(?P<c{index}>{translate_pattern(pattern, f"c{index}_")})')
+        self.regex = re.compile('|'.join(regexes)) if regexes else None
+        self.cache = dict()
+
+    def classify(self, user):
+        """Return class name of user, or None if no class matches"""
+        try:
+            return self.cache[user]
+        except KeyError:
+            pass
+        index = self.homeservers.get(user.split(':', 1)[1] if ':' in user else '')
+        if self.regex:
+            match = self.regex.match(user)
+            if match:
+                regex_index = int(match.lastgroup[1:])
+                if index is None or regex_index < index:
+                    index = regex_index
+        name = None if index is None else self.order[index]
+        if len(self.cache) >= self.max_cache:
+            self.cache.clear()
+        self.cache[user] = name
+        return name
+
+    def stats(self, users):
+        """Return Counter of class name -> number of users, None for unclassified users"""
+        cache, classify = self.cache, self.classify
+        return collections.Counter([cache[user] if user in cache else classify(user) for user in users])
+
 
 class MatrixModule(BotModule):
     def __init__(self, name):
         super().__init__(name)
         self.classes = dict() # classname <-> pattern
+        self.classifier = UserClassifier(self.classes)
+        self.kick_jobs = dict()  # room id -> running BulkJob
         self.enabled = False
 
     async def matrix_message(self, bot, room, event):
@@ -13,9 +97,6 @@ class MatrixModule(BotModule):
 
         if len(args) == 1:
             if args[0] == 'stats' or args[0] == 'roomstats':
-                stats = dict()
-                for name, pattern in self.classes.items():
-                    stats[name] = 0
                 if args[0] == 'stats':
                     allusers = self.get_users(bot)
                 else:
@@ -25,15 +106,9 @@ class MatrixModule(BotModule):
                     await bot.send_text(room, "I don't see any users. How did this happen?")
                     return
 
-                matched = 0
-                for user in allusers:
-                    for name, pattern in self.classes.items():
-                        match = fnmatch.fnmatch(user, pattern)
-                        if match:
-                            stats[name] = stats[name] + 1
-                            matched = matched + 1
-                
-                stats['Matrix'] = total - matched
+                counts = self.classifier.stats(allusers)
+                stats = {name: counts[name] for name in self.classes}
+                stats['Matrix'] = counts[None]
                 stats = dict(sorted(stats.items(), key=lambda item: item[1], reverse=True))
 
                 if args[0] == 'stats':
@@ -52,7 +127,7 @@ class MatrixModule(BotModule):
                 if args[0] == 'list':
                     search_room = room.room_id
                 allusers = self.get_users(bot, search_room)
-                users = fnmatch.filter(allusers, args[1])
+                users = filter_users(allusers, args[1])
                 if len(users):
                     await bot.send_text(room, ' '.join(users))
                 else:
@@ -60,14 +135,14 @@ class MatrixModule(BotModule):
                 return
             if args[0] == 'kick':
                 bot.must_be_admin(room, event)
-                allusers = self.get_users(bot, room.room_id)
-                users = fnmatch.filter(allusers, args[1])
-                if len(users):
-                    for user in users:
-                        self.logger.debug(f"Kicking {user} from {room.room_id} as requested by {event.sender}")
-                        await bot.client.room_kick(room.room_id, user)
-                else:
-                    await bot.send_text(room, 'No matching users found!')
+                if args[1] == 'cancel':
+                    job = self.kick_jobs.get(room.room_id)
+                    if job:
+                        job.cancel()
+                    else:
+                        await bot.send_text(room, 'No kick in progress in this room.')
+                    return
+                await self.kick(bot, room, event, args[1])
                 return
             if args[0] == 'classify':
                 if args[1] == 'list':
@@ -80,38 +155,54 @@ class MatrixModule(BotModule):
                     name = args[2]
                     pattern = args[3]
                     self.classes[name] = pattern
+                    self.classifier = UserClassifier(self.classes)
                     await bot.send_text(room, f'Added class {name} pattern {pattern}.')
                     bot.save_settings()
                     return
         elif len(args) == 3:
+            if args[0] == 'kick' and args[2] == 'dryrun':
+                bot.must_be_admin(room, event)
+                await self.kick(bot, room, event, args[1], dry_run=True)
+                return
             if args[0] == 'classify':
                 if args[1] == 'del':
                     bot.must_be_owner(event)
                     name = args[2]
                     del self.classes[name]
+                    self.classifier = UserClassifier(self.classes)
                     await bot.send_text(room, f'Deleted class {name}.')
                     bot.save_settings()
                     return
 
         await bot.send_text(room, 'Unknown command - please see readme')
 
+    async def kick(self, bot, room, event, pattern, dry_run=False):
+        if room.room_id in self.kick_jobs:
+            await bot.send_text(room, 'Kick already in progress in this room, cancel it first.')
+            return
+        # Never kick the bot itself or whoever asked
+        users = [user for user in filter_users(self.get_users(bot, room.room_id), pattern)
+                 if user not in (bot.matrix_user, event.sender)]
+        if not users:
+            await bot.send_text(room, 'No matching users found!')
+            return
+        self.logger.info(f"Kicking {len(users)} users matching {pattern} from {room.room_id} as requested by {event.sender}")
+
+        async def kick_user(user):
+            self.logger.debug(f"Kicking {user} from {room.room_id} as requested by {event.sender}")
+            return await send_once(bot.client, RoomKickResponse, *Api.room_kick(bot.client.access_token, room.room_id, user))
+
+        job = BulkJob(bot, room, 'Kicking', users, kick_user, self.logger, dry_run=dry_run, cancel_command='!users kick cancel')
+        self.kick_jobs[room.room_id] = job
+        # Run in background so that syncing (and cancel) isn't blocked
+        job.start().add_done_callback(lambda task: self.kick_jobs.pop(room.room_id, None))
+
     def get_users(self, bot, roomid=None):
-        allusers = []
-        for croomid in self.bot.client.rooms:
-            if not roomid or (roomid == croomid):
-                try:
-                    users = self.bot.client.rooms[croomid].users
-                except (KeyError, ValueError) as e:
-                    self.logger.warning(f"Couldn't get user list in room with id {croomid}, skipping: {repr(e)}")
-                    continue
-                for user in users:
-                    allusers.append(user)
-        allusers = list(dict.fromkeys(allusers)) # Deduplicate
-        return allusers
+        return self.bot.members.users(roomid)
 
     def search_users(self, bot, pattern):
-        allusers = self.get_users(self, bot)
-        return fnmatch.filter(allusers, pattern)
+        allusers = self.get_users(bot)
+        return filter_users(allusers, pattern)
 
     def help(self):
         return 'User management tools'
@@ -125,7 +216,13 @@ class MatrixModule(BotModule):
         super().set_settings(data)
         if data.get("classes"):
             self.classes = data["classes"]
+            self.classifier = UserClassifier(self.classes)
 
     def matrix_start(self, bot):
         super().matrix_start(bot)
-        self.bot = bot
\ No newline at end of file
+        self.bot = bot
+
+    def matrix_stop(self, bot):
+        super().matrix_stop(bot)
+        for job in list(self.kick_jobs.values()):
+            job.cancel()
\ No newline at end of file
@@ -1,5 +1,9 @@
-import itertools
+import collections
 import shlex
+import time
+
+from nio import RoomMemberEvent
+
 from modules.common.module import BotModule
 
 
@@ -7,12 +11,33 @@ class MatrixModule(BotModule):
     """
     Detect new users who join the provided room, DM them a welcome message, and
     alert bot owners that a new user has been welcomed.
+
+    Joins and departures are picked up from membership events and queued.
+    The queue is drained on poll, a few welcomes at a time, and owners get
+    one notification per room for each batch. Per room, only the timestamp
+    of the last handled membership event is stored.
     """
 
+    welcomes_per_poll = 5
+    recently_welcomed_max = 1000
+    handled_events_max = 1000
+
     def __init__(self, name):
         super().__init__(name)
         self.enabled = False
         self.rooms = dict()
+        self.welcome_queue = collections.deque()  # (room id, mxid) to welcome
+        self.departures = collections.defaultdict(list)  # room id -> [mxid, ..] left since last poll
+        self.recently_welcomed = collections.OrderedDict()  # (room id, mxid) -> None, bounded
+        self.handled_events = collections.OrderedDict()  # membership event id -> None, bounded
+
+    def matrix_start(self, bot):
+        super().matrix_start(bot)
+        bot.client.add_event_callback(self.member_cb, RoomMemberEvent)
+
+    def matrix_stop(self, bot):
+        super().matrix_stop(bot)
+        bot.remove_callback(self.member_cb)
 
     async def matrix_message(self, bot, room, event):
         bot.must_be_owner(event)
@@ -21,12 +46,10 @@ class MatrixModule(BotModule):
         # Message body possibilities:
         #   ["welcome_message", "notify_departure", "settings"]
         if args[0] == "welcome_message":
-            users = bot.client.rooms[room.room_id].users
             welcome_settings = {
-                "last_room_user_count": len(users),
-                "last_room_users": [username for username in users],
                 "welcome_message": event.body.split("welcome_message", 1)[1],
-                "notify_departure": False
+                "notify_departure": False,
+                "last_event_ts": int(time.time() * 1000)
             }
             self.rooms[room.room_id] = welcome_settings
             bot.save_settings()
@@ -48,77 +71,81 @@ class MatrixModule(BotModule):
         super().set_settings(data)
         if data.get("rooms"):
             self.rooms = data["rooms"]
+            for welcome_settings in self.rooms.values():
+                # Full member lists were stored by earlier versions
+                welcome_settings.pop("last_room_users", None)
+                welcome_settings.pop("last_room_user_count", None)
+                welcome_settings.setdefault("last_event_ts", 0)
 
-    async def matrix_poll(self, bot, pollcount):
-        for room_id in self.rooms:
-            if room_id in bot.client.rooms:
-                welcome_parameters = self.rooms[room_id]
-                newcomer_room_users = bot.client.rooms[room_id].users
-                newcomer_room_user_delta = self.get_user_list_delta(
-                    newcomer_room_users,
-                    welcome_parameters["last_room_users"]
-                )
-                self.rooms[room_id]["last_room_user_count"] = len(newcomer_room_users)
-                self.rooms[room_id]["last_room_users"] = [u for u in newcomer_room_users]
-
-                if pollcount != 1:
-                    new_users = newcomer_room_user_delta.get("recently_added", [])
-                    if welcome_parameters["notify_departure"] and \
-                            len(newcomer_room_user_delta.get("recently_removed")) > 0:
-                        for owner in bot.owners:
-                            await bot.send_msg(
-                                owner,
-                                "Welcome Bot",
-                                "User {user_left} left {channel}".format(
-                                    user_left=newcomer_room_user_delta.get("recently_removed"),
-                                    channel=bot.client.rooms[room_id].display_name
-                                )
-                            )
-                    await self.welcome_users(
-                        new_users,
-                        welcome_parameters["welcome_message"],
-                        bot,
-                        bot.client.rooms[room_id].display_name
-                    )
+    async def member_cb(self, room, event):
+        welcome_settings = self.rooms.get(room.room_id)
+        if not welcome_settings or not self.enabled:
+            return
+        # Events may be delivered again, e.g. after a limited sync. Not by timestamp,
+        # with clock skew between servers joins may arrive older than handled ones
+        if event.event_id in self.handled_events:
+            return
+        self.handled_events[event.event_id] = None
+        if len(self.handled_events) > self.handled_events_max:
+            self.handled_events.popitem(last=False)
+        welcome_settings["last_event_ts"] = max(welcome_settings["last_event_ts"], event.server_timestamp)
 
-    def help(self):
-        return "Poll for new users in the room and welcome them"
+        if event.membership == "join" and event.prev_membership != "join":
+            key = (room.room_id, event.state_key)
+            if key not in self.recently_welcomed:
+                self.recently_welcomed[key] = None
+                if len(self.recently_welcomed) > self.recently_welcomed_max:
+                    self.recently_welcomed.popitem(last=False)
+                self.welcome_queue.append(key)
+        elif event.membership in ("leave", "ban") and event.prev_membership == "join":
+            if welcome_settings["notify_departure"]:
+                self.departures[room.room_id].append(event.state_key)
 
-    async def welcome_users(self, user_list, message, bot, roomname):
-        for user in user_list:
-            await bot.send_msg(
-                user,
-                "Welcome",
-                message
-            )
-        if len(user_list) > 0:
+    async def matrix_poll(self, bot, pollcount):
+        if not self.welcome_queue and not self.departures:
+            return
+
+        for room_id, users in self.departures.items():
+            room = bot.client.rooms.get(room_id)
+            if room is None:
+                continue
             for owner in bot.owners:
                 await bot.send_msg(
                     owner,
                     "Welcome Bot",
-                    "Sent a welcome message from {channel} to: {users}".format(
-                        users=user_list,
-                        channel=roomname
+                    "User {user_left} left {channel}".format(
+                        user_left=users,
+                        channel=room.display_name
                     )
                 )
+        self.departures.clear()
+
+        welcomed = collections.defaultdict(list)  # room id -> [mxid, ..]
+        while self.welcome_queue and sum(len(users) for users in welcomed.values()) < self.welcomes_per_poll:
+            room_id, user = self.welcome_queue.popleft()
+            room = bot.client.rooms.get(room_id)
+            welcome_settings = self.rooms.get(room_id)
+            # Skip users who already left again
+            if room is None or welcome_settings is None or user not in room.users:
+                continue
+            await bot.send_msg(user, "Welcome", welcome_settings["welcome_message"])
+            welcomed[room_id].append(user)
+
+        for room_id, users in welcomed.items():
+            await self.notify_owners(users, bot, bot.client.rooms[room_id].display_name)
+        # Store the watermarks
+        bot.save_settings()
 
-    def get_user_list_delta(
-        self,
-        current_user_list,
-        previous_user_list
-    ):
-        recently_added = list(itertools.filterfalse(
-            lambda u: u in previous_user_list,
-            current_user_list
-        ))
-        recently_removed = list(itertools.filterfalse(
-            lambda u: u in current_user_list,
-            previous_user_list
-        ))
-        total_change = len(recently_added) + len(recently_removed)
-
-        return {
-            "total_change": total_change,
-            "recently_removed": recently_removed,
-            "recently_added": recently_added
-        }
+    def help(self):
+        return "Watch for new users in the room and welcome them"
+
+    async def notify_owners(self, user_list, bot, roomname):
+        for owner in bot.owners:
+            await bot.send_msg(
+                owner,
+                "Welcome Bot",
+                "Sent a welcome message from {channel} to: {users}".format(
+                    users=user_list,
+                    channel=roomname
+                )
+            )
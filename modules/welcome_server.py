@@ -1,7 +1,9 @@
 import os
-import itertools
 import shlex
-import requests
+import time
+
+import httpx
+
 from modules.common.module import BotModule
 
 
@@ -10,33 +12,50 @@ class MatrixModule(BotModule):
     Detect new users who join the server, DM them a welcome message, and alert
     bot owners that a new user has been welcomed.
 
+    Users are listed newest first by creation_ts, one page at a time, until
+    a user older than the stored watermark is seen. Only the watermark (the
+    newest creation_ts seen and the users created at that moment) is kept
+    in settings.
+
     Note: This module will only work if the bot is a server admin. This
     privilege level has risks.
     """
 
+    page_size = 100
+    max_new_users = 50  # More new users than this in one poll is suspicious, don't welcome them
+    default_poll_interval = 60  # seconds
+
     def __init__(self, name):
         super().__init__(name)
         self.enabled = False
         self.access_token = os.getenv("MATRIX_ACCESS_TOKEN")
         self.welcome_settings = dict()
+        self.last_poll = 0
 
     async def matrix_message(self, bot, room, event):
         bot.must_be_owner(event)
         args = shlex.split(event.body)
         args.pop(0)
         # Message body possibilities:
-        #   ["welcome_message", "query_host", "settings"]
+        #   ["welcome_message", "poll_interval", "settings"]
         if args[0] == "welcome_message":
-            welcome_settings = {"user_query_host": os.getenv("MATRIX_SERVER")}
-            users = self.get_server_user_list()
-            welcome_settings.update({
-                "last_server_user_count": len(users),
-                "last_server_users": users,
-                "welcome_message": event.body.split("welcome_message", 1)[1] 
-            })
+            welcome_settings = {
+                "user_query_host": os.getenv("MATRIX_SERVER"),
+                "welcome_message": event.body.split("welcome_message", 1)[1],
+                "poll_interval": self.welcome_settings.get("poll_interval", self.default_poll_interval)
+            }
             self.welcome_settings = welcome_settings
+            # Start from the newest current user, existing users are not welcomed
+            await self.get_new_users()
             bot.save_settings()
             await bot.send_text(room, "Welcome settings configured for server: {settings}".format(settings=welcome_settings))
+        elif args[0] == "poll_interval":
+            if len(args) != 2 or not args[1].isdigit() or int(args[1]) < 1:
+                await bot.send_text(room, "Usage: !welcome_server poll_interval [seconds], at least 1 second")
+                return
+            self.welcome_settings["poll_interval"] = int(args[1])
+            bot.save_settings()
+            await bot.send_text(room, "Polling for new server users every {interval} seconds".format(interval=int(args[1])))
         elif args[0] == "settings":
             await bot.send_text(room, "Welcome settings for server: {settings}".format(settings=self.welcome_settings))
 
@@ -49,14 +68,30 @@ class MatrixModule(BotModule):
         super().set_settings(data)
         if data.get("welcome_settings"):
             self.welcome_settings = data["welcome_settings"]
+            # Full user lists were stored by earlier versions
+            self.welcome_settings.pop("last_server_users", None)
+            self.welcome_settings.pop("last_server_user_count", None)
 
     async def matrix_poll(self, bot, pollcount):
-        server_user_delta = self.get_server_user_delta(bot)
+        if not self.welcome_settings.get("welcome_message"):
+            return
+        now = time.monotonic()
+        if now - self.last_poll < self.welcome_settings.get("poll_interval", self.default_poll_interval):
+            return
+        self.last_poll = now
 
-        # The first time this bot runs it will detect all users as new, so
-        # allow it to one once without taking action.
-        if pollcount != 1:
-            new_users = server_user_delta.get("recently_added", [])
+        first_run = "watermark_ts" not in self.welcome_settings
+        try:
+            new_users = await self.get_new_users()
+        except (httpx.HTTPError, ValueError) as e:
+            self.logger.warning(f"Failed to get new server users: {repr(e)}")
+            return
+        if first_run:
+            # Nothing to compare against, don't welcome everybody
+            bot.save_settings()
+            return
+        if new_users:
+            bot.save_settings()
             await self.welcome_users(
                 new_users,
                 self.welcome_settings["welcome_message"],
@@ -67,8 +102,17 @@ class MatrixModule(BotModule):
         return "Poll for new users on the server and welcome them"
 
     async def welcome_users(self, user_list, message, bot):
-        if len(user_list) > 1:
-            print(user_list)
+        if len(user_list) > self.max_new_users:
+            self.logger.warning(f"Not welcoming {len(user_list)} new server users, too many at once: {user_list}")
+            for owner in bot.owners:
+                await bot.send_msg(
+                    owner,
+                    "Welcome Bot",
+                    "Did not welcome {count} new server users, too many at once: {users}".format(
+                        count=len(user_list),
+                        users=user_list
+                    )
+                )
             return
         for user in user_list:
             await bot.send_msg(
@@ -86,49 +130,64 @@ class MatrixModule(BotModule):
                     )
                 )
 
-    def get_user_list_delta(
-        self,
-        current_user_list,
-        previous_user_list
-    ):
-        recently_added = list(itertools.filterfalse(
-            lambda u: u in previous_user_list,
-            current_user_list
-        ))
-        recently_removed = list(itertools.filterfalse(
-            lambda u: u in current_user_list,
-            previous_user_list
-        ))
-        total_change = len(recently_added) + len(recently_removed)
-
-        return {
-            "total_change": total_change,
-            "recently_removed": recently_removed,
-            "recently_added": recently_added
-        }
-
-    def get_server_user_delta(self, bot):
+    async def get_new_users(self):
         """
-        Get the full user list for the server and return the change in users
-        since the last run.
+        Page through server users newest first until reaching the watermark.
+        Moves the watermark to the newest user and returns the users created
+        after the previous watermark, oldest first.
         """
-        user_list = self.get_server_user_list()
-        user_delta = self.get_user_list_delta(
-            user_list,
-            self.welcome_settings["last_server_users"]
-        )
-        self.welcome_settings["last_server_users"] = [u for u in user_list]
-        self.welcome_settings["last_server_user_count"] = len(user_list)
-        bot.save_settings()
-        return user_delta
-
-    def get_server_user_list(self):
-        user_data = requests.get(
-            self.welcome_settings["user_query_host"] + "/_synapse/admin/v2/users",
-            headers={"Authorization": "Bearer {token}".format(
-                token=self.access_token
-            )}
-        )
-        user_data_json = user_data.json()
-        user_list = [u.get("name") for u in user_data_json.get("users", [])]
-        return user_list
+        watermark_ts = self.welcome_settings.get("watermark_ts")
+        watermark_users = set(self.welcome_settings.get("watermark_users", []))
+        new_users = []
+        newest_ts = None
+        newest_users = []
+        params = {"order_by": "creation_ts", "dir": "b", "limit": self.page_size}
+
+        async with httpx.AsyncClient(timeout=30) as client:
+            while True:
+                response = await client.get(
+                    self.welcome_settings["user_query_host"] + "/_synapse/admin/v2/users",
+                    params=params,
+                    headers={"Authorization": "Bearer {token}".format(
+                        token=self.access_token
+                    )}
+                )
+                response.raise_for_status()
+                user_data_json = response.json()
+                users = user_data_json.get("users", [])
+
+                reached_watermark = False
+                for user in users:
+                    name = user.get("name")
+                    creation_ts = user.get("creation_ts") or 0
+                    if newest_ts is None:
+                        newest_ts = creation_ts
+                    if creation_ts == newest_ts:
+                        newest_users.append(name)
+                    if watermark_ts is None:
+                        # First run, just find all the newest users
+                        if creation_ts < newest_ts:
+                            reached_watermark = True
+                            break
+                        continue
+                    if creation_ts < watermark_ts:
+                        reached_watermark = True
+                        break
+                    if creation_ts == watermark_ts and name in watermark_users:
+                        continue
+                    new_users.append(name)
+
+                if reached_watermark or not user_data_json.get("next_token"):
+                    break
+                params["from"] = user_data_json["next_token"]
+
+        if newest_ts is not None:
+            if newest_ts == watermark_ts:
+                newest_users.extend(watermark_users.difference(newest_users))
+            self.welcome_settings["watermark_ts"] = newest_ts
+            self.welcome_settings["watermark_users"] = newest_users
+        else:
+            self.welcome_settings.setdefault("watermark_ts", 0)
+            self.welcome_settings.setdefault("watermark_users", [])
+        new_users.reverse()
+        return new_users
@@ -0,0 +1,150 @@
+import asyncio
+import struct
+import unittest
+
+from modules.common.mediasniff import describe_file, id3_tag, image_size, jpeg_scan, mp3_duration, mp4_scan, seek_scan
+
+PNG = b'\x89PNG\r\n\x1a\n' + struct.pack('>I4sII', 13, b'IHDR', 800, 600) + b'\x08\x02\x00\x00\x00'
+GIF = b'GIF89a' + struct.pack('<HH', 320, 200) + b'\xf7\x00\x00'
+BMP = b'BM' + b'\0' * 16 + struct.pack('<ii', 64, -32) + b'\x01\x00\x18\x00'
+WEBP_VP8 = b'RIFF\0\0\0\0WEBPVP8 \0\0\0\0' + b'\0\0\0' + b'\x9d\x01\x2a' + struct.pack('<HH', 640, 480)
+WEBP_VP8L = b'RIFF\0\0\0\0WEBPVP8L\0\0\0\0\x2f' + struct.pack('<I', (100 - 1) | ((50 - 1) << 14))
+WEBP_VP8X = b'RIFF\0\0\0\0WEBPVP8X\0\0\0\0' + b'\0\0\0\0' + (1919).to_bytes(3, 'little') + (1079).to_bytes(3, 'little')
+
+
+def jpeg(app_size=16, width=1024, height=768):
+    app = b'\xff\xe0' + struct.pack('>H', app_size) + b'\0' * (app_size - 2)
+    sof = b'\xff\xc0' + struct.pack('>HBHH', 17, 8, height, width) + b'\x03' + b'\0' * 9
+    return b'\xff\xd8' + app + sof + b'\xff\xda'
+
+
+def mp4(duration=90, timescale=1000, free=0):
+    mvhd_body = b'\0\0\0\0' + b'\0' * 8 + struct.pack('>II', timescale, duration * timescale) + b'\0' * 80
+    mvhd = struct.pack('>I4s', 8 + len(mvhd_body), b'mvhd') + mvhd_body
+    moov = struct.pack('>I4s', 8 + len(mvhd), b'moov') + mvhd
+    ftyp = struct.pack('>I4s', 16, b'ftyp') + b'isom\0\0\0\0'
+    mdat = struct.pack('>I4s', 8 + free, b'mdat') + b'\0' * free
+    return ftyp + mdat + moov
+
+
+def id3(frames, major=3, flags=0):
+    body = b''.join(struct.pack('>4sIH', frame_id, len(text) + 1, 0) + b'\x03' + text.encode()
+                    for frame_id, text in frames)
+    size = len(body)
+    synchsafe = bytes([(size >> 21) & 0x7f, (size >> 14) & 0x7f, (size >> 7) & 0x7f, size & 0x7f])
+    return b'ID3' + bytes([major, 0, flags]) + synchsafe + body
+
+
+def describe(name, content_type, data, size=None, file=None):
+    """describe_file with range reads served from file"""
+    async def read_range(start, length):
+        return file[start:start + length] if file is not None else None
+    return asyncio.run(describe_file(name, content_type, data, size, read_range))
+
+
+class ImageSizeTest(unittest.TestCase):
+    def test_formats(self):
+        self.assertEqual(image_size(PNG), ('PNG', 800, 600))
+        self.assertEqual(image_size(GIF), ('GIF', 320, 200))
+        self.assertEqual(image_size(BMP), ('BMP', 64, 32))
+        self.assertEqual(image_size(WEBP_VP8), ('WebP', 640, 480))
+        self.assertEqual(image_size(WEBP_VP8L), ('WebP', 100, 50))
+        self.assertEqual(image_size(WEBP_VP8X), ('WebP', 1920, 1080))
+
+    def test_truncated(self):
+        # Shortest prefix with the dimensions
+        for data, needed in ((PNG, 24), (GIF, 10), (BMP, 26), (WEBP_VP8, 30), (WEBP_VP8L, 25), (WEBP_VP8X, 30)):
+            for length in range(needed):
+                self.assertIsNone(image_size(data[:length]), (data, length))
+            self.assertIsNotNone(image_size(data[:needed]))
+
+    def test_corrupt(self):
+        self.assertIsNone(image_size(PNG[:12] + b'IDAT' + PNG[16:]))
+        self.assertIsNone(image_size(b'BM' + b'\0' * 16 + struct.pack('<ii', -64, 32)))
+        self.assertIsNone(image_size(b'RIFF\0\0\0\0WEBPVP8 ' + b'\0' * 20))
+        self.assertIsNone(image_size(b'not an image at all'))
+        self.assertIsNone(image_size(b''))
+
+
+class JpegTest(unittest.TestCase):
+    def test_dimensions(self):
+        self.assertEqual(jpeg_scan(jpeg(), 0), ((1024, 768), None))
+
+    def test_frame_header_after_data(self):
+        # A large exif segment pushes the frame header past the sniffed bytes
+        data = jpeg(app_size=20000)
+        self.assertEqual(jpeg_scan(data[:4096], 0), (None, 20004))
+        self.assertEqual(describe('a.jpg', 'image/jpeg', data[:4096], len(data), data), 'a.jpg (JPEG image, 1024x768, 19.6 KiB)')
+
+    def test_truncated(self):
+        data = jpeg()
+        sof_end = data.index(b'\xff\xc0') + 9
+        for length in range(sof_end):
+            dimensions, _ = jpeg_scan(data[:length], 0)
+            self.assertIsNone(dimensions)
+        self.assertEqual(jpeg_scan(data[:sof_end], 0), ((1024, 768), None))
+        self.assertEqual(describe('a.jpg', 'image/jpeg', data[:10], None), 'a.jpg (JPEG image)')
+
+    def test_corrupt(self):
+        self.assertEqual(jpeg_scan(b'\xff\xd8\x00\x00\x00\x00', 0), (None, None))
+        # Zero length segments must not loop forever
+        self.assertEqual(describe('a.jpg', 'image/jpeg', b'\xff\xd8' + b'\xff\xe0\x00\x00' * 10, None), 'a.jpg (JPEG image)')
+
+
+class Mp4Test(unittest.TestCase):
+    def test_duration(self):
+        self.assertEqual(mp4_scan(mp4(), 0), (90, None))
+        self.assertEqual(describe('a.mp4', 'video/mp4', mp4()), 'a.mp4 (MP4 video, 1:30)')
+
+    def test_moov_after_data(self):
+        data = mp4(duration=3725, free=100000)
+        self.assertEqual(describe('a.mp4', 'video/mp4', data[:4096], len(data), data),
+                         f'a.mp4 (MP4 video, 1:02:05, {len(data) / 1024:.1f} KiB)')
+
+    def test_truncated_and_corrupt(self):
+        data = mp4()
+        for length in range(len(data)):
+            duration, _ = mp4_scan(data[:length], 0)
+            self.assertIn(duration, (None, 90))
+        self.assertEqual(mp4_scan(struct.pack('>I4s', 4, b'free') + b'\0' * 8, 0), (None, None))
+        self.assertEqual(describe('a.mp4', 'video/mp4', struct.pack('>I4s', 12, b'moov') + b'\0' * 4), 'a.mp4 (MP4 video)')
+
+
+class Mp3Test(unittest.TestCase):
+    def test_id3_title(self):
+        tag = id3([(b'TIT2', 'Song'), (b'TPE1', 'Band')])
+        self.assertEqual(id3_tag(tag), ('Band - Song', len(tag)))
+
+    def test_id3_truncated(self):
+        tag = id3([(b'TIT2', 'Song')])
+        for length in range(len(tag)):
+            # A frame cut short by the sniffed bytes is not read
+            self.assertEqual(id3_tag(tag[:length]), (None, len(tag) if length >= 10 else 0))
+        # Extended header flag without the extended header
+        self.assertEqual(id3_tag(b'ID3\x03\x00\x40\x00\x00\x00\x10'), (None, 26))
+
+    def test_cbr_duration(self):
+        frame = struct.pack('>I', 0xfffb9000)  # MPEG 1 layer III, 128 kbps, 44.1 kHz
+        self.assertEqual(mp3_duration(frame, 0, 160000), 10)
+        self.assertIsNone(mp3_duration(frame, 0, None))
+        self.assertIsNone(mp3_duration(frame[:3], 0, 160000))
+        self.assertIsNone(mp3_duration(b'\0\0\0\0', 0, 160000))
+
+
+class SeekScanTest(unittest.TestCase):
+    def test_gives_up_on_backwards_offsets(self):
+        calls = []
+
+        async def read_range(start, length):
+            calls.append(start)
+            return b'\0' * length
+
+        def scanner(data, base):
+            return None, 0
+
+        self.assertIsNone(asyncio.run(seek_scan(scanner, b'', None, read_range)))
+        self.assertEqual(calls, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+import httpx
+
+from modules.spaceapi import MatrixModule
+
+
+class FakeBot:
+    def __init__(self, rooms):
+        self.client = SimpleNamespace(rooms=dict.fromkeys(rooms))
+        self.sent = []
+
+    def save_settings(self):
+        pass
+
+    def get_room_by_id(self, roomid):
+        return roomid
+
+    async def send_text(self, room, body, **kwargs):
+        self.sent.append((room, body))
+
+
+class SpaceApiTest(unittest.TestCase):
+    def test_change_after_unchanged_polls_is_announced(self):
+        state = {'open': True}
+
+        def handler(request):
+            etag = f'"{state["open"]}"'
+            if request.headers.get('if-none-match') == etag:
+                return httpx.Response(304)
+            return httpx.Response(200, headers={'etag': etag}, json={'space': 'Hack', 'state': dict(state)})
+
+        async def poll(module, bot, times=1):
+            for _ in range(times):
+                await module.poll_all_accounts(bot, force=True)
+
+        async def run():
+            module = MatrixModule('spaceapi')
+            module.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            module.set_settings({'account_rooms': {'!room': ['https://space/api']}})
+            bot = FakeBot(['!room'])
+            # First poll only learns the status, unchanged ones are not modified
+            await poll(module, bot, 3)
+            self.assertEqual(bot.sent, [])
+            state['open'] = False
+            await poll(module, bot)
+            self.assertEqual(bot.sent, [('!room', 'Hack is now closed 🔒')])
+            state['open'] = True
+            await poll(module, bot, 2)
+            self.assertEqual(bot.sent[1:], [('!room', 'Hack is now open 🔓')])
+            await module.client.aclose()
+
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+import unittest
+
+from modules.users import UserClassifier
+
+
+class UserClassifierTest(unittest.TestCase):
+    def test_multiple_wildcard_patterns(self):
+        # fnmatch.translate of patterns with several *'s uses named groups on Python < 3.11
+        classifier = UserClassifier({
+            'bots': '@*bot*:*',
+            'admins': '@admin*:*.org',
+            'example': '@*:example.com',
+        })
+        self.assertEqual(classifier.classify('@mybot1:matrix.org'), 'bots')
+        self.assertEqual(classifier.classify('@admin:foo.org'), 'admins')
+        self.assertEqual(classifier.classify('@someone:example.com'), 'example')
+        self.assertIsNone(classifier.classify('@someone:foo.org'))
+
+    def test_first_class_wins(self):
+        classifier = UserClassifier({'example': '@*:example.com', 'bots': '@*bot*:*'})
+        self.assertEqual(classifier.classify('@bot:example.com'), 'example')
+        self.assertEqual(classifier.classify('@bot:foo.org'), 'bots')
+
+
+if __name__ == '__main__':
+    unittest.main()